@@ -1,4 +1,13 @@
 import os, sys, re
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == 'audit':
+    # Offline rule audit, run from a shell outside of Kodi. Run as a module so that
+    # its worker processes import it instead of this file, which needs Kodi.
+    import runpy
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'lib'))
+    del sys.argv[1]
+    runpy.run_module('audit', run_name='__main__', alter_sys=True)
+
 import xbmc, xbmcaddon, xbmcvfs, xbmcgui
 import json as simplejson
 
@@ -32,12 +41,14 @@ class Main:
         self._daemon()
 
     def _init_vars(self):
-        self.Monitor = LangPref_Monitor()
         self.Player = LangPrefMan_Player()
+        self.Monitor = LangPref_Monitor(self.Player)
 
     def _daemon(self):
         while not self.Monitor.abortRequested():
             self.Monitor.waitForAbort(1)
+        self.Player.saveDecisionCache()
+        self.Player.saveCustomMediaPreferences()
 
 
 # Allow this to be called as a script with parameters
@@ -0,0 +1,280 @@
+"""
+Offline audit of the preference rules over exported stream sets, run from a shell outside of Kodi:
+
+    python default.py audit <dump.jsonl> [--settings <settings.xml>] [--workers <n>] [--output <report.jsonl>]
+
+Each line of the dump is one item, either the result of Player.GetProperties (audiostreams, subtitles,
+currentaudiostream, currentsubtitle, subtitleenabled) or a library item with its streamdetails, optionally with
+its file, label, genre and tag. The chosen tracks of each item are written as JSON lines, followed by a summary
+of the items falling through to "none of the preferred languages is available" and of the hits of each rule.
+"""
+import os
+import sys
+import argparse
+import itertools
+import logging
+import multiprocessing
+import threading
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+
+import json as simplejson
+
+import logger
+from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+from prefengine import StreamSnapshot, decideMany, ACTION_AUDIO, ACTION_SUBTITLE, ACTION_SHOW_SUBTITLES, \
+    TRACE_AUDIO, TRACE_SUBTITLE, TRACE_CONDSUB, TRACE_ORIGINAL, TRACE_FILENAME
+from prefkernel import bulkKernel
+from prefsettings import settings
+
+# Number of dump lines sent at once to a worker process
+AUDIT_CHUNK_SIZE = 500
+# Number of chunks read ahead of the report, per worker process
+AUDIT_CHUNKS_IN_FLIGHT = 4
+
+__addon_settings_file__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'settings.xml')
+
+
+class SettingsFile:
+    """
+    The addon settings as stored by Kodi, for use outside Kodi: the defaults of the addon's settings definition,
+    overridden by the values of a user settings file (userdata/addon_data/service.languagepreferencemanager/settings.xml).
+    """
+
+    def __init__(self, file_name=None):
+        self.values = {}
+        for setting in ElementTree.parse(__addon_settings_file__).iter('setting'):
+            default = setting.find('default')
+            if setting.get('id') and default is not None:
+                self.values[setting.get('id')] = default.text or ''
+        if file_name:
+            for setting in ElementTree.parse(file_name).iter('setting'):
+                # Settings files version 1 keep the value in an attribute, version 2 in the element text
+                if setting.get('id'):
+                    self.values[setting.get('id')] = setting.get('value', setting.text or '')
+
+    def getSetting(self, setting_id):
+        return self.values.get(setting_id, '')
+
+
+def snapshotFromItem(item, use_genres):
+    """
+    Build the snapshot of an exported item, as the player would report it at the start of the playback.
+    Library items do not tell the initial selection: the first audio track is considered selected, without subtitles.
+    """
+    if 'result' in item and isinstance(item['result'], dict):
+        # Raw JSON-RPC response
+        item = item['result']
+    if 'streamdetails' in item:
+        streamdetails = item['streamdetails'] or {}
+        audiostreams = [dict(stream, index=index) for index, stream in enumerate(streamdetails.get('audio', []))]
+        subtitles = [dict(sub, index=index) for index, sub in enumerate(streamdetails.get('subtitle', []))]
+        selected_audio_stream = audiostreams[0] if audiostreams else None
+        selected_sub = None
+        subtitle_enabled = False
+    else:
+        audiostreams = item['audiostreams']
+        subtitles = item.get('subtitles', [])
+        selected_audio_stream = item.get('currentaudiostream')
+        selected_sub = item.get('currentsubtitle')
+        subtitle_enabled = item.get('subtitleenabled', False)
+    genres_and_tags = set()
+    if use_genres:
+        genres_and_tags = set(map(lambda x: x.lower(), item.get('genre', []) + item.get('tag', [])))
+    return StreamSnapshot(audiostreams, subtitles, selected_audio_stream, selected_sub, subtitle_enabled,
+                          genres_and_tags, file_name=item.get('file', ''))
+
+
+def itemName(item, line_number):
+    if 'result' in item and isinstance(item['result'], dict):
+        item = item['result']
+    return item.get('file') or item.get('label') or 'line {0}'.format(line_number)
+
+
+def track(streams, index):
+    stream = next((stream for stream in streams if stream.get('index') == index), None)
+    if stream is None:
+        return None
+    return {"index": index, "language": stream.get('language', ''), "name": stream.get('name', '')}
+
+
+def readItem(line_number, line, audit_settings):
+    """
+    :return: The name and snapshot of the item on one line of the dump
+    """
+    item = simplejson.loads(line)
+    return itemName(item, line_number), snapshotFromItem(item, audit_settings.custom_audio_prefs_on or
+                                                         audit_settings.custom_sub_prefs_on or
+                                                         audit_settings.custom_condsub_prefs_on)
+
+
+def itemReport(line_number, name, snapshot, decision, trace, rules):
+    """
+    :return: The report of one item, as a dict
+    """
+    audio_index = snapshot.selected_audio_stream.get('index')
+    sub_index = snapshot.selected_sub.get('index')
+    subtitle_enabled = snapshot.subtitle_enabled
+    for action, value in decision.actions:
+        if action == ACTION_AUDIO:
+            audio_index = value
+        elif action == ACTION_SUBTITLE:
+            sub_index = value
+        elif action == ACTION_SHOW_SUBTITLES:
+            subtitle_enabled = value
+
+    return {"line": line_number,
+            "item": name,
+            "audio": track(snapshot.audiostreams, audio_index),
+            "subtitle": track(snapshot.subtitles, sub_index),
+            "subtitles_enabled": subtitle_enabled,
+            "changes": [list(action) for action in decision.actions],
+            "rules": dict((kind, ruleName(rules, kind, rule)) for kind, rule in trace if rule is not None),
+            "none_available": [kind for kind, rule in trace if rule is None]}
+
+
+def ruleName(rules, kind, rule):
+    """
+    :return: A readable name of a rule found in an evaluation trace
+    """
+    if rule in (TRACE_ORIGINAL, TRACE_FILENAME):
+        return rule
+    group_position, rule_position = rule
+    plan = {TRACE_AUDIO: rules.audio_prefs, TRACE_SUBTITLE: rules.sub_prefs, TRACE_CONDSUB: rules.condsub_prefs}[kind]
+    group = plan.groups[group_position]
+    compiled_rule = group.rules[rule_position]
+    if kind == TRACE_CONDSUB:
+        name = '{0}:{1}'.format(compiled_rule.audio_name, compiled_rule.sub_name)
+        if compiled_rule.ss_tag:
+            name += '-ss'
+    else:
+        name = compiled_rule.name
+    if kind != TRACE_AUDIO and compiled_rule.forced:
+        name += '-ff'
+    if group.genres_and_tags:
+        name = '{0}#{1}'.format(','.join(sorted(group.genres_and_tags)), name)
+    return '{0} {1}.{2} {3}'.format(kind, group_position + 1, rule_position + 1, name)
+
+
+# Settings of a worker process, read once when the process starts
+_audit_settings = None
+
+
+def initWorker(settings_file_name):
+    global _audit_settings
+    # Evaluations log at info level, only errors are of interest in an audit
+    logger.log_level = LOG_ERROR
+    _audit_settings = settings(SettingsFile(settings_file_name))
+    _audit_settings.readSettings()
+
+
+def auditChunk(lines):
+    """
+    Run the rules over a chunk of the dump at once, in a worker process.
+    :return: The report lines of the chunk, with its counts for the summary
+    """
+    rules = _audit_settings.compiled_rules
+    errors = []
+    items = []
+    for line_number, line in lines:
+        try:
+            items.append((line_number,) + readItem(line_number, line, _audit_settings))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            errors.append((line_number, str(e)))
+    traces = [[] for _ in items]
+    decisions = decideMany([snapshot for _, _, snapshot in items], rules, traces, bulkKernel())
+
+    reports = [{"line": line_number, "error": error} for line_number, error in errors]
+    none_available = Counter()
+    rule_hits = Counter()
+    for (line_number, name, snapshot), decision, trace in zip(items, decisions, traces):
+        report = itemReport(line_number, name, snapshot, decision, trace, rules)
+        none_available.update(report['none_available'])
+        rule_hits.update(report['rules'].values())
+        reports.append(report)
+    reports.sort(key=lambda report: report['line'])
+    report_lines = ''.join(simplejson.dumps(report) + '\n' for report in reports)
+    return report_lines, len(items), errors, none_available, rule_hits
+
+
+def readChunks(file, in_flight):
+    """
+    Read the dump by chunks of numbered non empty lines, no more than allowed by the in_flight semaphore.
+    """
+    lines = ((line_number, line) for line_number, line in enumerate(file, 1) if line.strip())
+    while True:
+        chunk = list(itertools.islice(lines, AUDIT_CHUNK_SIZE))
+        if not chunk:
+            return
+        in_flight.acquire()
+        yield chunk
+
+
+def audit(dump_file_name, settings_file_name=None, workers=None, output=sys.stdout):
+    """
+    Run the rules over all items of a dump, in parallel, streaming the dump and the report.
+    :return: The summary, as a dict
+    """
+    workers = workers or os.cpu_count() or 1
+    items = 0
+    errors = 0
+    none_available = Counter()
+    rule_hits = Counter()
+
+    in_flight = threading.BoundedSemaphore(workers * AUDIT_CHUNKS_IN_FLIGHT)
+    with open(dump_file_name, 'r', encoding='utf-8') as file:
+        if workers == 1:
+            initWorker(settings_file_name)
+            pool = None
+            reports = map(auditChunk, readChunks(file, in_flight))
+        else:
+            pool = multiprocessing.Pool(workers, initializer=initWorker, initargs=(settings_file_name,))
+            reports = pool.imap(auditChunk, readChunks(file, in_flight))
+        try:
+            for report_lines, chunk_items, chunk_errors, chunk_none_available, chunk_rule_hits in reports:
+                in_flight.release()
+                output.write(report_lines)
+                items += chunk_items
+                errors += len(chunk_errors)
+                for line_number, error in chunk_errors:
+                    log(LOG_ERROR, 'Audit: line {0} skipped: {1}'.format(line_number, error))
+                none_available.update(chunk_none_available)
+                rule_hits.update(chunk_rule_hits)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    return {"items": items, "errors": errors,
+            "none_available": dict(none_available), "rule_hits": dict(rule_hits.most_common())}
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='default.py audit',
+                                     description='Run the preference rules over exported stream sets.')
+    parser.add_argument('dump', help='JSON lines file, one Player.GetProperties result or library item per line')
+    parser.add_argument('--settings', help='Addon settings file to use instead of the default settings')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: all cores)')
+    parser.add_argument('--output', help='Report file (default: standard output)')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', stream=sys.stderr)
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        summary = audit(args.dump, args.settings, args.workers, output)
+    finally:
+        if args.output:
+            output.close()
+
+    sys.stderr.write('Audited {0} items ({1} lines skipped)\n'.format(summary['items'], summary['errors']))
+    for kind in (TRACE_AUDIO, TRACE_SUBTITLE, TRACE_CONDSUB):
+        sys.stderr.write('None of the preferred languages available ({0}): {1} items\n'.format(
+            kind, summary['none_available'].get(kind, 0)))
+    sys.stderr.write('Rule hits:\n')
+    for rule, hits in summary['rule_hits'].items():
+        sys.stderr.write('  {0}: {1}\n'.format(rule, hits))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,16 +1,56 @@
 from logger import log, LOG_INFO, LOG_DEBUG, LOG_ERROR
+import os
+import hashlib
+import threading
+from collections import deque
+import xbmcaddon
 import xbmcvfs
 import json as simplejson
 
 __user_data_path__ = xbmcvfs.translatePath("special://profile/addon_data/service.languagepreferencemanager/")
+__preferences_file__ = __user_data_path__ + "customMediaPreferences.json"
+__journal_file__ = __user_data_path__ + "customMediaPreferences.journal"
 
 from resources.lib import kodi_utils
 
+# Seconds without new changes to wait before saving the custom media preferences in the background
+PREFERENCES_SAVE_DELAY = 2
+# The journal is compacted into a new preferences file once larger than this part of the preferences file,
+# and than JOURNAL_MIN_COMPACTION_SIZE bytes
+JOURNAL_COMPACTION_RATIO = 0.5
+JOURNAL_MIN_COMPACTION_SIZE = 64 * 1024
+
 
 class MediaPreferenceManager:
+    """
+    The custom media preferences, in the order they were added, indexed by their media selector: by its string,
+    and by the TV show title and file name it applies to.
+    """
 
     def __init__(self):
-        self.preferences = []
+        # Preferences by selector string, in insertion order
+        self.preferences_by_selector = {}
+        # Insertion number of each selector string, to break priority ties in insertion order
+        self.selector_positions = {}
+        self.next_position = 0
+        # Preferences by the TV show title, and by the file name, of their selector
+        self.tv_show_index = {}
+        self.file_index = {}
+        # Incremented on each change, to tell whether a preference looked up earlier is still the one that applies
+        self.version = 0
+        # Saves the preferences in the background once started, otherwise they are saved right away
+        self.writer = None
+        # Changes not written to the journal yet, while the writer runs
+        self.pending_changes = deque()
+        # Guards the changes against the writer thread: a snapshot of the preferences is taken together with the
+        # pending changes it includes, so that none of them is written again to the journal of the snapshot
+        self.lock = threading.RLock()
+        # Hash of the preferences file the journal applies to, None if there is no such file
+        self.snapshot_hash = None
+
+    @property
+    def preferences(self):
+        return list(self.preferences_by_selector.values())
 
     def add_preference(self, custom_media_preference):
         if not isinstance(custom_media_preference, CustomMediaPreference):
@@ -21,15 +61,57 @@ class MediaPreferenceManager:
             log(LOG_ERROR, "Cannot add empty custom media preference")
             return
 
-        matching_preference = self.get_matching_preference(custom_media_preference)
-        if matching_preference is not None:
-            self.remove_preference(matching_preference)
+        # A preference for the same media replaces the previous one, and moves to the end
+        with self.lock:
+            self.remove_selector(selector_key(custom_media_preference.selector))
+            self.insert_preference(custom_media_preference)
+            self.version += 1
+            if self.writer is not None:
+                self.pending_changes.append({"add": custom_media_preference.to_json()})
+
+    def insert_preference(self, custom_media_preference):
+        key = selector_key(custom_media_preference.selector)
+        self.preferences_by_selector[key] = custom_media_preference
+        self.selector_positions[key] = self.next_position
+        self.next_position += 1
+
+        selector = custom_media_preference.selector
+        if selector is None:
+            return
+        if selector.tv_show_name:
+            self.tv_show_index[selector.tv_show_name] = custom_media_preference
+        if selector.file_name:
+            self.file_index.setdefault(selector.file_name, {})[key] = custom_media_preference
 
-        self.preferences.append(custom_media_preference)
+    def remove_selector(self, key):
+        """
+        Remove the preference stored for a selector string, from the preferences and the indexes.
+        :return: True if there was one, False otherwise
+        """
+        preference = self.preferences_by_selector.pop(key, None)
+        if preference is None:
+            return False
+        del self.selector_positions[key]
+
+        selector = preference.selector
+        if selector is None:
+            return True
+        if selector.tv_show_name and self.tv_show_index.get(selector.tv_show_name) is preference:
+            del self.tv_show_index[selector.tv_show_name]
+        if selector.file_name:
+            file_preferences = self.file_index.get(selector.file_name, {})
+            file_preferences.pop(key, None)
+            if not file_preferences:
+                self.file_index.pop(selector.file_name, None)
+        return True
 
     def remove_preference(self, custom_media_preference):
-        if self.has_preference(custom_media_preference):
-            self.preferences.remove(custom_media_preference)
+        key = selector_key(custom_media_preference.selector)
+        with self.lock:
+            if self.remove_selector(key):
+                self.version += 1
+                if self.writer is not None:
+                    self.pending_changes.append({"remove": key})
 
     def has_preference(self, custom_media_preference):
         """
@@ -45,11 +127,28 @@ class MediaPreferenceManager:
         :param custom_media_preference: The custom media preference to match
         :return: The custom media preference that matches the media selector of the given custom media preference, or None if no preference matches
         """
-        for preference in self.preferences:
-            if preference.selector.is_same_media(custom_media_preference.selector):
-                return preference
+        return self.preferences_by_selector.get(selector_key(custom_media_preference.selector))
 
-        return None
+    def get_candidates_for_item(self, is_tv_show, tv_show_title, file_name):
+        """
+        Get the preferences that can apply to an item, from the indexes: the preference of its TV show, and the
+        preferences of its file.
+        """
+        candidates = []
+        if is_tv_show and tv_show_title in self.tv_show_index:
+            candidates.append(self.tv_show_index[tv_show_title])
+        candidates.extend(self.file_index.get(file_name, {}).values())
+        return candidates
+
+    def get_highest_priority(self, preferences):
+        """
+        :return: The preference with the highest priority, the first added one if several have it, None if there are none
+        """
+        if len(preferences) == 0:
+            return None
+
+        return max(preferences, key=lambda preference: (
+            preference.priority_index, -self.selector_positions[selector_key(preference.selector)]))
 
     def get_preference(self, player):
         """
@@ -59,44 +158,160 @@ class MediaPreferenceManager:
         :return:  The custom media preference that applies to the playing item with the highest priority, or None if no preference applies
         """
 
-        applicable_preferences = []
+        identity = MediaIdentity.from_player(player)
+        if identity is None:
+            return None
 
-        for preference in self.preferences:
-            log(LOG_DEBUG, "Checking preference: " + preference.selector.to_string())
-            if preference.selector.applies_to_player(player):
-                applicable_preferences.append(preference)
+        return self.get_preference_for_item(identity.is_tv_show, identity.tv_show_title, identity.file_name)
 
-        if len(applicable_preferences) == 0:
-            return None
+    def get_preference_for_item(self, is_tv_show, tv_show_title, file_name):
+        """
+        Get the custom media preference that applies to an item with the highest priority, without it being played.
+        :param is_tv_show: True if the item is an episode of a TV show
+        :param tv_show_title: The title of the TV show of the item
+        :param file_name: The file of the item
+        :return: The custom media preference that applies to the item with the highest priority, or None if no preference applies
+        """
+        applicable_preferences = [preference for preference in
+                                  self.get_candidates_for_item(is_tv_show, tv_show_title, file_name)
+                                  if preference.selector.applies_to_item(is_tv_show, tv_show_title, file_name)]
 
-        return max(applicable_preferences, key=lambda preference: preference.priority_index)
+        return self.get_highest_priority(applicable_preferences)
 
     def save_preferences(self):
-        file_name = __user_data_path__ + "customMediaPreferences.json"
+        """
+        Save the preferences, in the background if the writer is started.
+        """
+        if self.writer is not None:
+            self.writer.schedule()
+        else:
+            self.write_preferences()
+
+    def write_preferences(self):
+        """
+        Write the preferences file, and start a new journal for it. The file is replaced at once by a complete new
+        file, so that a crash cannot leave it truncated.
+        :return: True if the preferences file was written
+        """
+        with self.lock:
+            preferences = self.to_json()
+            # The snapshot includes all the changes made so far, only the next ones go to its journal
+            self.pending_changes.clear()
+            data = simplejson.dumps(preferences, separators=(',', ':'))
+            snapshot_hash = hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+            try:
+                write_file_atomically(__preferences_file__, data)
+                # A journal left by a crash right here is ignored on load: it is for the previous preferences file
+                self.snapshot_hash = snapshot_hash
+                write_file_atomically(__journal_file__, simplejson.dumps({"snapshot": snapshot_hash}) + "\n")
+                log(LOG_DEBUG, "Saved " + str(len(preferences)) + " custom media preferences")
+                return True
+            except (IOError, OSError) as e:
+                log(LOG_ERROR, "Failed to save custom media preferences: " + str(e))
+                return False
 
-        with open(file_name, 'w') as file:
-            file.write(simplejson.dumps(self.to_json(), indent=4))
+    def write_changes(self):
+        """
+        Append the pending changes to the journal, one JSON line each. Once the journal grows too large compared to
+        the preferences file, write a new preferences file instead.
+        """
+        with self.lock:
+            changes = list(self.pending_changes)
+            self.pending_changes.clear()
+        if not changes:
+            return
+
+        try:
+            if self.snapshot_hash is None or not os.path.exists(__journal_file__) or \
+                    os.path.getsize(__journal_file__) > max(JOURNAL_MIN_COMPACTION_SIZE,
+                                                            os.path.getsize(__preferences_file__) *
+                                                            JOURNAL_COMPACTION_RATIO):
+                log(LOG_DEBUG, "Compacting the custom media preferences journal")
+                self.write_preferences()
+                return
+
+            with open(__journal_file__, 'a') as file:
+                file.write(''.join(simplejson.dumps(change, separators=(',', ':')) + "\n" for change in changes))
+                file.flush()
+                os.fsync(file.fileno())
+            log(LOG_DEBUG, "Saved " + str(len(changes)) + " custom media preference changes")
+        except (IOError, OSError) as e:
+            log(LOG_ERROR, "Failed to save custom media preferences: " + str(e))
+
+    def replay_journal(self):
+        """
+        Apply the changes of the journal written for the loaded preferences file.
+        """
+        if not os.path.exists(__journal_file__):
+            return
+
+        changes = 0
+        try:
+            with open(__journal_file__, 'r') as file:
+                header = file.readline()
+                if not header or simplejson.loads(header).get("snapshot") != self.snapshot_hash:
+                    log(LOG_DEBUG, "Custom media preferences journal is for another preferences file, ignoring it")
+                    return
+                for line in file:
+                    try:
+                        change = simplejson.loads(line)
+                    except ValueError:
+                        # Only the last line can be incomplete, if a crash happened while writing it
+                        log(LOG_ERROR, "Ignoring incomplete custom media preferences journal line")
+                        break
+                    if "add" in change:
+                        custom_media_preference = CustomMediaPreference.from_json(change["add"])
+                        self.remove_selector(selector_key(custom_media_preference.selector))
+                        self.insert_preference(custom_media_preference)
+                    elif "remove" in change:
+                        self.remove_selector(change["remove"])
+                    changes += 1
+        except (IOError, OSError, ValueError, KeyError, AttributeError) as e:
+            log(LOG_ERROR, "Failed to replay custom media preferences journal: " + str(e))
+
+        log(LOG_DEBUG, "Replayed " + str(changes) + " custom media preference changes")
+
+    def start_writer(self):
+        """
+        Save the preferences in the background from now on, once per burst of changes.
+        """
+        if self.writer is None:
+            self.writer = PreferencesWriter(self)
+            self.writer.start()
+
+    def stop_writer(self):
+        """
+        Stop saving the preferences in the background, saving any pending change right away.
+        """
+        if self.writer is not None:
+            writer = self.writer
+            self.writer = None
+            writer.stop()
 
     @staticmethod
     def from_file():
-        file_name = __user_data_path__ + "customMediaPreferences.json"
-        if xbmcvfs.exists(file_name):
+        custom_media_preferences = MediaPreferenceManager()
+        if xbmcvfs.exists(__preferences_file__):
             log(LOG_DEBUG, "Attempting custom media preferences from file")
 
-            with open(file_name, 'r') as file:
-                # Check if file is empty
-                if not file.read(1):
-                    log(LOG_DEBUG, "No custom media preferences found (empty file?)")
-                    return
-
-                file.seek(0)
+            with open(__preferences_file__, 'r') as file:
+                data = file.read()
 
+            # Check if file is empty
+            if not data:
+                log(LOG_DEBUG, "No custom media preferences found (empty file?)")
+            else:
                 try:
-                    return MediaPreferenceManager.from_json(simplejson.loads(file.read()))
+                    custom_media_preferences = MediaPreferenceManager.from_json(simplejson.loads(data))
                 except Exception as e:
                     log(LOG_ERROR, "Failed to load custom media preferences: " + str(e))
+                    return MediaPreferenceManager()
+
+            custom_media_preferences.snapshot_hash = hashlib.sha1(data.encode('utf-8')).hexdigest()
+            custom_media_preferences.replay_journal()
 
-        return MediaPreferenceManager()
+        return custom_media_preferences
 
     def to_json(self):
         return [preference.to_json() for preference in self.preferences]
@@ -105,13 +320,68 @@ class MediaPreferenceManager:
     def from_json(json):
         custom_media_preferences = MediaPreferenceManager()
         for preference_json in json:
-            custom_media_preferences.add_preference(CustomMediaPreference.from_json(preference_json))
+            custom_media_preference = CustomMediaPreference.from_json(preference_json)
+            # The last preference for the same media wins, as when adding them one by one
+            custom_media_preferences.remove_selector(selector_key(custom_media_preference.selector))
+            custom_media_preferences.insert_preference(custom_media_preference)
 
         log(LOG_DEBUG, "Loaded " + str(len(custom_media_preferences.preferences)) + " custom media preferences")
 
         return custom_media_preferences
 
 
+class PreferencesWriter(threading.Thread):
+    """
+    A thread that saves the custom media preferences of a MediaPreferenceManager. Changes coming in a burst are
+    saved once, PREFERENCES_SAVE_DELAY seconds after the last one.
+    """
+
+    def __init__(self, manager, delay=PREFERENCES_SAVE_DELAY):
+        super().__init__()
+        self.manager = manager
+        self.delay = delay
+
+        # Event to stop the thread gracefully
+        self._stop_event = threading.Event()
+        # Set on each change
+        self._change_event = threading.Event()
+        self._dirty = False
+        # Ensures one write at a time, from the thread or from flush
+        self._write_lock = threading.Lock()
+
+        # Ensures the thread exits when the program ends
+        self.daemon = True
+
+    def schedule(self):
+        """ The preferences changed, save them once no more changes come """
+        self._dirty = True
+        self._change_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._change_event.wait()
+            # Wait until the changes stop coming
+            while self._change_event.is_set() and not self._stop_event.is_set():
+                self._change_event.clear()
+                self._stop_event.wait(self.delay)
+            self.flush()
+
+    def flush(self):
+        """ Save the pending changes now """
+        with self._write_lock:
+            if not self._dirty:
+                return
+            # Changes made while writing set it again, and are saved by the next write
+            self._dirty = False
+            self.manager.write_changes()
+
+    def stop(self):
+        self._stop_event.set()
+        self._change_event.set()
+        self.join()
+        self.flush()
+
+
 class CustomMediaPreference:
 
     def __init__(self):
@@ -318,35 +588,26 @@ class MediaSelector:
         :param player: The player to check the media selector against
         :return: True if the media selector applies to the player, False otherwise
         """
-        if not player:
+        identity = MediaIdentity.from_player(player)
+        if identity is None:
             return False
 
-        if not player.isPlayingVideo():
-            log(LOG_DEBUG, 'Player is not playing video, cannot apply media selector')
-            return False
-
-        playing_item = player.getPlayingItem()
-
-        if not playing_item:
-            log(LOG_DEBUG, 'No playing item found, cannot apply media selector')
-            return
-
-        video_info_tag = playing_item.getVideoInfoTag()
-
-        if not video_info_tag:
-            log(LOG_DEBUG, 'No video info tag found, cannot apply media selector')
-            return
-
-        is_tv_show = kodi_utils.is_tv_show(video_info_tag.getMediaType())
-        log(LOG_DEBUG, 'Media Info: ' + video_info_tag.getMediaType() + " is_tv_show: " + str(is_tv_show))
+        return self.applies_to_item(identity.is_tv_show, identity.tv_show_title, identity.file_name)
 
+    def applies_to_item(self, is_tv_show, tv_show_title, file_name):
+        """
+        Check if the media selector applies to an item, given its identity.
+        :param is_tv_show: True if the item is an episode of a TV show
+        :param tv_show_title: The title of the TV show of the item
+        :param file_name: The file of the item
+        :return: True if the media selector applies to the item, False otherwise
+        """
         if is_tv_show and self.tv_show_name:
-            log(LOG_DEBUG,
-                'Checking TV Show name: ' + self.tv_show_name + ' against ' + video_info_tag.getTVShowTitle())
-            return video_info_tag.getTVShowTitle() == self.tv_show_name
+            log(LOG_DEBUG, 'Checking TV Show name: ' + self.tv_show_name + ' against ' + tv_show_title)
+            return tv_show_title == self.tv_show_name
         elif self.file_name:
-            log(LOG_DEBUG, 'Checking file name: ' + self.file_name + ' against ' + player.getPlayingFile())
-            return player.getPlayingFile() == self.file_name
+            log(LOG_DEBUG, 'Checking file name: ' + self.file_name + ' against ' + file_name)
+            return file_name == self.file_name
         else:
             return False
 
@@ -433,4 +694,87 @@ class MediaSelector:
         return media_selector
 
 
-media_preference_manager = MediaPreferenceManager.from_file()
+class MediaIdentity:
+    """
+    What the media selectors look at in a playing item: whether it is a TV show, the TV show title and the file.
+    It is read once from the player, each of these reads being a call into Kodi.
+    """
+
+    def __init__(self, is_tv_show, tv_show_title, file_name):
+        self.is_tv_show = is_tv_show
+        self.tv_show_title = tv_show_title
+        self.file_name = file_name
+
+    @staticmethod
+    def from_player(player):
+        """
+        Get the identity of the playing item of the player.
+        :param player: The player to get the identity of the playing item from
+        :return: The identity of the playing item, or None if the player is not playing a video
+        """
+        if not player:
+            return None
+
+        if not player.isPlayingVideo():
+            log(LOG_DEBUG, 'Player is not playing video, cannot apply media selector')
+            return None
+
+        playing_item = player.getPlayingItem()
+
+        if not playing_item:
+            log(LOG_DEBUG, 'No playing item found, cannot apply media selector')
+            return None
+
+        video_info_tag = playing_item.getVideoInfoTag()
+
+        if not video_info_tag:
+            log(LOG_DEBUG, 'No video info tag found, cannot apply media selector')
+            return None
+
+        media_type = video_info_tag.getMediaType()
+        is_tv_show = kodi_utils.is_tv_show(media_type)
+        log(LOG_DEBUG, 'Media Info: ' + media_type + " is_tv_show: " + str(is_tv_show))
+
+        return MediaIdentity(is_tv_show, video_info_tag.getTVShowTitle(), player.getPlayingFile())
+
+
+def write_file_atomically(file_name, data):
+    """
+    Replace a file by a new one with the given content, so that a crash leaves either the old or the new file.
+    """
+    temp_file_name = file_name + ".tmp"
+    with open(temp_file_name, 'w') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file_name, file_name)
+
+
+def selector_key(media_selector):
+    """
+    Get the key of a media selector in the indexes of the MediaPreferenceManager: the string it serializes to.
+    :param media_selector: The media selector, or None
+    :return: The key of the media selector
+    """
+    return media_selector.to_string() if media_selector else ""
+
+
+def load_preference_manager():
+    """
+    Load the custom media preferences from the storage chosen in the settings: the SQLite database, or
+    customMediaPreferences.json and its journal. A database left from when the setting was enabled is exported back
+    to customMediaPreferences.json first, as the file was not kept up to date meanwhile.
+    :return: The media preference manager
+    """
+    # Imported here, as it builds on this module
+    from sqlite_media_preference import SqliteMediaPreferenceManager
+    if xbmcaddon.Addon().getSetting('preferencesDatabase') == 'true':
+        manager = SqliteMediaPreferenceManager.open()
+        if manager is not None:
+            return manager
+    else:
+        SqliteMediaPreferenceManager.export_to_file()
+    return MediaPreferenceManager.from_file()
+
+
+media_preference_manager = load_preference_manager()
@@ -0,0 +1,117 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import json as simplejson
+
+from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+from prefengine import Decision
+
+# Maximum number of stream layouts kept in the decision cache
+DECISION_CACHE_SIZE = 500
+
+
+def snapshotFingerprint(snapshot, rules):
+    """
+    Fingerprint of a stream layout: languages, names (through their keyword flags), forced/original flags
+    and selected indices of all tracks, plus the video's genres/tags. Episodes of the same show usually share the same fingerprint.
+    :param snapshot: The StreamSnapshot of the playing item
+    :param rules: The CompiledRules in use
+    :return: The fingerprint as a hex string
+    """
+    features = snapshot.features(rules.keyword_matcher)
+    layout = (
+        [(t.index, t.language, t.blacklisted, t.original) for t in features.audio],
+        [(t.index, t.language, t.blacklisted, t.signs, t.forced) for t in features.subtitles],
+        features.selected_audio_index,
+        features.selected_sub_index,
+        snapshot.subtitle_enabled,
+        sorted(snapshot.genres_and_tags),
+        snapshot.initial,
+        # Filename preferences make the decision specific to the file
+        snapshot.file_name if rules.use_filename else '',
+    )
+    return hashlib.sha1(repr(layout).encode('utf-8')).hexdigest()
+
+
+class DecisionCache:
+    """
+    A bounded LRU cache of preference Decisions, keyed by stream layout fingerprint.
+    Entries are only valid for the rules version they were computed with.
+    """
+
+    def __init__(self, max_size=DECISION_CACHE_SIZE):
+        self.max_size = max_size
+        self.rules_version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint):
+        with self._lock:
+            decision = self._entries.get(fingerprint)
+            if decision is not None:
+                self._entries.move_to_end(fingerprint)
+        return decision
+
+    def put(self, fingerprint, decision):
+        with self._lock:
+            self._entries[fingerprint] = decision
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, rules_version):
+        """
+        Drop all cached decisions if the rules changed since they were computed.
+        :param rules_version: The version of the rules currently in use
+        """
+        with self._lock:
+            if rules_version != self.rules_version:
+                if self._entries:
+                    log(LOG_DEBUG, 'Preference rules changed, clearing {0} cached decisions'.format(len(self._entries)))
+                self._entries.clear()
+                self.rules_version = rules_version
+
+    def __len__(self):
+        return len(self._entries)
+
+    def save(self, file_name):
+        with self._lock:
+            data = {"rules_version": self.rules_version,
+                    "entries": [[key, decision.to_json()] for key, decision in self._entries.items()]}
+        temp_file_name = file_name + '.tmp'
+        try:
+            with open(temp_file_name, 'w') as file:
+                file.write(simplejson.dumps(data, separators=(',', ':')))
+            os.replace(temp_file_name, file_name)
+            log(LOG_DEBUG, 'Saved {0} cached decisions'.format(len(data['entries'])))
+        except (IOError, OSError) as e:
+            log(LOG_ERROR, 'Failed to save decision cache: ' + str(e))
+
+    def load(self, file_name, rules_version):
+        """
+        Restore the cached decisions saved by a previous run, unless they were computed with other rules.
+        """
+        if not os.path.exists(file_name):
+            return
+        try:
+            with open(file_name, 'r') as file:
+                data = simplejson.loads(file.read())
+        except (IOError, OSError, ValueError) as e:
+            log(LOG_ERROR, 'Failed to load decision cache: ' + str(e))
+            return
+
+        if data.get('rules_version') != rules_version:
+            log(LOG_DEBUG, 'Saved decision cache was computed with other rules, ignoring it')
+            return
+        try:
+            entries = OrderedDict((key, Decision.from_json(decision))
+                                  for key, decision in data.get('entries', [])[-self.max_size:])
+        except (KeyError, TypeError, ValueError) as e:
+            log(LOG_ERROR, 'Failed to load decision cache: ' + str(e))
+            return
+        with self._lock:
+            self.rules_version = rules_version
+            self._entries = entries
+        log(LOG_DEBUG, 'Loaded {0} cached decisions'.format(len(self._entries)))
@@ -61,9 +61,77 @@ LANGUAGES      = (
     ("Any"                        , "-2",       "",              "any",                 "46",                    30300  ),
     ("Undefined"                  , "-3",       "",              "und",                 "50",                    30350  ) )
 
+def _buildTranslateIndex():
+  # One dict per (from, to) column pair, keyed by every alias of the 'from' column (ex. German = ger,deu).
+  # The first matching row wins, like the former linear scan over LANGUAGES did.
+  index = {}
+  nbr_columns = len(LANGUAGES[0])
+  for lang_from in range(nbr_columns):
+    for lang_to in range(nbr_columns):
+      pair_index = {}
+      for x in LANGUAGES:
+        if not isinstance(x[lang_from], str):
+          continue
+        for code in x[lang_from].split(r','):
+          pair_index.setdefault(code, x[lang_to])
+      index[(lang_from, lang_to)] = pair_index
+  return index
+
+_TRANSLATE_INDEX = _buildTranslateIndex()
+
 def languageTranslate(lang, lang_from, lang_to):
+  pair_index = _TRANSLATE_INDEX.get((lang_from, lang_to))
+  if pair_index is None:
+    return None
+  return pair_index.get(lang)
+
+def languageTranslateMany(langs, lang_from, lang_to):
+  """
+  Bulk version of languageTranslate: translates every code of langs in one go.
+  :return: A list of translated codes, None for each code not found
+  """
+  pair_index = _TRANSLATE_INDEX.get((lang_from, lang_to), {})
+  return [pair_index.get(lang) for lang in langs]
+
+def _buildLanguageIds():
+  # Canonical small integer per language: every alias code and the full name map to the same ID.
+  # Rows sharing a code (ex. Farsi and Persian = per) share the same ID.
+  ids = {}
+  next_id = 0
   for x in LANGUAGES:
-    codes = x[lang_from].split(r',')
-    for code in codes:
-      if lang == code :
-        return x[lang_to]
+    keys = [x[0]] + x[3].split(r',')
+    lang_id = next((ids[key] for key in keys if key in ids), None)
+    if lang_id is None:
+      lang_id = next_id
+      next_id += 1
+    for key in keys:
+      ids.setdefault(key, lang_id)
+  return ids
+
+_LANGUAGE_IDS = _buildLanguageIds()
+_LANGUAGE_ID_SETS = {}
+
+LANGUAGE_ID_UNKNOWN = -1
+LANGUAGE_ID_NONE = _LANGUAGE_IDS['non']
+LANGUAGE_ID_ANY = _LANGUAGE_IDS['any']
+LANGUAGE_ID_UNDEFINED = _LANGUAGE_IDS['und']
+
+def languageId(lang):
+  """
+  Get the canonical language ID of a 3-letter code (any alias) or a full language name.
+  :return: The language ID, or LANGUAGE_ID_UNKNOWN if the language is not in LANGUAGES
+  """
+  return _LANGUAGE_IDS.get(lang, LANGUAGE_ID_UNKNOWN)
+
+def languageIds(name, codes):
+  """
+  Get the set of canonical language IDs of a preference, given its full name and comma separated codes.
+  Results are memoized as preferences are evaluated against every stream of every playback.
+  """
+  key = (name, codes)
+  ids = _LANGUAGE_ID_SETS.get(key)
+  if ids is None:
+    langs = [name] + (codes.split(r',') if codes else [])
+    ids = frozenset(languageId(lang) for lang in langs) - {LANGUAGE_ID_UNKNOWN}
+    _LANGUAGE_ID_SETS[key] = ids
+  return ids
@@ -1,12 +1,20 @@
-import xbmc, xbmcaddon
+try:
+    import xbmc, xbmcaddon
+except ImportError:
+    # Headless use outside Kodi (offline evaluation, rule audits): log through the standard logging module
+    import logging
+    xbmc = None
 
 LOG_NONE = 0
 LOG_ERROR = 1
 LOG_INFO = 2
 LOG_DEBUG = 3
 
-addon = xbmcaddon.Addon()
-log_level = addon.getSetting('log_level')
+if xbmc is not None:
+    addon = xbmcaddon.Addon()
+    log_level = addon.getSetting('log_level')
+else:
+    log_level = None
 if log_level and len(log_level) > 0:
     log_level = int(log_level)
 else:
@@ -16,6 +24,11 @@ else:
 def log(level, msg):
 
     if level <= log_level:
+        if xbmc is None:
+            if level in (LOG_ERROR, LOG_INFO, LOG_DEBUG):
+                logging.getLogger('LanguagePreferenceManager').log(
+                    {LOG_ERROR: logging.ERROR, LOG_INFO: logging.INFO, LOG_DEBUG: logging.DEBUG}[level], msg)
+                return
         if level == LOG_ERROR:
             kodi_log_level = xbmc.LOGERROR
         elif level == LOG_INFO:
@@ -27,4 +40,4 @@ def log(level, msg):
             log(LOG_INFO, msg)
             return
 
-        xbmc.log("[Language Preference Manager]: " + str(msg), kodi_log_level)
\ No newline at end of file
+        xbmc.log("[Language Preference Manager]: " + str(msg), kodi_log_level)
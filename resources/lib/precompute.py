@@ -0,0 +1,370 @@
+import os
+import hashlib
+import itertools
+import threading
+
+import xbmc
+
+import json as simplejson
+
+from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+from decisioncache import snapshotFingerprint
+from prefengine import StreamSnapshot, Decision, decideMany
+from prefkernel import bulkKernel
+from rpcclient import queryJSONRPC
+
+# Number of library items requested per JSON-RPC page
+LIBRARY_PAGE_SIZE = 100
+# Layouts with more possible initial selections than this are left to evaluation at playback
+MAX_PRECOMPUTED_SELECTIONS = 512
+# Seconds between two checks while the job yields to playback
+PLAYBACK_POLL_INTERVAL = 5
+# Seconds to wait before a run, so that settings and library updates settle
+RUN_DELAY = 30
+
+
+def libraryLayoutKey(audiostreams, subtitles, genres_and_tags, file_name):
+    """
+    Key of everything decisions depend on for a library item, as known by the library.
+    An item needs to be processed again only if its key changed.
+    """
+    layout = ([stream['language'] for stream in audiostreams],
+              [sub['language'] for sub in subtitles],
+              sorted(genres_and_tags),
+              file_name)
+    return hashlib.sha1(repr(layout).encode('utf-8')).hexdigest()
+
+
+def libraryStreams(streamdetails):
+    """
+    :return: The audio streams and subtitles of a library item, as the player would list them
+    """
+    # Library stream details are listed in the player tracks order
+    audiostreams = [{'index': index, 'language': stream.get('language', '')}
+                    for index, stream in enumerate(streamdetails.get('audio', []))]
+    subtitles = [{'index': index, 'language': sub.get('language', '')}
+                 for index, sub in enumerate(streamdetails.get('subtitle', []))]
+    return audiostreams, subtitles
+
+
+def precomputeDecisions(audiostreams, subtitles, genres_and_tags, file_name, rules):
+    """
+    Evaluate the preferences for all the initial selections the player could report for a stream layout.
+    :return: A dict of Decisions by snapshot fingerprint, empty if the layout has too many possible selections
+    """
+    audio_choices = list(audiostreams) or [None]
+    sub_choices = [None] + list(subtitles)
+    if len(audio_choices) * len(sub_choices) * 2 > MAX_PRECOMPUTED_SELECTIONS:
+        return {}
+    snapshots = [StreamSnapshot(audiostreams, subtitles, audio, sub, enabled, genres_and_tags, file_name)
+                 for audio, sub, enabled in itertools.product(audio_choices, sub_choices, (False, True))]
+    return dict((snapshotFingerprint(snapshot, rules), decision)
+                for snapshot, decision in zip(snapshots, decideMany(snapshots, rules, kernel=bulkKernel())))
+
+
+class PrecomputedDecisions:
+    """
+    The decisions computed in the background for the stream layouts found in the video library, by snapshot fingerprint,
+    with the library items they were computed for. Only valid for the rules version they were computed with.
+    """
+
+    def __init__(self):
+        self.rules_version = None
+        # file -> [layout key, genres/tags or None]
+        self.items = {}
+        # layout key -> {fingerprint: Decision}
+        self.layouts = {}
+        self._decisions = {}
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint):
+        return self._decisions.get(fingerprint)
+
+    def genresAndTags(self, file_name):
+        """
+        :return: The genres/tags the library reports for a movie file, None if unknown
+        """
+        item = self.items.get(file_name)
+        if item is None or item[1] is None:
+            return None
+        return set(item[1])
+
+    def isCurrent(self, file_name, layout_key):
+        item = self.items.get(file_name)
+        return item is not None and item[0] == layout_key and layout_key in self.layouts
+
+    def hasLayout(self, layout_key):
+        return layout_key in self.layouts
+
+    def putItem(self, file_name, layout_key, genres_and_tags=None, decisions=None):
+        with self._lock:
+            self.items[file_name] = [layout_key, sorted(genres_and_tags) if genres_and_tags is not None else None]
+            if decisions is not None:
+                self.layouts[layout_key] = decisions
+                self._decisions.update(decisions)
+
+    def prune(self, seen_files):
+        """
+        Forget the items no longer in the library, and the layouts no longer used by any item.
+        """
+        with self._lock:
+            self.items = {file_name: item for file_name, item in self.items.items() if file_name in seen_files}
+            used = set(item[0] for item in self.items.values())
+            self.layouts = {key: decisions for key, decisions in self.layouts.items() if key in used}
+            self._decisions = {}
+            for decisions in self.layouts.values():
+                self._decisions.update(decisions)
+
+    def invalidate(self, rules_version):
+        with self._lock:
+            if rules_version != self.rules_version:
+                self.items = {}
+                self.layouts = {}
+                self._decisions = {}
+                self.rules_version = rules_version
+
+    def clear(self):
+        """ Forget all decisions, so that playback no longer uses them """
+        with self._lock:
+            self.items = {}
+            self.layouts = {}
+            self._decisions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def save(self, file_name):
+        with self._lock:
+            data = {"rules_version": self.rules_version,
+                    "items": self.items,
+                    "layouts": {key: [[fingerprint, decision.to_json()] for fingerprint, decision in decisions.items()]
+                                for key, decisions in self.layouts.items()}}
+        temp_file_name = file_name + '.tmp'
+        try:
+            with open(temp_file_name, 'w') as file:
+                file.write(simplejson.dumps(data, separators=(',', ':')))
+            os.replace(temp_file_name, file_name)
+            log(LOG_DEBUG, 'Saved precomputed decisions for {0} library items'.format(len(data['items'])))
+        except (IOError, OSError) as e:
+            log(LOG_ERROR, 'Failed to save precomputed decisions: ' + str(e))
+
+    def load(self, file_name, rules_version):
+        if not os.path.exists(file_name):
+            return
+        try:
+            with open(file_name, 'r') as file:
+                data = simplejson.loads(file.read())
+        except (IOError, OSError, ValueError) as e:
+            log(LOG_ERROR, 'Failed to load precomputed decisions: ' + str(e))
+            return
+
+        if data.get('rules_version') != rules_version:
+            log(LOG_DEBUG, 'Precomputed decisions were computed with other rules, ignoring them')
+            return
+        try:
+            layouts = {key: dict((fingerprint, Decision.from_json(decision)) for fingerprint, decision in decisions)
+                       for key, decisions in data.get('layouts', {}).items()}
+            items = dict(data.get('items', {}))
+        except (KeyError, TypeError, ValueError) as e:
+            log(LOG_ERROR, 'Failed to load precomputed decisions: ' + str(e))
+            return
+        decisions_by_fingerprint = {}
+        for decisions in layouts.values():
+            decisions_by_fingerprint.update(decisions)
+        with self._lock:
+            self.rules_version = rules_version
+            self.items = items
+            self.layouts = layouts
+            self._decisions = decisions_by_fingerprint
+        log(LOG_DEBUG, 'Loaded precomputed decisions for {0} library items'.format(len(self.items)))
+
+
+class PrecomputationStopped(Exception):
+    """ Raised when the precomputation job has to stop in the middle of a run """
+    pass
+
+
+class LibraryMonitor(xbmc.Monitor):
+    """ Requests a new precomputation run when the video library or the settings change """
+
+    def __init__(self, precomputer):
+        xbmc.Monitor.__init__(self)
+        self.precomputer = precomputer
+
+    def onScanFinished(self, library):
+        if library == 'video':
+            self.precomputer.requestRun()
+
+    def onCleanFinished(self, library):
+        if library == 'video':
+            self.precomputer.requestRun()
+
+    def onNotification(self, sender, method, data):
+        # Library items edited (ex. genres/tags) or removed outside of a scan
+        if method in ('VideoLibrary.OnUpdate', 'VideoLibrary.OnRemove'):
+            self.precomputer.requestRun()
+
+    def onSettingsChanged(self):
+        self.precomputer.requestRun()
+
+
+class LibraryPrecomputer(threading.Thread):
+    """
+    A thread evaluating the preferences in the background for all movies and episodes of the video library,
+    so that playback only needs a lookup. Runs are incremental and pause while a video is playing.
+    """
+
+    def __init__(self, player, settings, precomputed, file_name):
+        super().__init__()
+        self.player = player
+        self.settings = settings
+        self.precomputed = precomputed
+        self.file_name = file_name
+        self.monitor = LibraryMonitor(self)
+
+        # Set when a new run is needed, the first run is done at startup
+        self._run_event = threading.Event()
+        self._run_event.set()
+        self._stop_event = threading.Event()
+
+        # Ensures the thread exits when the program ends
+        self.daemon = True
+
+    def requestRun(self):
+        self._run_event.set()
+
+    def stop(self):
+        """ Method to stop the thread gracefully """
+        self._stop_event.set()
+        self._run_event.set()
+        self.join()
+
+    def _stopped(self):
+        return self._stop_event.is_set() or self.monitor.abortRequested()
+
+    def run(self):
+        while not self._stopped():
+            if not self._run_event.wait(PLAYBACK_POLL_INTERVAL):
+                continue
+            if not self._wait(RUN_DELAY):
+                break
+            self._run_event.clear()
+            try:
+                self.runOnce()
+            except PrecomputationStopped:
+                # Keep the progress of the interrupted run, the next one goes on from there
+                self.precomputed.save(self.file_name)
+                break
+            except Exception as e:
+                log(LOG_ERROR, 'Library precomputation failed: ' + str(e))
+
+    def _wait(self, seconds):
+        """
+        :return: False if the job has to stop
+        """
+        for _ in range(seconds):
+            if self.monitor.waitForAbort(1) or self._stopped():
+                return False
+        return True
+
+    def _waitWhilePlaying(self):
+        """
+        Yield to playback: wait until no video is playing.
+        :return: False if the job has to stop
+        """
+        while self.player.isPlayingVideo():
+            if not self._wait(PLAYBACK_POLL_INTERVAL):
+                return False
+        return not self._stopped()
+
+    def runOnce(self):
+        """
+        Process the library items added or changed since the last run, then forget the removed ones.
+        """
+        rules = self.settings.compiled_rules
+        rules_version = self.settings.rules_version
+        use_genres = (self.settings.custom_audio_prefs_on or self.settings.custom_sub_prefs_on or
+                      self.settings.custom_condsub_prefs_on)
+        self.precomputed.invalidate(rules_version)
+        log(LOG_INFO, 'Library precomputation started')
+
+        seen_files = set()
+        processed = 0
+        show_genres = self.getShowGenresAndTags() if use_genres else {}
+        for method, result_key, properties in (
+                ('VideoLibrary.GetMovies', 'movies', ['file', 'streamdetails', 'genre', 'tag']),
+                ('VideoLibrary.GetEpisodes', 'episodes', ['file', 'streamdetails', 'tvshowid'])):
+            for item in self.libraryItems(method, result_key, properties):
+                if self.settings.rules_version != rules_version:
+                    log(LOG_DEBUG, 'Preference rules changed, restarting library precomputation')
+                    self.requestRun()
+                    return
+                file_name = item.get('file')
+                streamdetails = item.get('streamdetails')
+                if not file_name or not streamdetails:
+                    continue
+                seen_files.add(file_name)
+
+                if result_key == 'movies':
+                    genres_and_tags = set(map(lambda x: x.lower(), item.get('genre', []) + item.get('tag', [])))
+                    # Player.GetItem reports the same genres/tags for a library movie, playback can skip that query
+                    stored_genres = genres_and_tags
+                else:
+                    genres_and_tags = show_genres.get(item.get('tvshowid'), set())
+                    stored_genres = None
+                if not use_genres:
+                    genres_and_tags = set()
+
+                audiostreams, subtitles = libraryStreams(streamdetails)
+                layout_file_name = file_name if rules.use_filename else ''
+                layout_key = libraryLayoutKey(audiostreams, subtitles, genres_and_tags, layout_file_name)
+                if self.precomputed.isCurrent(file_name, layout_key):
+                    continue
+                if self.precomputed.hasLayout(layout_key):
+                    self.precomputed.putItem(file_name, layout_key, stored_genres)
+                else:
+                    self.precomputed.putItem(file_name, layout_key, stored_genres,
+                                             precomputeDecisions(audiostreams, subtitles, genres_and_tags,
+                                                                 layout_file_name, rules))
+                processed += 1
+
+        self.precomputed.prune(seen_files)
+        self.precomputed.save(self.file_name)
+        log(LOG_INFO, 'Library precomputation done: {0} new or changed items, {1} layouts for {2} items'.format(
+            processed, len(self.precomputed.layouts), len(self.precomputed)))
+
+    def libraryItems(self, method, result_key, properties):
+        """
+        Page through a VideoLibrary listing, yielding to playback before each item.
+        Raises PrecomputationStopped if the job has to stop.
+        """
+        start = 0
+        while True:
+            if not self._waitWhilePlaying():
+                raise PrecomputationStopped()
+            query = {"jsonrpc": "2.0",
+                     "method": method,
+                     "params": {"properties": properties,
+                                "limits": {"start": start, "end": start + LIBRARY_PAGE_SIZE}},
+                     "id": 1}
+            json_response = queryJSONRPC(query)
+            if 'result' not in json_response or json_response['result'] is None:
+                log(LOG_ERROR, 'Library precomputation: {0} failed: {1}'.format(method, json_response.get('error')))
+                return
+            items = json_response['result'].get(result_key, [])
+            for item in items:
+                # Processing a whole page can take a while on slow devices, do not hold playback back until its end
+                if not self._waitWhilePlaying():
+                    raise PrecomputationStopped()
+                yield item
+            total = json_response['result'].get('limits', {}).get('total', 0)
+            start += LIBRARY_PAGE_SIZE
+            if not items or start >= total:
+                return
+
+    def getShowGenresAndTags(self):
+        """
+        :return: The genres/tags of each TV show, by tvshowid
+        """
+        return {show['tvshowid']: set(map(lambda x: x.lower(), show.get('genre', []) + show.get('tag', [])))
+                for show in self.libraryItems('VideoLibrary.GetTVShows', 'tvshows', ['genre', 'tag'])}
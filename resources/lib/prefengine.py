@@ -0,0 +1,702 @@
+import re
+
+from langcodes import *
+from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+
+# Keywords identifying 'Signs and Songs' and forced subtitle tracks by name
+SIGNS_KEYWORDS = ['signs']
+FORCED_KEYWORDS = ['forced', 'forcés']
+
+# Maximum number of distinct track names kept classified
+KEYWORD_CACHE_SIZE = 1024
+
+
+class KeywordMatcher:
+    """
+    Classifies a track name against all keyword lists (audio blacklist, subtitle blacklist, signs and forced)
+    in a single scan of one combined regex. Compiled once per settings change, results are cached per name.
+    """
+    BLACKLISTED_AUDIO = 1
+    BLACKLISTED_SUB = 2
+    SIGNS = 4
+    FORCED = 8
+
+    def __init__(self, audio_keyword_blacklist, subtitle_keyword_blacklist):
+        masks = {}
+        for keywords, flag in ((audio_keyword_blacklist, self.BLACKLISTED_AUDIO),
+                               (subtitle_keyword_blacklist, self.BLACKLISTED_SUB),
+                               (SIGNS_KEYWORDS, self.SIGNS),
+                               (FORCED_KEYWORDS, self.FORCED)):
+            for keyword in keywords:
+                masks[keyword] = masks.get(keyword, 0) | flag
+
+        # An empty keyword is found in any name
+        self._always = masks.pop('', 0)
+        # A keyword found in a name implies all the keywords it contains are found too,
+        # so overlapping keywords are still reported with one match per position
+        self._masks = {}
+        for keyword in masks:
+            self._masks[keyword] = 0
+            for other, mask in masks.items():
+                if other in keyword:
+                    self._masks[keyword] |= mask
+        if self._masks:
+            # Longest keywords first, matched at every position through a lookahead
+            alternatives = sorted(self._masks, key=len, reverse=True)
+            self._regex = re.compile('(?=({0}))'.format('|'.join(map(re.escape, alternatives))))
+        else:
+            self._regex = None
+        self._cache = {}
+
+    def classify(self, name):
+        """
+        :param name: The track name
+        :return: A mask of BLACKLISTED_AUDIO, BLACKLISTED_SUB, SIGNS and FORCED flags
+        """
+        flags = self._cache.get(name)
+        if flags is None:
+            flags = self._always
+            if self._regex is not None:
+                for match in self._regex.finditer(name.lower()):
+                    flags |= self._masks[match.group(1)]
+            if len(self._cache) >= KEYWORD_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[name] = flags
+        return flags
+
+
+class TrackFeatures:
+    """
+    Features of one audio or subtitle track, computed once per snapshot of the player streams.
+    """
+    __slots__ = ('index', 'position', 'language', 'language_id', 'blacklisted', 'signs', 'forced', 'original')
+
+    def __init__(self, stream, position, keyword_matcher, is_subtitle):
+        flags = keyword_matcher.classify(stream.get('name', ''))
+        self.index = stream.get('index', -1)
+        self.position = position
+        self.language = stream['language']
+        self.language_id = stream.get('language_id', languageId(self.language))
+        if is_subtitle:
+            self.blacklisted = bool(flags & KeywordMatcher.BLACKLISTED_SUB)
+            self.signs = bool(flags & KeywordMatcher.SIGNS)
+            # In case the sub name is plain empty or not well documented,
+            #   check also the sub isforced tag and consider it a forced track if set
+            self.forced = bool(flags & KeywordMatcher.FORCED) or bool(stream.get('isforced'))
+        else:
+            self.blacklisted = bool(flags & KeywordMatcher.BLACKLISTED_AUDIO)
+            self.signs = False
+            self.forced = False
+        self.original = bool(stream.get('isoriginal'))
+
+    def isEligible(self, ignore_signs):
+        """ Subtitles to be ignored via Signs&Songs Toggle or matching Keywords Blacklist are not eligible """
+        return not self.blacklisted and not (ignore_signs and self.signs)
+
+
+class StreamFeatures:
+    """
+    Per-track features of the player streams, with tracks bucketed by language ID,
+    so that each preference rule is resolved with a lookup instead of a scan of all tracks.
+    """
+
+    def __init__(self, audiostreams, subtitles, selected_audio_stream, selected_sub, keyword_matcher):
+        self.audio = [TrackFeatures(stream, position, keyword_matcher, False)
+                      for position, stream in enumerate(audiostreams)]
+        self.subtitles = [TrackFeatures(sub, position, keyword_matcher, True)
+                          for position, sub in enumerate(subtitles)]
+
+        self.selected_audio = None
+        self.selected_audio_index = -1
+        if selected_audio_stream and 'language' in selected_audio_stream:
+            self.selected_audio = TrackFeatures(selected_audio_stream, -1, keyword_matcher, False)
+            self.selected_audio_index = self.selected_audio.index
+
+        self.selected_sub = None
+        self.selected_sub_index = -1
+        if selected_sub and 'index' in selected_sub:
+            self.selected_sub_index = selected_sub['index']
+        if selected_sub and 'language' in selected_sub:
+            self.selected_sub = TrackFeatures(selected_sub, -1, keyword_matcher, True)
+
+        # Blacklisted audio tracks are never candidates, subtitles eligibility depends on the rule
+        self.audio_by_lang = {}
+        for track in self.audio:
+            if not track.blacklisted:
+                self.audio_by_lang.setdefault(track.language_id, []).append(track)
+        self.subs_by_lang = {}
+        for track in self.subtitles:
+            self.subs_by_lang.setdefault(track.language_id, []).append(track)
+
+    @staticmethod
+    def _tracksFor(by_lang, lang_ids):
+        buckets = [by_lang[lang_id] for lang_id in lang_ids if lang_id in by_lang]
+        if len(buckets) == 1:
+            return buckets[0]
+        # Several languages for one rule (ex. Farsi/Persian): keep the tracks order
+        return sorted((track for bucket in buckets for track in bucket), key=lambda track: track.position)
+
+    def audioFor(self, lang_ids):
+        """ Non blacklisted audio tracks of one of the languages, in tracks order """
+        return self._tracksFor(self.audio_by_lang, lang_ids)
+
+    def subtitlesFor(self, lang_ids):
+        """ Subtitle tracks of one of the languages, in tracks order """
+        return self._tracksFor(self.subs_by_lang, lang_ids)
+
+
+# Kinds and special rules of the evaluation trace, see decide()
+TRACE_AUDIO = 'audio'
+TRACE_SUBTITLE = 'subtitle'
+TRACE_CONDSUB = 'condsub'
+TRACE_ORIGINAL = 'original'
+TRACE_FILENAME = 'filename'
+
+
+def evalOriginalAudio(features, audio_original_preflist):
+    """
+    Get the audio track index that matches the original_preferred_list. If no audio track matches, return None.
+    The audio track is searched by language, checking for the isoriginal tag. If multiple original found (weird...) the first one is returned.
+
+    :return: The first audio track index tagged as isoriginal and that matches the original_preferred_list.
+            -1 if the current selected audio track is already correct (to avoid unnecessary audio change)
+             None if no original audio track found or no match.
+    """
+    found = next((track for track in features.audio
+                  if track.original and track.language in audio_original_preflist), None)
+
+    if found is not None:
+        if found.index != features.selected_audio_index:
+            log(LOG_INFO,
+                "Audio: Found at least one preferred original audio track among " + ",".join(audio_original_preflist) +
+                " . Picking first: " + found.language)
+            return found.index
+        else:
+            # Found audio track is already the selected one - No need to change
+            log(LOG_INFO,
+                "Audio: Selected audio track matches preferred original list " + ",".join(audio_original_preflist) +
+                " . Keeping it   : " + found.language)
+            return -1
+    log(LOG_INFO,
+        "Audio: No preferred original audio track found among " + ",".join(audio_original_preflist) +
+        " . Continue preferences evaluation...")
+    return None
+
+
+def evalAudio(features, audio_prefs, genres_and_tags, audio_original_preflist=None, trace=None):
+    """
+    Resolve the audio preferences against the stream features.
+    :param trace: Optional list, the matching rule is appended to it as (kind, (group position, rule position))
+    :return: The audio track index to select, -1 if the selected track already matches, -2 if no preference matched
+    """
+    if audio_original_preflist:
+        index = evalOriginalAudio(features, audio_original_preflist)
+        # Audio Original tracks are preferred. If one is found we choose it and skip remaining preference evaluation.
+        if index is not None:
+            if trace is not None:
+                trace.append((TRACE_AUDIO, TRACE_ORIGINAL))
+            return index
+
+    selected = features.selected_audio
+    for position, group in audio_prefs.matchingGroups(genres_and_tags):
+        i = position + 1
+        if group.genres_and_tags:
+            log(LOG_INFO, 'Audio: genre/tag preference {0} met with intersection {1}'.format(
+                group.genres_and_tags, (genres_and_tags & group.genres_and_tags)))
+        for rule_position, rule in enumerate(group.rules):
+            if selected is not None and not selected.blacklisted and selected.language_id in rule.lang_ids:
+                log(LOG_INFO, 'Selected audio language matches preference {0} ({1})'.format(i, rule.name))
+                if trace is not None:
+                    trace.append((TRACE_AUDIO, (position, rule_position)))
+                return -1
+            tracks = features.audioFor(rule.lang_ids)
+            if tracks:
+                log(LOG_INFO, 'Language of Audio track {0} matches preference {1} ({2})'.format(
+                    (tracks[0].index + 1), i, rule.name))
+                if trace is not None:
+                    trace.append((TRACE_AUDIO, (position, rule_position)))
+                return tracks[0].index
+            log(LOG_INFO, 'Audio: preference {0} ({1}:{2}) not available'.format(i, rule.name, ','.join(rule.codes)))
+            i += 1
+    return -2
+
+
+def evalSub(features, sub_prefs, genres_and_tags, ignore_signs, trace=None):
+    """
+    Resolve the subtitle preferences against the stream features.
+    :param trace: Optional list, the matching rule is appended to it as (kind, (group position, rule position))
+    :return: The subtitle track index to select, -1 if the selected track already matches, -2 if no preference matched
+    """
+    selected = features.selected_sub
+    current_subtitle_index = features.selected_sub_index
+    for position, group in sub_prefs.matchingGroups(genres_and_tags):
+        i = position + 1
+        if group.genres_and_tags:
+            log(LOG_INFO, 'SubPrefs : genre/tag preference {0} met with intersection {1}'.format(
+                group.genres_and_tags, (genres_and_tags & group.genres_and_tags)))
+        for rule_position, rule in enumerate(group.rules):
+            if (selected is not None and selected.isEligible(ignore_signs) and
+                    selected.language_id in rule.lang_ids and selected.forced == rule.forced):
+                log(LOG_INFO, 'SubPrefs : Selected subtitle language matches preference {0} ({1})'.format(i, rule.name))
+                if trace is not None:
+                    trace.append((TRACE_SUBTITLE, (position, rule_position)))
+                return -1
+
+            to_chose_subtitle_indexes = [track.index for track in features.subtitlesFor(rule.lang_ids)
+                                         if track.isEligible(ignore_signs) and track.forced == rule.forced]
+
+            # If our current subtitle is eligible for the condition, we will not change it
+            if current_subtitle_index in to_chose_subtitle_indexes:
+                log(LOG_INFO, 'SubPrefs : already selected subtitle {0} matches preference {1} ({2})'.format(
+                    (current_subtitle_index + 1), i, rule.name))
+                if trace is not None:
+                    trace.append((TRACE_SUBTITLE, (position, rule_position)))
+                return current_subtitle_index
+
+            if to_chose_subtitle_indexes:
+                # if we have more than one subtitles, we will take the first one
+                log(LOG_INFO, 'SubPrefs : Found {0} matching subtitles, using first at index {1}'.format(
+                    len(to_chose_subtitle_indexes), to_chose_subtitle_indexes[0]))
+                if trace is not None:
+                    trace.append((TRACE_SUBTITLE, (position, rule_position)))
+                return to_chose_subtitle_indexes[0]
+
+            log(LOG_INFO, 'SubPrefs : preference {0} ({1}:{2}) not available'.format(i, rule.name, ','.join(rule.codes)))
+            i += 1
+    return -2
+
+
+def evalCondSub(features, condsub_prefs, genres_and_tags, ignore_signs, trace=None):
+    """
+    Resolve the conditional subtitle preferences against the stream features.
+    :param trace: Optional list, the matching rule is appended to it as (kind, (group position, rule position))
+    :return: The subtitle track index to select, -1 to disable subtitles, -2 if no preference matched
+    """
+    selected_audio = features.selected_audio
+    if selected_audio is None:
+        return -2
+    current_subtitle_index = features.selected_sub_index
+    for position, group in condsub_prefs.matchingGroups(genres_and_tags):
+        i = position + 1
+        if group.genres_and_tags:
+            log(LOG_INFO, 'CondSubs : genre/tag preference {0} met with intersection {1}'.format(
+                group.genres_and_tags, (genres_and_tags & group.genres_and_tags)))
+        for rule_position, rule in enumerate(group.rules):
+            if selected_audio.language_id not in rule.audio_ids and LANGUAGE_ID_ANY not in rule.audio_ids:
+                i += 1
+                continue
+            log(LOG_INFO,
+                'CondSubs : Selected audio language matches conditional preference {0} ({1}:{2}), force tag is {3}'.format(
+                    i, rule.audio_name, rule.sub_name, rule.forced))
+
+            if LANGUAGE_ID_NONE in rule.sub_ids:
+                if rule.forced:
+                    log(LOG_INFO,
+                        'CondSubs : Subtitle condition is None but forced is true, searching a forced subtitle matching selected audio...')
+                    for track in features.subtitlesFor(rule.audio_ids):
+                        if track.isEligible(ignore_signs) and track.forced:
+                            log(LOG_INFO,
+                                'CondSubs : Language of subtitle {0} matches audio preference {1} ({2}:{3}) with forced overriding rule {4}'.format(
+                                    (track.index + 1), i, rule.audio_name, rule.sub_name, rule.forced))
+                            if trace is not None:
+                                trace.append((TRACE_CONDSUB, (position, rule_position)))
+                            return track.index
+                    log(LOG_INFO,
+                        'CondSubs : no match found for preference {0} ({1}:{2}) with forced overriding rule {3}'.format(
+                            i, rule.audio_name, rule.sub_name, rule.forced))
+                if trace is not None:
+                    trace.append((TRACE_CONDSUB, (position, rule_position)))
+                return -1
+
+            # take into account -ss tag to prioritize specific Signs&Songs subtitles track,
+            # otherwise filter out subtitles to be ignored via Signs&Songs Toggle or matching Keywords Blacklist
+            to_chose_subtitle_indexes = [track.index for track in features.subtitlesFor(rule.sub_ids)
+                                         if (rule.ss_tag and track.signs) or
+                                         (not rule.ss_tag and track.isEligible(ignore_signs) and track.forced == rule.forced)]
+
+            # If our current subtitle is eligible for the condition, we will not change it
+            if current_subtitle_index in to_chose_subtitle_indexes:
+                log(LOG_INFO,
+                    'CondSubs : already selected subtitle matches preference {0} ({1}:{2}) with forced {3} & ss-tag {4}'.format(
+                        i, rule.audio_name, rule.sub_name, rule.forced, rule.ss_tag))
+                if trace is not None:
+                    trace.append((TRACE_CONDSUB, (position, rule_position)))
+                return current_subtitle_index
+
+            if to_chose_subtitle_indexes:
+                # if we have more than one subtitles, we will take the first one
+                log(LOG_INFO, 'CondSubs : Found {0} matching subtitles, using first at index {1}'.format(
+                    len(to_chose_subtitle_indexes), to_chose_subtitle_indexes[0]))
+                if trace is not None:
+                    trace.append((TRACE_CONDSUB, (position, rule_position)))
+                return to_chose_subtitle_indexes[0]
+
+            log(LOG_INFO,
+                'CondSubs : no match found for preference {0} ({1}:{2}) with forced {3} & ss-tag {4}'.format(
+                    i, rule.audio_name, rule.sub_name, rule.forced, rule.ss_tag))
+            i += 1
+    return -2
+
+
+class StreamSnapshot:
+    """
+    Immutable view of the player streams, the current selection and the video's genres/tags,
+    as loaded by one getDetails call. All that preference evaluation needs to know about the playing item.
+    """
+    __slots__ = ('audiostreams', 'subtitles', 'selected_audio_stream', 'selected_sub', 'subtitle_enabled',
+                 'genres_and_tags', 'file_name', 'initial', '_features')
+
+    def __init__(self, audiostreams, subtitles, selected_audio_stream, selected_sub, subtitle_enabled,
+                 genres_and_tags=(), file_name='', initial=True):
+        """
+        :param initial: True for the first evaluation of a playback, False for re-evaluations (ex. audio change)
+        """
+        subtitles = [dict(sub) for sub in subtitles]
+        for sub in subtitles:
+            # Consider empty subtitle language code as und/Undefined so it can still be prioritized in rules, not just ignored
+            if sub.get('language') == "":
+                sub['language'] = "und"
+        object.__setattr__(self, 'audiostreams', tuple(dict(stream) for stream in audiostreams))
+        object.__setattr__(self, 'subtitles', tuple(subtitles))
+        object.__setattr__(self, 'selected_audio_stream', dict(selected_audio_stream or {}))
+        object.__setattr__(self, 'selected_sub', dict(selected_sub or {}))
+        object.__setattr__(self, 'subtitle_enabled', bool(subtitle_enabled))
+        object.__setattr__(self, 'genres_and_tags', frozenset(genres_and_tags))
+        object.__setattr__(self, 'file_name', file_name)
+        object.__setattr__(self, 'initial', initial)
+        object.__setattr__(self, '_features', None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Stream snapshots are immutable')
+
+    def features(self, keyword_matcher):
+        """ The StreamFeatures of this snapshot, computed once per keyword matcher """
+        if self._features is None or self._features[0] is not keyword_matcher:
+            features = StreamFeatures(self.audiostreams, self.subtitles, self.selected_audio_stream,
+                                      self.selected_sub, keyword_matcher)
+            object.__setattr__(self, '_features', (keyword_matcher, features))
+        return self._features[1]
+
+    def withSelection(self, audio_index=None, sub_index=None, subtitle_enabled=None):
+        """
+        Get the snapshot the player would report once the given audio/subtitle tracks are selected.
+        None keeps the current selection.
+        """
+        selected_audio_stream = self.selected_audio_stream
+        if audio_index is not None:
+            selected_audio_stream = next((s for s in self.audiostreams if s.get('index') == audio_index),
+                                         selected_audio_stream)
+        selected_sub = self.selected_sub
+        if sub_index is not None:
+            selected_sub = next((s for s in self.subtitles if s.get('index') == sub_index), selected_sub)
+        if subtitle_enabled is None:
+            subtitle_enabled = self.subtitle_enabled
+        return self._replace(selected_audio_stream=selected_audio_stream, selected_sub=selected_sub,
+                             subtitle_enabled=subtitle_enabled)
+
+    def withProperties(self, properties, initial=None):
+        """
+        Get the snapshot updated with the selection properties of a partial Player.GetProperties result
+        (currentaudiostream, currentsubtitle, subtitleenabled). The stream lists are shared, not copied again.
+        :param initial: The new initial flag, None keeps the current one
+        """
+        changes = {}
+        if 'currentaudiostream' in properties:
+            changes['selected_audio_stream'] = dict(properties['currentaudiostream'] or {})
+        if 'currentsubtitle' in properties:
+            changes['selected_sub'] = dict(properties['currentsubtitle'] or {})
+        if 'subtitleenabled' in properties:
+            changes['subtitle_enabled'] = bool(properties['subtitleenabled'])
+        if initial is not None:
+            changes['initial'] = initial
+        return self._replace(**changes)
+
+    def hasSelection(self, properties):
+        """
+        Whether the tracks selected in a partial Player.GetProperties result are part of the streams of this snapshot.
+        """
+        audio = properties.get('currentaudiostream')
+        if audio and not any(stream.get('index') == audio.get('index') and stream.get('language') == audio.get('language')
+                             and stream.get('name') == audio.get('name') for stream in self.audiostreams):
+            return False
+        sub = properties.get('currentsubtitle')
+        # Subtitle languages are normalized, only compare index and name
+        if sub and not any(stream.get('index') == sub.get('index') and stream.get('name') == sub.get('name')
+                           for stream in self.subtitles):
+            return False
+        return True
+
+    def _replace(self, **changes):
+        snapshot = object.__new__(StreamSnapshot)
+        for name in StreamSnapshot.__slots__:
+            object.__setattr__(snapshot, name, changes[name] if name in changes else getattr(self, name))
+        # Features depend on the selection
+        object.__setattr__(snapshot, '_features', None)
+        return snapshot
+
+
+class CompiledRules:
+    """
+    Everything preference evaluation needs from the settings: the compiled preference plans in use and the options.
+    """
+    __slots__ = ('audio_prefs_on', 'sub_prefs_on', 'condsub_prefs_on', 'audio_prefs', 'sub_prefs', 'condsub_prefs',
+                 'turn_subs_on', 'turn_subs_off', 'ignore_signs', 'keyword_matcher', 'audio_original_preflist',
+                 'use_filename', 'filename_regex', 'filename_split')
+
+    def __init__(self, audio_prefs, sub_prefs, condsub_prefs, keyword_matcher,
+                 audio_prefs_on=False, sub_prefs_on=False, condsub_prefs_on=False,
+                 turn_subs_on=False, turn_subs_off=False, ignore_signs=False, audio_original_preflist=None,
+                 use_filename=False, filename_regex=None, filename_split=None):
+        self.audio_prefs = audio_prefs
+        self.sub_prefs = sub_prefs
+        self.condsub_prefs = condsub_prefs
+        self.keyword_matcher = keyword_matcher
+        self.audio_prefs_on = audio_prefs_on
+        self.sub_prefs_on = sub_prefs_on
+        self.condsub_prefs_on = condsub_prefs_on
+        self.turn_subs_on = turn_subs_on
+        self.turn_subs_off = turn_subs_off
+        self.ignore_signs = ignore_signs
+        self.audio_original_preflist = audio_original_preflist or []
+        self.use_filename = use_filename
+        self.filename_regex = filename_regex
+        self.filename_split = filename_split
+
+
+# Decision actions, applied in order by the player
+ACTION_AUDIO = 'audio'
+ACTION_SUBTITLE = 'subtitle'
+ACTION_SHOW_SUBTITLES = 'show'
+
+
+class Decision:
+    """
+    The result of preference evaluation: the ordered track changes to apply to the player.
+    """
+    __slots__ = ('actions', 'audio_changed')
+
+    def __init__(self, actions, audio_changed=False):
+        object.__setattr__(self, 'actions', tuple((action, value) for action, value in actions))
+        object.__setattr__(self, 'audio_changed', audio_changed)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Decisions are immutable')
+
+    def __repr__(self):
+        return 'Decision(actions={0}, audio_changed={1})'.format(self.actions, self.audio_changed)
+
+    def __eq__(self, other):
+        return isinstance(other, Decision) and self.actions == other.actions and self.audio_changed == other.audio_changed
+
+    def __hash__(self):
+        return hash((self.actions, self.audio_changed))
+
+    def targetSelection(self, audio_index, sub_index, subtitle_enabled):
+        """
+        The selection the track changes lead to, from the given one. As with Kodi's setSubtitleStream,
+        selecting a subtitle track also shows the subtitles.
+        :return: The target audio index, subtitle index and subtitles enabled flag
+        """
+        for action, value in self.actions:
+            if action == ACTION_AUDIO:
+                audio_index = value
+            elif action == ACTION_SUBTITLE:
+                sub_index = value
+                subtitle_enabled = True
+            elif action == ACTION_SHOW_SUBTITLES:
+                subtitle_enabled = value
+        return audio_index, sub_index, subtitle_enabled
+
+    def to_json(self):
+        return {"actions": [list(action) for action in self.actions], "audio_changed": self.audio_changed}
+
+    @staticmethod
+    def from_json(json):
+        return Decision(json["actions"], json["audio_changed"])
+
+
+def evalFilename(file_name, filename_regex, filename_split):
+    log(LOG_DEBUG, 'Evaluating filename preferences')
+    audio = -1
+    sub = -1
+    matches = filename_regex.findall(file_name)
+    fileprefs = []
+    for m in matches:
+        sp = filename_split.split(m)
+        fileprefs.append(sp)
+
+    for pref in fileprefs:
+        if len(pref) == 2:
+            if (pref[0].lower() == 'audiostream'):
+                audio = int(pref[1])
+                log(LOG_INFO, 'audio track extracted from filename: {0}'.format(audio))
+            elif (pref[0].lower() == 'subtitle'):
+                sub = int(pref[1])
+                log(LOG_INFO, 'subtitle track extracted from filename: {0}'.format(sub))
+    log(LOG_DEBUG, 'filename: audio: {0}, sub: {1} ({2})'.format(audio, sub, file_name))
+    return audio, sub
+
+
+class PythonKernel:
+    """
+    Evaluates one kind of preferences for many items, one item after the other.
+    The reference implementation of the bulk kernels (see prefkernel), used by default.
+    """
+
+    def evalAudioMany(self, features_list, audio_prefs, genres_list, audio_original_preflist, traces):
+        return [evalAudio(features, audio_prefs, genres_and_tags, audio_original_preflist, trace)
+                for features, genres_and_tags, trace in zip(features_list, genres_list, traces)]
+
+    def evalSubMany(self, features_list, sub_prefs, genres_list, ignore_signs, traces):
+        return [evalSub(features, sub_prefs, genres_and_tags, ignore_signs, trace)
+                for features, genres_and_tags, trace in zip(features_list, genres_list, traces)]
+
+    def evalCondSubMany(self, features_list, condsub_prefs, genres_list, ignore_signs, traces):
+        return [evalCondSub(features, condsub_prefs, genres_and_tags, ignore_signs, trace)
+                for features, genres_and_tags, trace in zip(features_list, genres_list, traces)]
+
+
+PYTHON_KERNEL = PythonKernel()
+
+
+def decide(snapshot, rules, trace=None):
+    """
+    Evaluate all preferences against a snapshot of the player streams. Pure: neither reads nor changes the player.
+    :param snapshot: The StreamSnapshot of the playing item
+    :param rules: The CompiledRules in use
+    :param trace: Optional list, for each kind of preference evaluated (kind, rule) is appended to it.
+                  rule is (group position, rule position) in the plan, TRACE_ORIGINAL, TRACE_FILENAME,
+                  or None if none of the preferred languages is available
+    :return: The Decision to apply
+    """
+    return decideMany([snapshot], rules, [trace])[0]
+
+
+def decideMany(snapshots, rules, traces=None, kernel=PYTHON_KERNEL):
+    """
+    Evaluate all preferences against many snapshots, one kind of preferences at a time for all of them.
+    :param snapshots: The StreamSnapshots to evaluate
+    :param rules: The CompiledRules in use
+    :param traces: Optional list of trace lists (or None), one per snapshot, see decide()
+    :param kernel: Evaluates one kind of preferences for many items, PYTHON_KERNEL or a bulk kernel from prefkernel
+    :return: The list of Decisions, one per snapshot
+    """
+    count = len(snapshots)
+    if traces is None:
+        traces = [None] * count
+    actions = [[] for _ in range(count)]
+    audio_changed = [False] * count
+    target_audio_index = [None] * count
+    target_sub_index = [None] * count
+
+    # recognized filename audio or filename subtitle
+    use_filename_audio = [False] * count
+    use_filename_subs = [False] * count
+
+    if rules.use_filename:
+        for k, snapshot in enumerate(snapshots):
+            if not snapshot.initial:
+                continue
+            trace = traces[k]
+            audio, sub = evalFilename(snapshot.file_name, rules.filename_regex, rules.filename_split)
+            if (audio >= 0) and audio < len(snapshot.audiostreams):
+                log(LOG_INFO, 'Filename preference: Match, selecting audio track {0}'.format(audio))
+                if trace is not None:
+                    trace.append((TRACE_AUDIO, TRACE_FILENAME))
+                actions[k].append((ACTION_AUDIO, audio))
+                target_audio_index[k] = audio
+                audio_changed[k] = True
+                use_filename_audio[k] = True
+            else:
+                log(LOG_INFO, 'Filename preference: No match found for audio track ({0})'.format(snapshot.file_name))
+
+            if (sub >= 0) and sub < len(snapshot.subtitles):
+                if trace is not None:
+                    trace.append((TRACE_SUBTITLE, TRACE_FILENAME))
+                actions[k].append((ACTION_SUBTITLE, sub))
+                target_sub_index[k] = sub
+                use_filename_subs[k] = True
+                log(LOG_INFO, 'Filename preference: Match, selecting subtitle track {0}'.format(sub))
+                if rules.turn_subs_on:
+                    log(LOG_DEBUG, 'Subtitle: enabling subs')
+                    actions[k].append((ACTION_SHOW_SUBTITLES, True))
+            else:
+                log(LOG_INFO,
+                    'Filename preference: No match found for subtitle track ({0})'.format(snapshot.file_name))
+                if rules.turn_subs_off:
+                    log(LOG_INFO, 'Subtitle: disabling subs')
+                    actions[k].append((ACTION_SHOW_SUBTITLES, False))
+
+    if rules.audio_prefs_on:
+        log(LOG_DEBUG, 'Evaluating audio preferences')
+        todo = [k for k in range(count) if not use_filename_audio[k] and snapshots[k].initial]
+        results = kernel.evalAudioMany([snapshots[k].features(rules.keyword_matcher) for k in todo], rules.audio_prefs,
+                                       [snapshots[k].genres_and_tags for k in todo], rules.audio_original_preflist,
+                                       [traces[k] for k in todo])
+        for k, trackIndex in zip(todo, results):
+            if trackIndex == -2:
+                log(LOG_INFO, 'Audio: None of the preferred languages is available')
+                if traces[k] is not None:
+                    traces[k].append((TRACE_AUDIO, None))
+            elif trackIndex >= 0:
+                actions[k].append((ACTION_AUDIO, trackIndex))
+                target_audio_index[k] = trackIndex
+                audio_changed[k] = True
+
+    if rules.sub_prefs_on:
+        log(LOG_DEBUG, 'Evaluating subtitle preferences')
+        todo = [k for k in range(count) if not use_filename_subs[k] and snapshots[k].initial]
+        results = kernel.evalSubMany([snapshots[k].features(rules.keyword_matcher) for k in todo], rules.sub_prefs,
+                                     [snapshots[k].genres_and_tags for k in todo], rules.ignore_signs,
+                                     [traces[k] for k in todo])
+        for k, trackIndex in zip(todo, results):
+            if trackIndex == -2:
+                log(LOG_INFO, 'Subtitle: None of the preferred languages is available')
+                if traces[k] is not None:
+                    traces[k].append((TRACE_SUBTITLE, None))
+                if rules.turn_subs_off:
+                    log(LOG_INFO, 'Subtitle: disabling subs')
+                    actions[k].append((ACTION_SHOW_SUBTITLES, False))
+            if trackIndex == -1:
+                log(LOG_INFO, 'Subtitle: Preferred subtitle is selected but might not be enabled')
+                if rules.turn_subs_on and not snapshots[k].subtitle_enabled:
+                    log(LOG_INFO, 'Subtitle: enabling subs because selected sub is not enabled')
+                    actions[k].append((ACTION_SHOW_SUBTITLES, True))
+            elif trackIndex >= 0:
+                actions[k].append((ACTION_SUBTITLE, trackIndex))
+                target_sub_index[k] = trackIndex
+                if rules.turn_subs_on:
+                    log(LOG_INFO, 'Subtitle: enabling subs')
+                    actions[k].append((ACTION_SHOW_SUBTITLES, True))
+
+    if rules.condsub_prefs_on:
+        log(LOG_DEBUG, 'Evaluating conditional subtitle preferences')
+        todo = [k for k in range(count) if not use_filename_subs[k]]
+        # Conditional subtitles depend on the audio track selected above
+        condsub_snapshots = [snapshots[k].withSelection(target_audio_index[k], target_sub_index[k]) for k in todo]
+        results = kernel.evalCondSubMany([snapshot.features(rules.keyword_matcher) for snapshot in condsub_snapshots],
+                                         rules.condsub_prefs, [snapshots[k].genres_and_tags for k in todo],
+                                         rules.ignore_signs, [traces[k] for k in todo])
+        for k, trackIndex in zip(todo, results):
+            if trackIndex == -1:
+                log(LOG_INFO, 'Conditional subtitle: disabling subs')
+                actions[k].append((ACTION_SHOW_SUBTITLES, False))
+            if trackIndex == -2:
+                log(LOG_INFO,
+                    'Conditional subtitle: No matching preferences found for current audio stream.')
+                if traces[k] is not None:
+                    traces[k].append((TRACE_CONDSUB, None))
+                if rules.turn_subs_off:
+                    log(LOG_INFO,
+                        'Conditional subtitle: Disabling subs.')
+                    actions[k].append((ACTION_SHOW_SUBTITLES, False))
+                else:
+                    log(LOG_INFO,
+                        'Conditional subtitle: Doing nothing.')
+            elif trackIndex >= 0:
+                actions[k].append((ACTION_SUBTITLE, trackIndex))
+                if rules.turn_subs_on:
+                    log(LOG_DEBUG, 'Subtitle: enabling subs')
+                    actions[k].append((ACTION_SHOW_SUBTITLES, True))
+
+    return [Decision(actions[k], audio_changed[k]) for k in range(count)]
@@ -0,0 +1,92 @@
+
+from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+from precompute import libraryStreams, precomputeDecisions
+from rpcclient import queryJSONRPC
+from resources.lib import kodi_utils
+
+# Properties of the next playlist item needed to know its decisions in advance
+NEXT_ITEM_PROPERTIES = ["file", "streamdetails", "genre", "tag", "showtitle"]
+
+
+class PrefetchedItem:
+    """
+    What is known in advance about the next item of the playlist: its genres/tags, the custom media preference
+    that applies to it and the decisions for the stream layout the library reports for it.
+    Decisions only apply if the player reports the same layout, that is the same snapshot fingerprint.
+    """
+
+    def __init__(self, file_name, genres_and_tags, decisions, rules_version, custom_preference=None,
+                 preferences_version=None):
+        self.file_name = file_name
+        self.genres_and_tags = genres_and_tags
+        self.decisions = decisions
+        self.rules_version = rules_version
+        self.custom_preference = custom_preference
+        # None if the custom media preferences were not looked up
+        self.preferences_version = preferences_version
+
+    def get(self, fingerprint):
+        return self.decisions.get(fingerprint)
+
+    def hasCustomPreference(self, preference_manager):
+        """
+        :return: True if the custom media preference was looked up, and the preferences did not change since
+        """
+        return self.preferences_version is not None and self.preferences_version == preference_manager.version
+
+
+def nextPlaylistItem(player_id):
+    """
+    :return: The next item of the playlist being played, as listed by Playlist.GetItems, None if there is none
+    """
+    query = {"jsonrpc": "2.0",
+             "method": "Player.GetProperties",
+             "params": {"properties": ["playlistid", "position"], "playerid": player_id},
+             "id": 1}
+    json_response = queryJSONRPC(query)
+    if 'result' not in json_response or json_response['result'] is None:
+        return None
+    playlist_id = json_response['result'].get('playlistid', -1)
+    position = json_response['result'].get('position', -1)
+    if playlist_id < 0 or position < 0:
+        return None
+
+    query = {"jsonrpc": "2.0",
+             "method": "Playlist.GetItems",
+             "params": {"playlistid": playlist_id, "properties": NEXT_ITEM_PROPERTIES,
+                        "limits": {"start": position + 1, "end": position + 2}},
+             "id": 1}
+    json_response = queryJSONRPC(query)
+    if 'result' not in json_response or json_response['result'] is None:
+        return None
+    items = json_response['result'].get('items', [])
+    return items[0] if items else None
+
+
+def prefetchItem(item, settings, preference_manager):
+    """
+    Get the genres/tags, custom media preference and decisions of a playlist item before it is played.
+    :param item: The item as listed by Playlist.GetItems
+    :return: The PrefetchedItem, None if the library does not know the streams of the item
+    """
+    file_name = item.get('file')
+    streamdetails = item.get('streamdetails')
+    if not file_name or not streamdetails:
+        return None
+
+    genres_and_tags = set()
+    if settings.custom_audio_prefs_on or settings.custom_sub_prefs_on or settings.custom_condsub_prefs_on:
+        # Player.GetItem reports the same genres/tags once the item plays
+        genres_and_tags = set(map(lambda x: x.lower(), item.get('genre', []) + item.get('tag', [])))
+    audiostreams, subtitles = libraryStreams(streamdetails)
+    decisions = precomputeDecisions(audiostreams, subtitles, genres_and_tags,
+                                    file_name if settings.useFilename else '', settings.compiled_rules)
+    prefetched = PrefetchedItem(file_name, genres_and_tags, decisions, settings.rules_version)
+
+    media_type = item.get('type')
+    if settings.is_store_user_preference(media_type):
+        prefetched.custom_preference = preference_manager.get_preference_for_item(
+            kodi_utils.is_tv_show(media_type), item.get('showtitle', ''), file_name)
+        prefetched.preferences_version = preference_manager.version
+    log(LOG_DEBUG, 'Prefetched next playlist item {0}: {1} decisions'.format(file_name, len(decisions)))
+    return prefetched
@@ -0,0 +1,303 @@
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional (script.module.numpy): bulk evaluations fall back to the pure Python kernel
+    numpy = None
+
+import itertools
+import operator
+
+from langcodes import *
+from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+from prefengine import PYTHON_KERNEL, TRACE_AUDIO, TRACE_SUBTITLE, TRACE_CONDSUB, TRACE_ORIGINAL
+
+# Maximum number of items evaluated at once, bounds the size of the items x rules x tracks arrays
+KERNEL_BATCH_SIZE = 2048
+
+# Track features encoded in the track arrays
+TRACK_ATTRIBUTES = operator.attrgetter('language_id', 'index', 'blacklisted', 'signs', 'forced')
+
+
+def bulkKernel():
+    """
+    :return: The fastest kernel available to evaluate preferences for many items, see prefengine.decideMany()
+    """
+    if numpy is not None:
+        return NUMPY_KERNEL
+    return PYTHON_KERNEL
+
+
+class RuleMatrices:
+    """
+    A rule plan flattened in priority order, with the rule languages encoded as membership matrices
+    (rules x language columns). Languages no rule refers to share column 0.
+    """
+
+    def __init__(self, plan, lang_ids_of):
+        """
+        :param lang_ids_of: For each rule, a tuple of the language ID sets to encode
+        """
+        self.plan = plan
+        self.positions = []
+        rules = []
+        for group_position, group in enumerate(plan.groups):
+            for rule_position, rule in enumerate(group.rules):
+                self.positions.append((group_position, rule_position))
+                rules.append(rule)
+        self.rules = rules
+        self.rule_group = numpy.array([position[0] for position in self.positions], dtype=numpy.intp)
+
+        self.columns = {}
+        for rule in rules:
+            for lang_ids in lang_ids_of(rule):
+                for lang_id in lang_ids:
+                    self.columns.setdefault(lang_id, len(self.columns) + 1)
+        self.matrices = []
+        for n in range(len(lang_ids_of(rules[0])) if rules else 0):
+            matrix = numpy.zeros((len(rules), len(self.columns) + 1), dtype=bool)
+            for r, rule in enumerate(rules):
+                for lang_id in lang_ids_of(rule)[n]:
+                    matrix[r, self.columns[lang_id]] = True
+            self.matrices.append(matrix)
+
+    def column(self, lang_id):
+        return self.columns.get(lang_id, 0)
+
+    def columnsOf(self, lang_ids):
+        """
+        :param lang_ids: An array of language IDs
+        :return: The array of their columns
+        """
+        unique_ids, inverse = numpy.unique(lang_ids, return_inverse=True)
+        return numpy.array([self.columns.get(int(lang_id), 0) for lang_id in unique_ids], dtype=numpy.intp)[inverse]
+
+    def applicable(self, genres_list):
+        """
+        :return: Items x rules, True where the rule's group applies to the item's genres/tags
+        """
+        if not self.plan.tag_index:
+            return numpy.ones((len(genres_list), len(self.rules)), dtype=bool)
+        groups = numpy.zeros((len(genres_list), len(self.plan.groups)), dtype=bool)
+        for b, genres_and_tags in enumerate(genres_list):
+            for position, group in self.plan.matchingGroups(genres_and_tags):
+                groups[b, position] = True
+        return groups[:, self.rule_group]
+
+
+class TrackArrays:
+    """
+    The tracks of many items encoded as arrays (items x tracks), padded with absent tracks.
+    """
+
+    def __init__(self, tracks_list, matrices):
+        lengths = [len(tracks) for tracks in tracks_list]
+        shape = (len(tracks_list), max(lengths + [1]))
+        tracks = [track for item_tracks in tracks_list for track in item_tracks]
+        # Item and track position of each track, to scatter the per-track values in the padded arrays
+        items = numpy.repeat(numpy.arange(len(tracks_list)), lengths)
+        positions = numpy.arange(len(tracks)) - numpy.repeat(numpy.cumsum([0] + lengths[:-1]), lengths)
+
+        values = numpy.fromiter(itertools.chain.from_iterable(map(TRACK_ATTRIBUTES, tracks)),
+                                dtype=numpy.int64, count=5 * len(tracks)).reshape(-1, 5)
+
+        def encode(column, dtype, fill):
+            array = numpy.full(shape, fill, dtype=dtype)
+            array[items, positions] = column
+            return array
+
+        self.present = encode(True, bool, False)
+        self.column = encode(matrices.columnsOf(values[:, 0]), numpy.intp, 0)
+        self.index = encode(values[:, 1], numpy.int64, -1)
+        self.blacklisted = encode(values[:, 2], bool, False)
+        self.signs = encode(values[:, 3], bool, False)
+        self.forced = encode(values[:, 4], bool, False)
+
+    def eligible(self, ignore_signs):
+        """ Subtitles to be ignored via Signs&Songs Toggle or matching Keywords Blacklist are not eligible """
+        eligible = self.present & ~self.blacklisted
+        if ignore_signs:
+            eligible &= ~self.signs
+        return eligible
+
+
+def selectedArrays(selected_list, matrices):
+    """
+    Encode the selected tracks of many items (None when there is none).
+    :return: present, language column, blacklisted, signs and forced arrays
+    """
+    present = numpy.array([track is not None for track in selected_list], dtype=bool)
+    column = numpy.array([matrices.column(track.language_id) if track is not None else 0
+                          for track in selected_list], dtype=numpy.intp)
+    blacklisted = numpy.array([track is not None and track.blacklisted for track in selected_list], dtype=bool)
+    signs = numpy.array([track is not None and track.signs for track in selected_list], dtype=bool)
+    forced = numpy.array([track is not None and track.forced for track in selected_list], dtype=bool)
+    return present, column, blacklisted, signs, forced
+
+
+def firstTrue(mask):
+    """
+    :return: The position of the first True along the last axis, and whether there is one
+    """
+    return mask.argmax(axis=-1), mask.any(axis=-1)
+
+
+class NumpyKernel:
+    """
+    Evaluates one kind of preferences for many items at once: tracks x rules matches are computed as array
+    operations, then the first matching rule of each item is picked. Same results and traces as PythonKernel,
+    without the evaluation logs.
+    """
+
+    def evalAudioMany(self, features_list, audio_prefs, genres_list, audio_original_preflist, traces):
+        return self._batched(self._evalAudio, features_list, audio_prefs, genres_list, audio_original_preflist, traces)
+
+    def evalSubMany(self, features_list, sub_prefs, genres_list, ignore_signs, traces):
+        return self._batched(self._evalSub, features_list, sub_prefs, genres_list, ignore_signs, traces)
+
+    def evalCondSubMany(self, features_list, condsub_prefs, genres_list, ignore_signs, traces):
+        return self._batched(self._evalCondSub, features_list, condsub_prefs, genres_list, ignore_signs, traces)
+
+    @staticmethod
+    def _batched(evaluate, features_list, plan, genres_list, option, traces):
+        results = []
+        for start in range(0, len(features_list), KERNEL_BATCH_SIZE):
+            end = start + KERNEL_BATCH_SIZE
+            results.extend(evaluate(features_list[start:end], plan, genres_list[start:end], option, traces[start:end]))
+        return results
+
+    @staticmethod
+    def _trace(traces, kind, matrices, matched_rules):
+        for trace, r in zip(traces, matched_rules):
+            if trace is not None and r >= 0:
+                trace.append((kind, matrices.positions[r]))
+
+    def _evalAudio(self, features_list, audio_prefs, genres_list, audio_original_preflist, traces):
+        count = len(features_list)
+        results = numpy.full(count, -2, dtype=numpy.int64)
+        matched_rules = numpy.full(count, -1, dtype=numpy.intp)
+        todo = numpy.ones(count, dtype=bool)
+
+        if audio_original_preflist:
+            # Audio Original tracks are preferred. If one is found we choose it and skip remaining preference evaluation.
+            for b, features in enumerate(features_list):
+                found = next((track for track in features.audio
+                              if track.original and track.language in audio_original_preflist), None)
+                if found is not None:
+                    results[b] = found.index if found.index != features.selected_audio_index else -1
+                    todo[b] = False
+                    if traces[b] is not None:
+                        traces[b].append((TRACE_AUDIO, TRACE_ORIGINAL))
+
+        matrices = RuleMatrices(audio_prefs, lambda rule: (rule.lang_ids,))
+        if matrices.rules and todo.any():
+            tracks = TrackArrays([features.audio for features in features_list], matrices)
+            sel_present, sel_column, sel_blacklisted, _, _ = selectedArrays(
+                [features.selected_audio for features in features_list], matrices)
+            languages = matrices.matrices[0]
+
+            # rules x items x tracks
+            candidates = languages[:, tracks.column] & (tracks.present & ~tracks.blacklisted)[None, :, :]
+            first_track, has_track = firstTrue(candidates)
+            # items x rules
+            selected_match = (sel_present & ~sel_blacklisted)[:, None] & languages[:, sel_column].T
+            has_track = has_track.T
+            first_track = first_track.T
+            hits = matrices.applicable(genres_list) & (selected_match | has_track) & todo[:, None]
+
+            rule, matched = firstTrue(hits)
+            items = numpy.nonzero(matched)[0]
+            rule = rule[items]
+            keep = selected_match[items, rule]
+            chosen = tracks.index[items, first_track[items, rule]]
+            results[items] = numpy.where(keep, -1, chosen)
+            matched_rules[items] = rule
+            self._trace(traces, TRACE_AUDIO, matrices, matched_rules)
+        return results.tolist()
+
+    def _evalSub(self, features_list, sub_prefs, genres_list, ignore_signs, traces):
+        count = len(features_list)
+        results = numpy.full(count, -2, dtype=numpy.int64)
+        matrices = RuleMatrices(sub_prefs, lambda rule: (rule.lang_ids,))
+        if not matrices.rules or not count:
+            return results.tolist()
+
+        tracks = TrackArrays([features.subtitles for features in features_list], matrices)
+        sel_present, sel_column, sel_blacklisted, sel_signs, sel_forced = selectedArrays(
+            [features.selected_sub for features in features_list], matrices)
+        current = numpy.array([features.selected_sub_index for features in features_list], dtype=numpy.int64)
+        languages = matrices.matrices[0]
+        rule_forced = numpy.array([rule.forced for rule in matrices.rules], dtype=bool)
+
+        # rules x items x tracks
+        candidates = (languages[:, tracks.column] & tracks.eligible(ignore_signs)[None, :, :] &
+                      (tracks.forced[None, :, :] == rule_forced[:, None, None]))
+        first_track, has_track = firstTrue(candidates)
+        current_match = (candidates & (tracks.index == current[:, None])[None, :, :]).any(axis=-1)
+        # items x rules
+        sel_eligible = sel_present & ~sel_blacklisted
+        if ignore_signs:
+            sel_eligible &= ~sel_signs
+        selected_match = (sel_eligible[:, None] & languages[:, sel_column].T &
+                          (sel_forced[:, None] == rule_forced[None, :]))
+        hits = matrices.applicable(genres_list) & (selected_match | has_track.T)
+
+        rule, matched = firstTrue(hits)
+        items = numpy.nonzero(matched)[0]
+        rule = rule[items]
+        chosen = numpy.where(current_match[rule, items], current[items],
+                             tracks.index[items, first_track[rule, items]])
+        results[items] = numpy.where(selected_match[items, rule], -1, chosen)
+        matched_rules = numpy.full(count, -1, dtype=numpy.intp)
+        matched_rules[items] = rule
+        self._trace(traces, TRACE_SUBTITLE, matrices, matched_rules)
+        return results.tolist()
+
+    def _evalCondSub(self, features_list, condsub_prefs, genres_list, ignore_signs, traces):
+        count = len(features_list)
+        results = numpy.full(count, -2, dtype=numpy.int64)
+        matrices = RuleMatrices(condsub_prefs, lambda rule: (rule.audio_ids, rule.sub_ids))
+        if not matrices.rules or not count:
+            return results.tolist()
+
+        tracks = TrackArrays([features.subtitles for features in features_list], matrices)
+        audio_present, audio_column, _, _, _ = selectedArrays(
+            [features.selected_audio for features in features_list], matrices)
+        current = numpy.array([features.selected_sub_index for features in features_list], dtype=numpy.int64)
+        audio_languages, sub_languages = matrices.matrices
+        rule_forced = numpy.array([rule.forced for rule in matrices.rules], dtype=bool)
+        rule_ss = numpy.array([rule.ss_tag for rule in matrices.rules], dtype=bool)
+        rule_any = numpy.array([LANGUAGE_ID_ANY in rule.audio_ids for rule in matrices.rules], dtype=bool)
+        rule_none = numpy.array([LANGUAGE_ID_NONE in rule.sub_ids for rule in matrices.rules], dtype=bool)
+        eligible = tracks.eligible(ignore_signs)
+
+        # rules x items x tracks
+        # take into account -ss tag to prioritize specific Signs&Songs subtitles track,
+        # otherwise filter out subtitles to be ignored via Signs&Songs Toggle or matching Keywords Blacklist
+        candidates = sub_languages[:, tracks.column] & (
+            (rule_ss[:, None, None] & tracks.signs[None, :, :]) |
+            (~rule_ss[:, None, None] & eligible[None, :, :] & (tracks.forced[None, :, :] == rule_forced[:, None, None])))
+        first_track, has_track = firstTrue(candidates)
+        current_match = (candidates & (tracks.index == current[:, None])[None, :, :]).any(axis=-1)
+        # Subtitle condition is None but forced is true: a forced subtitle matching the selected audio
+        forced_candidates = audio_languages[:, tracks.column] & (eligible & tracks.forced)[None, :, :]
+        first_forced, has_forced = firstTrue(forced_candidates)
+
+        # items x rules
+        audio_match = audio_present[:, None] & (audio_languages[:, audio_column].T | rule_any[None, :])
+        hits = matrices.applicable(genres_list) & audio_match & (rule_none[None, :] | has_track.T)
+
+        rule, matched = firstTrue(hits)
+        items = numpy.nonzero(matched)[0]
+        rule = rule[items]
+        chosen = numpy.where(current_match[rule, items], current[items],
+                             tracks.index[items, first_track[rule, items]])
+        none_chosen = numpy.where(rule_forced[rule] & has_forced[rule, items],
+                                  tracks.index[items, first_forced[rule, items]], -1)
+        results[items] = numpy.where(rule_none[rule], none_chosen, chosen)
+        matched_rules = numpy.full(count, -1, dtype=numpy.intp)
+        matched_rules[items] = rule
+        self._trace(traces, TRACE_CONDSUB, matrices, matched_rules)
+        return results.tolist()
+
+
+NUMPY_KERNEL = NumpyKernel() if numpy is not None else None
@@ -1,18 +1,117 @@
 import re
-import xbmc, xbmcaddon
 from langcodes import *
-from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+from logger import log, log_level, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+
+# Maximum number of distinct preference strings kept compiled
+COMPILED_CACHE_SIZE = 16
+
+
+class CompiledRule:
+    """
+    Immutable base class of compiled preference rules.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Compiled rules are immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('Compiled rules are immutable')
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__,
+                                 ', '.join('{0}={1!r}'.format(k, getattr(self, k)) for k in self.__slots__))
+
+
+class LangRule(CompiledRule):
+    """
+    An audio or subtitle preference: a language (full name and pre-split codes) and the forced flag.
+    """
+    __slots__ = ('name', 'codes', 'lang_ids', 'forced')
+
+    def __init__(self, name, codes, forced=False):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'codes', frozenset(codes.split(r',')) if codes else frozenset())
+        object.__setattr__(self, 'lang_ids', languageIds(name, codes))
+        object.__setattr__(self, 'forced', forced)
+
+
+class CondSubRule(CompiledRule):
+    """
+    A conditional subtitle preference: if audio is audio_name then activate sub_name subtitles.
+    """
+    __slots__ = ('audio_name', 'audio_codes', 'audio_ids', 'sub_name', 'sub_codes', 'sub_ids', 'forced', 'ss_tag')
+
+    def __init__(self, audio_name, audio_codes, sub_name, sub_codes, forced=False, ss_tag=False):
+        object.__setattr__(self, 'audio_name', audio_name)
+        object.__setattr__(self, 'audio_codes', frozenset(audio_codes.split(r',')) if audio_codes else frozenset())
+        object.__setattr__(self, 'audio_ids', languageIds(audio_name, audio_codes))
+        object.__setattr__(self, 'sub_name', sub_name)
+        object.__setattr__(self, 'sub_codes', frozenset(sub_codes.split(r',')) if sub_codes else frozenset())
+        object.__setattr__(self, 'sub_ids', languageIds(sub_name, sub_codes))
+        object.__setattr__(self, 'forced', forced)
+        object.__setattr__(self, 'ss_tag', ss_tag)
+
+
+class RuleGroup(CompiledRule):
+    """
+    Rules applying to videos having at least one of genres_and_tags (or to any video if genres_and_tags is empty).
+    """
+    __slots__ = ('genres_and_tags', 'rules')
+
+    def __init__(self, genres_and_tags, rules):
+        object.__setattr__(self, 'genres_and_tags', frozenset(genres_and_tags))
+        object.__setattr__(self, 'rules', tuple(rules))
+
+
+class RulePlan(CompiledRule):
+    """
+    The compiled form of a preference string: its rule groups in priority order,
+    plus an inverted index from genre/tag to the positions of the groups requiring it.
+    """
+    __slots__ = ('groups', 'tag_index', 'untagged')
+
+    def __init__(self, groups):
+        groups = tuple(groups)
+        tag_index = {}
+        untagged = []
+        for position, group in enumerate(groups):
+            if not group.genres_and_tags:
+                untagged.append(position)
+            for g_t in group.genres_and_tags:
+                tag_index.setdefault(g_t, []).append(position)
+        object.__setattr__(self, 'groups', groups)
+        object.__setattr__(self, 'tag_index', {g_t: tuple(positions) for g_t, positions in tag_index.items()})
+        object.__setattr__(self, 'untagged', tuple(untagged))
+
+    def matchingGroups(self, genres_and_tags):
+        """
+        Get the groups applying to a video: untagged groups plus groups sharing at least one genre/tag with it.
+        Only the video's genres/tags are looked up, groups of other genres/tags are never visited.
+        :param genres_and_tags: The lowercased genres and tags of the video
+        :return: A list of (position, group) in the original priority order
+        """
+        if not self.tag_index or not genres_and_tags:
+            return [(position, self.groups[position]) for position in self.untagged]
+        positions = set(self.untagged)
+        for g_t in genres_and_tags:
+            positions.update(self.tag_index.get(g_t, ()))
+        return [(position, self.groups[position]) for position in sorted(positions)]
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(self.groups)
 
 
 class PrefParser:
-    
+
+    # Compiled plans of the last parsed preference strings, shared by all parser instances
+    _compiled = {}
+
     def __init__( self ):
-        addon = xbmcaddon.Addon()
-        self.logLevel = addon.getSetting('log_level')
-        if self.logLevel and len(self.logLevel) > 0:
-            self.logLevel = int(self.logLevel)
-        else:
-            self.logLevel = LOG_INFO
+        self.logLevel = log_level
         self.custom_prefs_delim = r'>'
         self.custom_genre_prefs_delim = r'|'
         self.custom_g_t_pref_delim = r'#'
@@ -97,3 +196,35 @@ class PrefParser:
                     log(LOG_INFO, 'Custom audio prefs: lang code {0} not found in db!'\
                              ' Please report this'.format(pref))
         return lang_prefs
+
+    def compilePrefString(self, pref_string):
+        """
+        Parse and compile a custom preference string into a RulePlan.
+        Plans are memoized by source string, so an unchanged string is never parsed again.
+        :param pref_string: The custom preference string, as found in the settings
+        :return: The compiled RulePlan
+        """
+        plan = PrefParser._compiled.get(pref_string)
+        if plan is None:
+            plan = self.compilePrefs(self.parsePrefString(pref_string))
+            if len(PrefParser._compiled) >= COMPILED_CACHE_SIZE:
+                PrefParser._compiled.pop(next(iter(PrefParser._compiled)))
+            PrefParser._compiled[pref_string] = plan
+        return plan
+
+    def compilePrefs(self, preferences):
+        """
+        Compile parsed preferences, a list of (genres_and_tags, preferences) tuples, into a RulePlan.
+        """
+        return RulePlan(RuleGroup(g_t, [self.compileRule(pref) for pref in prefs]) for g_t, prefs in preferences)
+
+    def compileRule(self, pref):
+        if len(pref) == 6:
+            audio_name, audio_codes, sub_name, sub_codes, forced, ss_tag = pref
+            return CondSubRule(audio_name, audio_codes, sub_name, sub_codes, forced == 'true', ss_tag == 'true')
+        elif len(pref) == 3:
+            name, codes, forced = pref
+            return LangRule(name, codes, forced == 'true')
+        else:
+            name, codes = pref
+            return LangRule(name, codes)
@@ -1,15 +1,43 @@
-import xbmc, xbmcaddon
+try:
+    import xbmc, xbmcaddon
+except ImportError:
+    # Headless use outside Kodi (offline rule audits): settings are read from a given source
+    xbmcaddon = None
 import re
+import hashlib
 from langcodes import *
 from prefparser import PrefParser
+from prefengine import KeywordMatcher, CompiledRules
 from resources.lib import kodi_utils
 from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
 
 
+# Settings changing the result of preference evaluations
+RULE_SETTING_IDS = ['AudioLang01', 'AudioLang02', 'AudioLang03',
+                    'SubLang01', 'SubForced01', 'SubLang02', 'SubForced02', 'SubLang03', 'SubForced03',
+                    'CondAudioLang01', 'CondSubLang01', 'CondSubForced01',
+                    'CondAudioLang02', 'CondSubLang02', 'CondSubForced02',
+                    'CondAudioLang03', 'CondSubLang03', 'CondSubForced03',
+                    'CustomAudio', 'CustomSub', 'CustomCondSub', 'signs',
+                    'enableSubtitleKeywordBlacklist', 'SubtitleKeywordBlacklist',
+                    'enableAudioKeywordBlacklist', 'AudioKeywordBlacklist',
+                    'enableAudioOriginalPreflist', 'AudioOriginalPreflist',
+                    'enableAudio', 'enableSub', 'enableCondSub', 'turnSubsOn', 'turnSubsOff',
+                    'useFilename', 'filenameRegex']
+
+
 class settings():
 
+    def getAddon(self):
+        """
+        :return: The source of the settings values, the addon itself unless another source was given
+        """
+        if self.addon is not None:
+            return self.addon
+        return xbmcaddon.Addon()
+
     def init(self):
-        addon = xbmcaddon.Addon()
+        addon = self.getAddon()
         self.logLevel = addon.getSetting('log_level')
 
         if self.logLevel and len(self.logLevel) > 0:
@@ -23,12 +51,18 @@ class settings():
 
         self.service_enabled = addon.getSetting('enabled') == 'true'
     
-    def __init__( self ):
+    def __init__( self, addon=None ):
+        """
+        :param addon: Optional source of the settings values with a getSetting(id) method, used outside Kodi
+        """
+        self.addon = addon
         self.init()
         
     def readSettings(self):
         self.readPrefs()
         self.readCustomPrefs()
+        self.readRulesVersion()
+        self.compileRules()
         log(LOG_DEBUG,
                  '\n##### LPM Settings #####\n' \
                  'delay: {0}ms\n' \
@@ -63,7 +97,7 @@ class settings():
                  )
       
     def readPrefs(self):
-      addon = xbmcaddon.Addon()    
+      addon = self.getAddon()    
 
       self.service_enabled = addon.getSetting('enabled') == 'true'
       self.delay = int(addon.getSetting('delay'))
@@ -91,7 +125,13 @@ class settings():
           self.audio_keyword_blacklist = self.audio_keyword_blacklist.lower().split(',')
       else:
           self.audio_keyword_blacklist = []
+      # Compiled once here, then classifies every track name in a single scan
+      self.keyword_matcher = KeywordMatcher(self.audio_keyword_blacklist, self.subtitle_keyword_blacklist)
       self.fast_subs_display = int(addon.getSetting('FastSubsDisplay'))
+      self.persistDecisionCache = addon.getSetting('persistDecisionCache') == 'true'
+      self.precomputeLibrary = addon.getSetting('precomputeLibrary') == 'true'
+      self.useJsonRpcSocket = addon.getSetting('useJsonRpcSocket') == 'true'
+      self.jsonRpcPort = int(addon.getSetting('jsonRpcPort') or 9090)
       self.useFilename = addon.getSetting('useFilename') == 'true'
       self.filenameRegex = addon.getSetting('filenameRegex')
       if self.useFilename:
@@ -102,51 +142,29 @@ class settings():
       
       self.CondSubTag = 'false'
       
-      self.AudioPrefs = [(set(), [
-          (languageTranslate(addon.getSetting('AudioLang01'), 4, 0) ,
-           languageTranslate(addon.getSetting('AudioLang01'), 4, 3)),
-          (languageTranslate(addon.getSetting('AudioLang02'), 4, 0) ,
-           languageTranslate(addon.getSetting('AudioLang02'), 4, 3)),
-          (languageTranslate(addon.getSetting('AudioLang03'), 4, 0) ,
-           languageTranslate(addon.getSetting('AudioLang03'), 4, 3))]
-      )]
-      self.SubtitlePrefs = [(set(), [
-          (languageTranslate(addon.getSetting('SubLang01'), 4, 0) ,
-           languageTranslate(addon.getSetting('SubLang01'), 4, 3),
-           addon.getSetting('SubForced01')),
-          (languageTranslate(addon.getSetting('SubLang02'), 4, 0) ,
-           languageTranslate(addon.getSetting('SubLang02'), 4, 3),
-           addon.getSetting('SubForced02')),
-          (languageTranslate(addon.getSetting('SubLang03'), 4, 0) ,
-           languageTranslate(addon.getSetting('SubLang03'), 4, 3),
-           addon.getSetting('SubForced03'))]
-      )]
-      self.CondSubtitlePrefs = [(set(), [
-          (
-              languageTranslate(addon.getSetting('CondAudioLang01'), 4, 0),
-              languageTranslate(addon.getSetting('CondAudioLang01'), 4, 3),
-              languageTranslate(addon.getSetting('CondSubLang01'), 4, 0),
-              languageTranslate(addon.getSetting('CondSubLang01'), 4, 3),
-              addon.getSetting('CondSubForced01'),
-              self.CondSubTag
-          ),
-          (
-              languageTranslate(addon.getSetting('CondAudioLang02'), 4, 0),
-              languageTranslate(addon.getSetting('CondAudioLang02'), 4, 3),
-              languageTranslate(addon.getSetting('CondSubLang02'), 4, 0),
-              languageTranslate(addon.getSetting('CondSubLang02'), 4, 3),
-              addon.getSetting('CondSubForced02'),
-              self.CondSubTag
-          ),
-          (
-              languageTranslate(addon.getSetting('CondAudioLang03'), 4, 0),
-              languageTranslate(addon.getSetting('CondAudioLang03'), 4, 3),
-              languageTranslate(addon.getSetting('CondSubLang03'), 4, 0),
-              languageTranslate(addon.getSetting('CondSubLang03'), 4, 3),
-              addon.getSetting('CondSubForced03'),
-              self.CondSubTag
-          )]
-      )]
+      audio_langs = [addon.getSetting('AudioLang0{0}'.format(n)) for n in range(1, 4)]
+      audio_names = languageTranslateMany(audio_langs, 4, 0)
+      audio_codes = languageTranslateMany(audio_langs, 4, 3)
+      prefParser = PrefParser()
+      self.AudioPrefs = prefParser.compilePrefs([(set(), list(zip(audio_names, audio_codes)))])
+
+      sub_langs = [addon.getSetting('SubLang0{0}'.format(n)) for n in range(1, 4)]
+      sub_forced = [addon.getSetting('SubForced0{0}'.format(n)) for n in range(1, 4)]
+      sub_names = languageTranslateMany(sub_langs, 4, 0)
+      sub_codes = languageTranslateMany(sub_langs, 4, 3)
+      self.SubtitlePrefs = prefParser.compilePrefs([(set(), list(zip(sub_names, sub_codes, sub_forced)))])
+
+      cond_audio_langs = [addon.getSetting('CondAudioLang0{0}'.format(n)) for n in range(1, 4)]
+      cond_sub_langs = [addon.getSetting('CondSubLang0{0}'.format(n)) for n in range(1, 4)]
+      cond_sub_forced = [addon.getSetting('CondSubForced0{0}'.format(n)) for n in range(1, 4)]
+      self.CondSubtitlePrefs = prefParser.compilePrefs([(set(), list(zip(
+          languageTranslateMany(cond_audio_langs, 4, 0),
+          languageTranslateMany(cond_audio_langs, 4, 3),
+          languageTranslateMany(cond_sub_langs, 4, 0),
+          languageTranslateMany(cond_sub_langs, 4, 3),
+          cond_sub_forced,
+          [self.CondSubTag] * len(cond_sub_forced)
+      )))])
 
       # These handle custom user preferences, that should be stored
       self.movieOverrides = addon.getSetting('movieOverrides') == 'true'
@@ -160,8 +178,36 @@ class settings():
 
       log(LOG_DEBUG, 'storeCustomMediaPreferences: {0}'.format(self.storeCustomMediaPreferences))
 
+    def readRulesVersion(self):
+        """
+        Compute a stable version of the rule set, changing whenever a setting used by preference evaluations changes.
+        """
+        addon = self.getAddon()
+        values = [addon.getSetting(setting_id) for setting_id in RULE_SETTING_IDS]
+        self.rules_version = hashlib.sha1('\n'.join(values).encode('utf-8')).hexdigest()
+
+    def compileRules(self):
+        """
+        Gather the preference plans in use and the evaluation options, for the headless preference engine.
+        """
+        self.compiled_rules = CompiledRules(
+            self.custom_audio if self.custom_audio_prefs_on else self.AudioPrefs,
+            self.custom_subs if self.custom_sub_prefs_on else self.SubtitlePrefs,
+            self.custom_condsub if self.custom_condsub_prefs_on else self.CondSubtitlePrefs,
+            self.keyword_matcher,
+            audio_prefs_on=self.audio_prefs_on,
+            sub_prefs_on=self.sub_prefs_on,
+            condsub_prefs_on=self.condsub_prefs_on,
+            turn_subs_on=self.turn_subs_on,
+            turn_subs_off=self.turn_subs_off,
+            ignore_signs=self.ignore_signs_on,
+            audio_original_preflist=self.audio_original_preflist if self.audio_original_preflist_enabled else [],
+            use_filename=self.useFilename,
+            filename_regex=self.reg if self.useFilename else None,
+            filename_split=self.split if self.useFilename else None)
+
     def readCustomPrefs(self):
-        addon = xbmcaddon.Addon()
+        addon = self.getAddon()
         self.custom_audio = []
         self.custom_audio_prefs_on = False
         self.custom_subs = []
@@ -170,11 +216,11 @@ class settings():
         self.custom_condsub_prefs_on = False
 
         prefParser = PrefParser()
-        self.custom_audio = prefParser.parsePrefString(
+        self.custom_audio = prefParser.compilePrefString(
             addon.getSetting('CustomAudio'))
-        self.custom_subs = prefParser.parsePrefString(
+        self.custom_subs = prefParser.compilePrefString(
             addon.getSetting('CustomSub'))
-        self.custom_condsub = prefParser.parsePrefString(
+        self.custom_condsub = prefParser.compilePrefString(
             addon.getSetting('CustomCondSub'))
 
         if len(self.custom_audio) > 0:
@@ -1,78 +1,384 @@
 import os, sys, re
 import threading
 import time
+from collections import OrderedDict, deque
 
 import xbmc, xbmcaddon, xbmcvfs
 
 from custom_media_preference import media_preference_manager, CustomMediaPreference
+from decisioncache import DecisionCache, snapshotFingerprint
+from precompute import PrecomputedDecisions, LibraryPrecomputer
+from prefetch import nextPlaylistItem, prefetchItem
+from rpcclient import queryJSONRPC, useSocket, addNotificationListener, removeNotificationListener
 from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
 
 import json as simplejson
 
 from langcodes import *
+from prefengine import StreamSnapshot, decide, ACTION_AUDIO, ACTION_SUBTITLE, ACTION_SHOW_SUBTITLES
 from prefsettings import settings
 
 settings = settings()
 
+__user_data_path__ = xbmcvfs.translatePath("special://profile/addon_data/service.languagepreferencemanager/")
+__decision_cache_file__ = __user_data_path__ + "decisionCache.json"
+__precomputed_file__ = __user_data_path__ + "precomputedDecisions.json"
+
+# Preference evaluation results of already seen stream layouts, shared by the whole service
+decision_cache = DecisionCache()
+# Preference evaluation results computed in the background for the video library
+precomputed_decisions = PrecomputedDecisions()
+
+# Polling interval of the subtitle change fallback, doubled up to the maximum while nothing changes
+WATCHER_MIN_INTERVAL = 5
+WATCHER_MAX_INTERVAL = 80
+# Notifications of Kodi on which the watcher checks for a subtitle change right away. Kodi announces stream changes
+# with Player.OnAVChange, Player.OnPropertyChanged is only sent for repeat, shuffle and party mode changes. Subtitle
+# visibility changes are not announced at all, polling catches those.
+WATCHER_NOTIFICATIONS = ('Player.OnAVChange', 'Player.OnAVStart')
+
+# Player events evaluated by the EvaluationWorker, and the maximum number of them waiting
+EVENT_AV_STARTED = 'AVStarted'
+EVENT_AV_CHANGE = 'AVChange'
+EVENT_SUBTITLE_CHECK = 'SubtitleCheck'
+EVENT_PREFETCH = 'Prefetch'
+EVALUATION_QUEUE_SIZE = 8
+
+# Readiness probe replacing the fixed delay: the player is ready once it reports the same streams for this number of
+# consecutive samples, taken at this interval (ms). The last readiness times are kept to log their distribution.
+READINESS_SAMPLES = 3
+READINESS_INTERVAL = 50
+READINESS_HISTORY = 100
+READY_AUDIO_SWITCH = 'AudioSwitch'
+
+# Id of the video player in Kodi, assumed by the batched details queries
+VIDEO_PLAYER_ID = 1
+ACTIVE_PLAYERS_ID = 1
+DETAILS_ID = 2
+GENRES_TAGS_ID = 3
+
+
+# Player.GetProperties of the streams, full for preference evaluation or limited to the selection for change checks
+STREAM_PROPERTIES = ("currentaudiostream", "audiostreams", "subtitleenabled", "currentsubtitle", "subtitles")
+SELECTION_PROPERTIES = ("currentaudiostream", "subtitleenabled", "currentsubtitle")
+SUBTITLE_SELECTION_PROPERTIES = ("subtitleenabled", "currentsubtitle")
+
+
+def detailsQuery(player_id, properties=STREAM_PROPERTIES, query_id=DETAILS_ID):
+    return {"jsonrpc": "2.0",
+            "method": "Player.GetProperties",
+            "params": {"properties": list(properties),
+                       "playerid": player_id},
+            "id": query_id}
+
+
+def genresTagsQuery(player_id, query_id=GENRES_TAGS_ID):
+    return {"jsonrpc": "2.0",
+            "method": "Player.GetItem",
+            "params": {"properties": ["genre", "tag"],
+                       "playerid": player_id},
+            "id": query_id}
+
+
+def activePlayersQuery(query_id=ACTIVE_PLAYERS_ID):
+    return {"jsonrpc": "2.0", "method": "Player.GetActivePlayers", "id": query_id}
+
+
+# JSON-RPC requests sent on every playback start, serialized once
+ACTIVE_PLAYERS_QUERY = simplejson.dumps(activePlayersQuery())
+PROPERTIES_QUERIES = dict((properties, simplejson.dumps(detailsQuery(VIDEO_PLAYER_ID, properties)))
+                          for properties in (STREAM_PROPERTIES, SELECTION_PROPERTIES, SUBTITLE_SELECTION_PROPERTIES))
+DETAILS_BATCH_QUERY = simplejson.dumps([activePlayersQuery(), detailsQuery(VIDEO_PLAYER_ID)])
+DETAILS_GENRES_BATCH_QUERY = simplejson.dumps([activePlayersQuery(), detailsQuery(VIDEO_PLAYER_ID),
+                                               genresTagsQuery(VIDEO_PLAYER_ID)])
+
+
+def hasSelectedAudio(properties, index=None):
+    """
+    :return: Whether Player.GetProperties reports a selected audio track, the given one if any
+    """
+    selected_index = (properties.get('currentaudiostream') or {}).get('index')
+    return selected_index is not None and (index is None or selected_index == index)
+
+
+def propertiesQueryString(player_id, properties):
+    if player_id == VIDEO_PLAYER_ID:
+        return PROPERTIES_QUERIES[properties]
+    return simplejson.dumps(detailsQuery(player_id, properties))
+
 
 class LangPref_Monitor(xbmc.Monitor):
 
-    def __init__(self):
+    def __init__(self, player=None):
         xbmc.Monitor.__init__(self)
+        self.player = player
 
     def onSettingsChanged(self):
         settings.init()
         settings.readSettings()
+        decision_cache.invalidate(settings.rules_version)
+        precomputed_decisions.invalidate(settings.rules_version)
+        useSocket(settings.useJsonRpcSocket, settings.jsonRpcPort)
+        if self.player is not None:
+            self.player.updateLibraryPrecomputer()
+
+
+class WatcherMonitor(xbmc.Monitor):
+    """ Requests a subtitle change check when Kodi announces a stream change """
+
+    def __init__(self, watcher):
+        xbmc.Monitor.__init__(self)
+        self.watcher = watcher
+
+    def onNotification(self, sender, method, data):
+        self.watcher.onNotification(method, data)
 
 
 class LangPrefWatcher(threading.Thread):
     """
-    A thread that periodically checks for subtitle changes.
+    A thread that requests subtitle change checks, when Kodi announces a stream change and by polling as a fallback.
+    Polling only runs while a video is playing, and slows down while nothing changes.
     """
 
-    def __init__(self, player, check_interval=10):
+    def __init__(self, player, min_interval=WATCHER_MIN_INTERVAL, max_interval=WATCHER_MAX_INTERVAL):
         super().__init__()
         self.player = player
-        self.check_interval = check_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.monitor = WatcherMonitor(self)
 
         # Event to stop the thread gracefully
         self._stop_event = threading.Event()
+        # Set on player activity, and with _check_requested when a check is needed right away
+        self._wake_event = threading.Event()
+        self._check_requested = False
 
         # Ensures the thread exits when the program ends
         self.daemon = True
 
+        # Kodi also pushes its notifications on the JSON-RPC TCP interface when it is in use
+        addNotificationListener(self.onNotification)
+
+    def onNotification(self, method, data=None):
+        if method in WATCHER_NOTIFICATIONS:
+            self.requestCheck()
+
+    def wake(self):
+        """ Something happened on the player, poll at the fastest rate again """
+        self._wake_event.set()
+
+    def requestCheck(self):
+        self._check_requested = True
+        self._wake_event.set()
+
     def run(self):
         """
-        This method runs in the background and periodically checks for subtitle changes.
+        This method runs in the background and checks for subtitle changes.
         Possibly in the future, this method will also check for other stuff.
         """
+        interval = self.min_interval
         while not self._stop_event.is_set():
-            if self.player.isPlayingVideo():
-                self.player.detect_subtitle_change()
-            time.sleep(self.check_interval)
+            try:
+                # Nothing to poll while no video is playing, wait for the next playback to wake the thread up
+                woken = self._wake_event.wait(interval if self.player.isPlayingVideo() else None)
+                if self._stop_event.is_set():
+                    break
+                self._wake_event.clear()
+                if woken:
+                    interval = self.min_interval
+                    if not self._check_requested:
+                        continue
+                self._check_requested = False
+
+                # The check runs on the evaluation worker, in line with the evaluations changing the tracks: our own
+                # track changes also raise Player.OnAVChange, and must not be mistaken for user changes. The worker
+                # wakes the watcher up again when it finds a change.
+                if self.player.isPlayingVideo():
+                    self.player.requestSubtitleCheck()
+                if not woken:
+                    interval = min(interval * 2, self.max_interval)
+            except Exception as e:
+                log(LOG_ERROR, 'Subtitle change check failed: {0}'.format(e))
+                # Keep watching, polling at the slowest rate until a check succeeds, without spinning on errors
+                interval = self.max_interval
+                self._stop_event.wait(1)
 
     def stop(self):
         """ Method to stop the thread gracefully """
+        removeNotificationListener(self.onNotification)
         self._stop_event.set()
+        self._wake_event.set()
+        self.join()
+
+
+class EvaluationWorker(threading.Thread):
+    """
+    A thread evaluating the preferences on player events, off Kodi's callback thread.
+    Jobs are (playback session, event) pairs, run in order. A newer job for the same event of the same session
+    replaces the pending one, and cancels the running one while it is still delayed: cycling through the audio
+    tracks leads to a single evaluation.
+    The worker is the only thread reading and changing the selected tracks: the subtitle change checks of the watcher
+    and of pause/resume are jobs too, so none of them runs in the middle of an evaluation.
+    """
+
+    def __init__(self, player, max_pending=EVALUATION_QUEUE_SIZE):
+        super().__init__()
+        self.player = player
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+        # Ensures the thread exits when the program ends
+        self.daemon = True
+
+    def submit(self, session, event):
+        job = (session, event)
+        with self._condition:
+            if self._pending.pop(job, None) is not None:
+                log(LOG_DEBUG, 'Replacing pending {0} evaluation'.format(event))
+            self._pending[job] = True
+            while len(self._pending) > self.max_pending:
+                dropped_job = self._pending.popitem(last=False)[0]
+                log(LOG_DEBUG, 'Too many pending evaluations, dropping {0}'.format(dropped_job[1]))
+            self._condition.notify_all()
+
+    def delay(self, job, milliseconds):
+        """
+        Wait before running a job, or only wait if the job is None.
+        :return: False if the job was replaced by a newer one meanwhile, or the worker stopped
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._stopped or job in self._pending, milliseconds / 1000.0)
+            return not self._stopped and job not in self._pending
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or self._pending)
+                if self._stopped:
+                    return
+                job = self._pending.popitem(last=False)[0]
+            try:
+                self.player.evaluate(job)
+            except Exception as e:
+                log(LOG_ERROR, 'Preference evaluation on {0} failed: {1}'.format(job[1], e))
+
+    def stop(self):
+        """ Method to stop the thread gracefully """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
         self.join()
 
 
+class PlaybackSession:
+    """
+    What is known about the item being played, from the start of its playback to its end: the active player id and
+    the genres/tags of the item do not change, the stream details only change with AV changes or our own track changes.
+    Each of those changes starts a new generation of the stream details, details queried during an older generation
+    are stale.
+    """
+
+    def __init__(self):
+        self.player_id = None
+        self.genres_and_tags = None
+        self.snapshot = None
+        self.generation = 0
+        self._snapshot_generation = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """ The streams of the player changed, the details known so far are outdated """
+        with self._lock:
+            self.generation += 1
+
+    def currentSnapshot(self):
+        """
+        :return: The StreamSnapshot of the current generation, None if the stream details need to be queried
+        """
+        with self._lock:
+            if self._snapshot_generation == self.generation:
+                return self.snapshot
+        return None
+
+    def setSnapshot(self, snapshot, generation):
+        """
+        Keep the stream details queried during a generation, unless the streams changed meanwhile.
+        :param snapshot: The StreamSnapshot queried from the player
+        :param generation: The generation at the time of the query
+        :return: True if the snapshot is current, False if it is stale
+        """
+        with self._lock:
+            if generation != self.generation:
+                return False
+            self.snapshot = snapshot
+            self._snapshot_generation = generation
+        return True
+
+
 class LangPrefMan_Player(xbmc.Player):
 
     def __init__(self):
         self.LPM_initial_run_done = False
         self.selected_sub_enabled = False
+        # Whether Kodi answers JSON-RPC batch requests, until proven otherwise
+        self.rpc_batch_supported = True
+        self.playback_session = None
 
         self.ignore_audio_change_index_list = []
+        # Observed readiness times (ms) of the player, by event
+        self.readiness_times = {}
+        # What is known in advance about the next playlist item
+        self.prefetched_item = None
 
         settings.readSettings()
+        if settings.persistDecisionCache:
+            decision_cache.load(__decision_cache_file__, settings.rules_version)
+        decision_cache.invalidate(settings.rules_version)
+        useSocket(settings.useJsonRpcSocket, settings.jsonRpcPort)
         xbmc.Player.__init__(self)
 
+        # Start the EvaluationWorker thread. Player callbacks only hand their events over to it.
+        self.evaluation_worker = EvaluationWorker(self)
+        self.evaluation_worker.start()
+        # Prefetching the next playlist item has a worker of its own, so that it never holds back the evaluation of
+        # the events of the item playing. Only the latest prefetch matters.
+        self.prefetch_worker = EvaluationWorker(self, max_pending=1)
+        self.prefetch_worker.start()
+
+        self.updateLibraryPrecomputer()
+
         if settings.storeCustomMediaPreferences:
-            # Start the LangPrefWatcher thread. This thread will periodically check for subtitle changes.
+            # Start the LangPrefWatcher thread. This thread will check for subtitle changes.
             # This is because onAVChange does not get called when the subtitle stream changes.
-            self.lang_pref_watcher = LangPrefWatcher(self, check_interval=10)
+            self.lang_pref_watcher = LangPrefWatcher(self)
             self.lang_pref_watcher.start()
+            # Recorded overrides are saved in the background, so that the player callbacks do not wait for the disk
+            media_preference_manager.start_writer()
+
+    def updateLibraryPrecomputer(self):
+        """ Start or stop the library precomputation, as enabled in the settings """
+        if settings.precomputeLibrary and not hasattr(self, 'library_precomputer'):
+            # Start the LibraryPrecomputer thread. This thread evaluates the preferences for the whole video library
+            # in the background, so that playback of a library item only needs a lookup.
+            precomputed_decisions.load(__precomputed_file__, settings.rules_version)
+            self.library_precomputer = LibraryPrecomputer(self, settings, precomputed_decisions, __precomputed_file__)
+            self.library_precomputer.start()
+        elif not settings.precomputeLibrary and hasattr(self, 'library_precomputer'):
+            log(LOG_DEBUG, 'Library precomputation disabled, stopping it')
+            self.library_precomputer.stop()
+            del self.library_precomputer
+            # Playback would otherwise go on using the decisions
+            precomputed_decisions.clear()
+
+    def saveDecisionCache(self):
+        if settings.persistDecisionCache:
+            decision_cache.save(__decision_cache_file__)
+
+    def saveCustomMediaPreferences(self):
+        """ Save the overrides not saved yet by the background writer """
+        media_preference_manager.stop_writer()
 
     def add_ignore_audio_change_index(self, index):
         """
@@ -104,36 +410,155 @@ class LangPrefMan_Player(xbmc.Player):
         """
         return index in self.ignore_audio_change_index_list
 
+    def wakeWatcher(self):
+        if hasattr(self, 'lang_pref_watcher'):
+            self.lang_pref_watcher.wake()
+
+    def requestSubtitleCheck(self):
+        """ Check for a subtitle change on the evaluation worker, after the evaluations submitted before """
+        self.evaluation_worker.submit(self.getPlaybackSession(), EVENT_SUBTITLE_CHECK)
+
     def onPlayBackPaused(self):
         """ Will be called when [user] stops Kodi playing a file """
         log(LOG_DEBUG, 'Player: [onPlayBackPaused] called')
-        self.detect_subtitle_change()
+        self.requestSubtitleCheck()
+        self.wakeWatcher()
 
     def onPlayBackResumed(self):
         """ Will be called when [user] stops Kodi playing a file """
         log(LOG_DEBUG, 'Player: [onPlayBackResumed] called')
-        self.detect_subtitle_change()
+        self.requestSubtitleCheck()
+        self.wakeWatcher()
 
     def onPlayBackStarted(self):
+        self.playback_session = PlaybackSession()
         if settings.service_enabled and settings.at_least_one_pref_on:
             log(LOG_DEBUG, 'New AV Playback initiated - Resetting LPM Initial Flag')
             self.LPM_initial_run_done = False
 
+    def onPlayBackStopped(self):
+        self.playback_session = None
+
+    def onPlayBackEnded(self):
+        self.playback_session = None
+
+    def onPlayBackError(self):
+        self.playback_session = None
+
+    def getPlaybackSession(self):
+        if self.playback_session is None:
+            # Playback started before the service
+            self.playback_session = PlaybackSession()
+        return self.playback_session
+
     def onAVStarted(self):
-        if settings.service_enabled and settings.at_least_one_pref_on and self.isPlayingVideo():
+        if settings.service_enabled and settings.at_least_one_pref_on:
+            self.evaluation_worker.submit(self.getPlaybackSession(), EVENT_AV_STARTED)
+
+    def onAVChange(self):
+        """
+        This method is called when the audio or video stream changes. It is not called when the subtitle stream changes.
+        :return: None
+        """
+        log(LOG_DEBUG, 'onAVChange detected')
+        if settings.service_enabled and settings.at_least_one_pref_on:
+            self.evaluation_worker.submit(self.getPlaybackSession(), EVENT_AV_CHANGE)
+
+    def evaluate(self, job):
+        """
+        Run an evaluation job of the EvaluationWorker, unless the playback it was submitted for is over.
+        :param job: The (playback session, event) pair
+        """
+        session, event = job
+        if session is not self.playback_session:
+            log(LOG_DEBUG, 'Playback over, skipping {0} evaluation'.format(event))
+            return
+        if event == EVENT_AV_STARTED:
+            self.evaluateAVStarted(job)
+        elif event == EVENT_AV_CHANGE:
+            self.evaluateAVChange(job)
+        elif event == EVENT_SUBTITLE_CHECK:
+            if self.detect_subtitle_change():
+                # More changes may follow, poll at the fastest rate again
+                self.wakeWatcher()
+        elif event == EVENT_PREFETCH:
+            self.prefetchNextItem()
+
+    def delayEvaluation(self, job, properties):
+        """
+        Wait for the player to be ready, at most the configured delay.
+        :return: False if the evaluation is cancelled by a newer event
+        """
+        if settings.delay > 0:
+            log(LOG_DEBUG, "Delaying preferences evaluation by at most {0} ms".format(settings.delay))
+            if self.waitUntilReady(job, job[1], properties, settings.delay) is None:
+                log(LOG_DEBUG, 'Newer {0} event, cancelling this evaluation'.format(job[1]))
+                return False
+        return True
+
+    def waitUntilReady(self, job, kind, properties, timeout, is_ready=None):
+        """
+        Sample the given player properties until they stay the same for READINESS_SAMPLES consecutive samples,
+        for at most timeout ms.
+        :param job: The evaluation job waiting, None if it cannot be cancelled
+        :param kind: The kind of wait, to keep the readiness times of each kind apart
+        :param is_ready: Check of the sampled properties, samples failing it are not counted. By default, an audio
+        track has to be selected: a player still opening the streams is just as steady.
+        :return: The time waited in ms, None if the job was cancelled meanwhile
+        """
+        if is_ready is None:
+            is_ready = hasSelectedAudio
+        query = propertiesQueryString(self.getPlaybackSession().player_id or VIDEO_PLAYER_ID, properties)
+        start = time.monotonic()
+        previous = None
+        stable = 0
+        while True:
+            result = queryJSONRPC(query).get('result')
+            if result is None or not is_ready(result):
+                stable = 0
+            elif result == previous:
+                stable += 1
+            else:
+                stable = 1
+            previous = result
+            elapsed = int((time.monotonic() - start) * 1000)
+            if stable >= READINESS_SAMPLES:
+                self.recordReadiness(kind, elapsed)
+                return elapsed
+            if elapsed >= timeout:
+                log(LOG_DEBUG, 'Player not steady after {0} ms, going on anyway'.format(elapsed))
+                self.recordReadiness(kind, elapsed)
+                return elapsed
+            if not self.evaluation_worker.delay(job, min(READINESS_INTERVAL, timeout - elapsed)):
+                return None
+
+    def recordReadiness(self, kind, elapsed):
+        times = self.readiness_times.setdefault(kind, deque(maxlen=READINESS_HISTORY))
+        times.append(elapsed)
+        ordered = sorted(times)
+        log(LOG_INFO, 'Player ready for {0} after {1} ms (median {2} ms, 90th percentile {3} ms, max {4} ms '
+                      'over the last {5})'.format(kind, elapsed, ordered[len(ordered) // 2],
+                                                  ordered[len(ordered) * 9 // 10], ordered[-1], len(ordered)))
+
+    def evaluateAVStarted(self, job):
+        if self.isPlayingVideo():
             log(LOG_DEBUG, 'Playback started')
             self.audio_changed = False
             # switching an audio track to early leads to a reopen -> start at the beginning
-            if settings.delay > 0:
-                log(LOG_DEBUG, "Delaying preferences evaluation by {0} ms".format(settings.delay))
-                xbmc.sleep(settings.delay)
+            if not self.delayEvaluation(job, STREAM_PROPERTIES):
+                return
             log(LOG_DEBUG, 'Getting video properties')
             self.getDetails()
+            prefetched = self.getPrefetchedItem(self.getPlayingFile())
 
             # If the user has enabled to store preferences (that is manually overriden preferences) for the player, we willl check for that here
             if settings.is_store_user_preference_for_player(self):
                 log(LOG_DEBUG, 'Media preference storage enabled for current media. Checking for custom preferences...')
-                custom_preference = media_preference_manager.get_preference(self)
+                if prefetched is not None and prefetched.hasCustomPreference(media_preference_manager):
+                    log(LOG_DEBUG, 'Using the custom preferences looked up in advance')
+                    custom_preference = prefetched.custom_preference
+                else:
+                    custom_preference = media_preference_manager.get_preference(self)
 
                 if custom_preference is not None:
                     log(LOG_INFO, 'Custom media preferences found for current media - Applying them...')
@@ -143,33 +568,34 @@ class LangPrefMan_Player(xbmc.Player):
                     if not custom_preference.apply_to_player(self):
                         log(LOG_INFO,
                             'Failed to apply custom media preferences for current media. Falling back to default preferences...')
-                        self.evalPrefs()
+                        self.evalPrefs(prefetched)
                 else:
-                    self.evalPrefs()
+                    self.evalPrefs(prefetched)
             else:
-                self.evalPrefs()
+                self.evalPrefs(prefetched)
 
-            self.LPM_initial_run_done = True
+            # Unless a new playback started meanwhile
+            if job[0] is self.playback_session:
+                self.LPM_initial_run_done = True
+                # Get ready for the next item of the playlist while this one plays
+                self.prefetch_worker.submit(job[0], EVENT_PREFETCH)
+            self.wakeWatcher()
 
-    def onAVChange(self):
-        """
-        This method is called when the audio or video stream changes. It is not called when the subtitle stream changes.
-        :return: None
-        """
-        log(LOG_DEBUG, 'onAVChange detected')
-        if self.LPM_initial_run_done and settings.service_enabled and settings.at_least_one_pref_on and self.isPlayingVideo():
+    def evaluateAVChange(self, job):
+        if self.LPM_initial_run_done and self.isPlayingVideo():
             log(LOG_DEBUG, 'AVChange detected - Checking possible change of audio track...')
             self.audio_changed = False
+            self.wakeWatcher()
 
-            if settings.delay > 0:
-                log(LOG_DEBUG, "Delaying preferences evaluation by {0} ms".format(settings.delay))
-                xbmc.sleep(settings.delay)
+            if not self.delayEvaluation(job, SELECTION_PROPERTIES):
+                return
 
             previous_audio_index = self.selected_audio_stream['index']
             previous_audio_language = self.selected_audio_stream['language']
 
-            log(LOG_DEBUG, 'Getting video properties')
-            self.getDetails()
+            log(LOG_DEBUG, 'Getting selected tracks')
+            self.getPlaybackSession().invalidate()
+            self.getSelection(SELECTION_PROPERTIES)
 
             log(LOG_DEBUG, 'Subtitle enabled: {0}'.format(self.selected_sub_enabled))
 
@@ -194,7 +620,7 @@ class LangPrefMan_Player(xbmc.Player):
     def detect_subtitle_change(self):
         """
         This method detects if the subtitle track has changed and stores the new preference if it has.
-        :return: None
+        :return: True if the subtitle track has changed
         """
         if self.LPM_initial_run_done and settings.service_enabled and settings.at_least_one_pref_on and self.isPlayingVideo():
             log(LOG_DEBUG, 'Running subtitle change detect')
@@ -203,7 +629,8 @@ class LangPrefMan_Player(xbmc.Player):
             previous_sub_language = self.getSelectedSubtitleLanguage()
             previous_enabled_sub = self.selected_sub_enabled
 
-            self.getDetails()
+            # Kodi does not report subtitle changes, the cached details cannot tell
+            self.getSelection(SUBTITLE_SELECTION_PROPERTIES)
 
             if self.getSelectedSubtitleIndex() != previous_sub_index or self.selected_sub_enabled != previous_enabled_sub:
                 log(LOG_DEBUG, 'Subtitle track changed from {0} to {1}'.format(previous_sub_language,
@@ -213,94 +640,88 @@ class LangPrefMan_Player(xbmc.Player):
                     custom_preference = CustomMediaPreference.from_player(self)
                     media_preference_manager.add_preference(custom_preference)
                     media_preference_manager.save_preferences()
+                return True
+        return False
 
-    def evalPrefs(self):
-        # recognized filename audio or filename subtitle
-        use_filename_audio = False
-        use_filename_subs = False
-
-        if settings.useFilename and not self.LPM_initial_run_done:
-            audio, sub = self.evalFilenamePrefs()
-            if (audio >= 0) and audio < len(self.audiostreams):
-                log(LOG_INFO, 'Filename preference: Match, selecting audio track {0}'.format(audio))
-                self.setAudioStream(audio)
-                self.audio_changed = True
-                use_filename_audio = True
-            else:
-                log(LOG_INFO, 'Filename preference: No match found for audio track ({0})'.format(self.getPlayingFile()))
-
-            if (sub >= 0) and sub < len(self.subtitles):
-                self.setSubtitleStream(sub)
-                use_filename_subs = True
-                log(LOG_INFO, 'Filename preference: Match, selecting subtitle track {0}'.format(sub))
-                if settings.turn_subs_on:
-                    log(LOG_DEBUG, 'Subtitle: enabling subs')
-                    self.showSubtitles(True)
-            else:
-                log(LOG_INFO,
-                    'Filename preference: No match found for subtitle track ({0})'.format(self.getPlayingFile()))
-                if settings.turn_subs_off:
-                    log(LOG_INFO, 'Subtitle: disabling subs')
-                    self.showSubtitles(False)
-
-        if settings.audio_prefs_on and not use_filename_audio and not self.LPM_initial_run_done:
-            if settings.custom_audio_prefs_on:
-                trackIndex = self.evalAudioPrefs(settings.custom_audio)
-            else:
-                trackIndex = self.evalAudioPrefs(settings.AudioPrefs)
+    def prefetchNextItem(self):
+        """
+        Look up the next item of the playlist, and get its custom media preference and decisions in advance.
+        """
+        item = nextPlaylistItem(self.getPlaybackSession().player_id or VIDEO_PLAYER_ID)
+        if item is None:
+            log(LOG_DEBUG, 'No next playlist item to prefetch')
+            self.prefetched_item = None
+            return
+        self.prefetched_item = prefetchItem(item, settings, media_preference_manager)
 
-            if trackIndex == -2:
-                log(LOG_INFO, 'Audio: None of the preferred languages is available')
-            elif trackIndex >= 0:
-                self.setAudioStream(trackIndex)
-                self.audio_changed = True
+    def getPrefetchedItem(self, file_name):
+        """
+        :return: The PrefetchedItem of a file, None if it was not prefetched or the rules changed since
+        """
+        prefetched = self.prefetched_item
+        if prefetched is None or prefetched.file_name != file_name or prefetched.rules_version != settings.rules_version:
+            return None
+        return prefetched
 
-        if settings.sub_prefs_on and not use_filename_subs and not self.LPM_initial_run_done:
-            if settings.custom_sub_prefs_on:
-                trackIndex = self.evalSubPrefs(settings.custom_subs)
-            else:
-                trackIndex = self.evalSubPrefs(settings.SubtitlePrefs)
-
-            if trackIndex == -2:
-                log(LOG_INFO, 'Subtitle: None of the preferred languages is available')
-                if settings.turn_subs_off:
-                    log(LOG_INFO, 'Subtitle: disabling subs')
-                    self.showSubtitles(False)
-            if trackIndex == -1:
-                log(LOG_INFO, 'Subtitle: Preferred subtitle is selected but might not be enabled')
-                if settings.turn_subs_on and not self.selected_sub_enabled:
-                    log(LOG_INFO, 'Subtitle: enabling subs because selected sub is not enabled')
-                    self.showSubtitles(True)
-            elif trackIndex >= 0:
-                self.setSubtitleStream(trackIndex)
-                if settings.turn_subs_on:
-                    log(LOG_INFO, 'Subtitle: enabling subs')
-                    self.showSubtitles(True)
-
-        if settings.condsub_prefs_on and not use_filename_subs:
-            if settings.custom_condsub_prefs_on:
-                trackIndex = self.evalCondSubPrefs(settings.custom_condsub)
-            else:
-                trackIndex = self.evalCondSubPrefs(settings.CondSubtitlePrefs)
-
-            if trackIndex == -1:
-                log(LOG_INFO, 'Conditional subtitle: disabling subs')
-                self.showSubtitles(False)
-            if trackIndex == -2:
-                log(LOG_INFO,
-                    'Conditional subtitle: No matching preferences found for current audio stream.')
-                if settings.turn_subs_off:
-                    log(LOG_INFO,
-                        'Conditional subtitle: Disabling subs.')
-                    self.showSubtitles(False)
-                else:
-                    log(LOG_INFO,
-                        'Conditional subtitle: Doing nothing.')
-            elif trackIndex >= 0:
-                self.setSubtitleStream(trackIndex)
-                if settings.turn_subs_on:
-                    log(LOG_DEBUG, 'Subtitle: enabling subs')
-                    self.showSubtitles(True)
+    def evalPrefs(self, prefetched=None):
+        """
+        Evaluate the preferences against the current snapshot of the streams and apply the resulting decision.
+        Decisions are cached per stream layout, episodes of the same show rarely need a new evaluation.
+        :param prefetched: The PrefetchedItem of the playing item, if any
+        """
+        rules = settings.compiled_rules
+        fingerprint = snapshotFingerprint(self.snapshot, rules)
+        decision = decision_cache.get(fingerprint)
+        if decision is not None:
+            log(LOG_DEBUG, 'Using cached decision {0} for this stream layout'.format(decision))
+        elif prefetched is not None and prefetched.get(fingerprint) is not None:
+            decision = prefetched.get(fingerprint)
+            log(LOG_DEBUG, 'Using prefetched decision {0} for this stream layout'.format(decision))
+            decision_cache.put(fingerprint, decision)
+        elif precomputed_decisions.get(fingerprint) is not None:
+            decision = precomputed_decisions.get(fingerprint)
+            log(LOG_DEBUG, 'Using precomputed decision {0} for this stream layout'.format(decision))
+            decision_cache.put(fingerprint, decision)
+        else:
+            decision = decide(self.snapshot, rules)
+            decision_cache.put(fingerprint, decision)
+        self.applyDecision(decision)
+
+    def applyDecision(self, decision):
+        """
+        Apply a Decision to the player in one step: the target selection is computed first, then only the tracks
+        differing from the current selection are changed.
+        :param decision: The Decision computed by the preference engine
+        """
+        self.audio_changed = decision.audio_changed
+        current_audio_index = self.getSelectedAudioIndex()
+        current_sub_index = self.getSelectedSubtitleIndex()
+        current_enabled = self.selected_sub_enabled
+        audio_index, sub_index, subtitle_enabled = decision.targetSelection(current_audio_index, current_sub_index,
+                                                                           current_enabled)
+
+        if audio_index != current_audio_index:
+            self.setAudioStream(audio_index)
+            # if the audio track has been changed wait for the player to switch before changing subtitles
+            if settings.condsub_prefs_on and settings.delay > 0 and sub_index != current_sub_index:
+                log(LOG_DEBUG, "Delaying subtitles change by at most {0} ms".format(4 * settings.delay))
+                self.waitUntilReady(None, READY_AUDIO_SWITCH, SELECTION_PROPERTIES, 4 * settings.delay,
+                                    lambda result: hasSelectedAudio(result, audio_index))
+        shown_enabled = current_enabled
+        if sub_index != current_sub_index:
+            self.setSubtitleStream(sub_index)
+            # Kodi shows the subtitles when selecting a track
+            shown_enabled = True
+        if subtitle_enabled != shown_enabled:
+            self.showSubtitles(subtitle_enabled)
+
+        if (audio_index, sub_index, subtitle_enabled) != (current_audio_index, current_sub_index, current_enabled):
+            # Keep track of our own changes, so they are not mistaken for user changes
+            self.setSnapshot(self.snapshot.withSelection(audio_index, sub_index, subtitle_enabled))
+            self.getPlaybackSession().invalidate()
+        if not subtitle_enabled or (sub_index == current_sub_index and current_enabled):
+            log(LOG_DEBUG, 'Displayed subtitles unchanged, no need to display them faster')
+            return
 
         # Workaround to an old Kodi bug creating 10-15 sec latency when activating a subtitle track.
         # Force a short rewind to avoid 10-15sec delay and first few subtitles lines potentially lost
@@ -349,409 +770,162 @@ class LangPrefMan_Player(xbmc.Player):
 
         return -1
 
-    def evalFilenamePrefs(self):
-        log(LOG_DEBUG, 'Evaluating filename preferences')
-        audio = -1
-        sub = -1
-        filename = self.getPlayingFile()
-        matches = settings.reg.findall(filename)
-        fileprefs = []
-        for m in matches:
-            sp = settings.split.split(m)
-            fileprefs.append(sp)
-
-        for pref in fileprefs:
-            if len(pref) == 2:
-                if (pref[0].lower() == 'audiostream'):
-                    audio = int(pref[1])
-                    log(LOG_INFO, 'audio track extracted from filename: {0}'.format(audio))
-                elif (pref[0].lower() == 'subtitle'):
-                    sub = int(pref[1])
-                    log(LOG_INFO, 'subtitle track extracted from filename: {0}'.format(sub))
-        log(LOG_DEBUG, 'filename: audio: {0}, sub: {1} ({2})'.format(audio, sub, filename))
-        return audio, sub
-
-    def evalAudioPrefs(self, audio_prefs):
-        log(LOG_DEBUG, 'Evaluating audio preferences')
-        log(LOG_DEBUG, 'Audio names containing the following keywords are blacklisted: {0}'.format(
-            ','.join(settings.audio_keyword_blacklist)))
-        
-        log(LOG_DEBUG, 'Original Audio tracks to be preferred if present: {0}'.format(
-            ','.join(settings.audio_original_preflist)))
-        
-        if settings.audio_original_preflist_enabled and settings.audio_original_preflist:
-            AudioOriginalTrackIndex = self.get_original_audio_track_index()
-            # Audio Original tracks are preferred. If one is found we choose it and skip remaining preference evaluation.
-            if AudioOriginalTrackIndex is not None:
-                return AudioOriginalTrackIndex
-            
-        i = 0
-        for pref in audio_prefs:
-            i += 1
-            g_t, preferences = pref
-            # genre or tags are given (g_t not empty) but none of them matches the video's tags/genres
-            if g_t and (not (self.genres_and_tags & g_t)):
-                continue
-
-            if g_t:
-                log(LOG_INFO, 'Audio: genre/tag preference {0} met with intersection {1}'.format(g_t, (
-                            self.genres_and_tags & g_t)))
-            for pref in preferences:
-                name, codes = pref
-                codes = codes.split(r',')
-                for code in codes:
-                    if (code is None):
-                        log(LOG_DEBUG, 'continue')
-                        continue
-                    if (self.selected_audio_stream and
-                            'language' in self.selected_audio_stream and
-                            # filter out audio tracks matching Keyword Blacklist
-                            not self.isInBlacklist(self.selected_audio_stream['name'], 'Audio') and
-                            (code == self.selected_audio_stream['language'] or name == self.selected_audio_stream[
-                                'language'])):
-                        log(LOG_INFO, 'Selected audio language matches preference {0} ({1})'.format(i, name))
-                        return -1
-                    else:
-                        for stream in self.audiostreams:
-                            # filter out audio tracks matching Keyword Blacklist
-                            if (self.isInBlacklist(stream['name'], 'Audio')):
-                                log(LOG_INFO,
-                                    'Audio: one audio track is found matching Keyword Blacklist : {0}. Skipping it.'.format(
-                                        ','.join(settings.audio_keyword_blacklist)))
-                                continue
-                            if ((code == stream['language']) or (name == stream['language'])):
-                                log(LOG_INFO, 'Language of Audio track {0} matches preference {1} ({2})'.format(
-                                    (stream['index'] + 1), i, name))
-                                return stream['index']
-                        log(LOG_INFO, 'Audio: preference {0} ({1}:{2}) not available'.format(i, name, code))
-                i += 1
-        return -2
-
-    def evalSubPrefs(self, sub_prefs):
-        log(LOG_DEBUG, 'Evaluating subtitle preferences')
-        log(LOG_DEBUG, 'Subtitle names containing the following keywords are blacklisted: {0}'.format(
-            ','.join(settings.subtitle_keyword_blacklist)))
-        i = 0
-        for pref in sub_prefs:
-            i += 1
-            g_t, preferences = pref
-            # genre or tags are given (g_t not empty) but none of them matches the video's tags/genres
-            if g_t and (not (self.genres_and_tags & g_t)):
-                continue
-
-            if g_t:
-                log(LOG_INFO, 'SubPrefs : genre/tag preference {0} met with intersection {1}'.format(g_t, (
-                            self.genres_and_tags & g_t)))
-            for pref in preferences:
-                if len(pref) == 2:
-                    name, codes = pref
-                    forced = 'false'
-                else:
-                    name, codes, forced = pref
-                codes = codes.split(r',')
-                for code in codes:
-                    if (code is None):
-                        log(LOG_DEBUG, 'continue')
-                        continue
-                    if (self.selected_sub and
-                            'language' in self.selected_sub and
-                            # filter out subtitles to be ignored via Signs&Songs Toggle or matching Keywords Blacklist
-                            not self.isInBlacklist(self.selected_sub['name'], 'Subtitle') and
-                            not (settings.ignore_signs_on and self.isSignsSub(self.selected_sub['name'])) and
-                            ((code == self.selected_sub['language'] or name == self.selected_sub[
-                                'language']) and self.testForcedFlag(forced, self.selected_sub['name'],
-                                                                     self.selected_sub['isforced']))):
-                        log(LOG_INFO, 'SubPrefs : Selected subtitle language matches preference {0} ({1})'.format(i, name))
-                        return -1
-                    else:
-                        to_chose_subtitle_indexes = []
-
-                        for sub in self.subtitles:
-                            # Consider empty subtitle language code as und/Undefined so it can still be prioritized in rules, not just ignored
-                            if sub['language'] == "":
-                                sub['language'] = "und"
-                            # filter out subtitles to be ignored via Signs&Songs Toggle or matching Keywords Blacklist
-                            if self.isInBlacklist(sub['name'], 'Subtitle'):
-                                log(LOG_INFO,
-                                    'SubPrefs : one subtitle track is found matching Keyword Blacklist : {0}. Skipping it.'.format(
-                                        ','.join(settings.subtitle_keyword_blacklist)))
-                                continue
-                            if (settings.ignore_signs_on and self.isSignsSub(sub['name'])):
-                                log(LOG_INFO,
-                                    'SubPrefs : ignore_signs toggle is on and one such subtitle track is found. Skipping it.')
-                                continue
-                            if (code == sub['language'] or name == sub['language']) and self.testForcedFlag(forced, sub['name'], sub['isforced']):
-                                log(LOG_INFO, 'Subtitle language of subtitle {0} matches preference {1} ({2})'.format(
-                                    (sub['index'] + 1), i, name))
-                                to_chose_subtitle_indexes.append(sub['index'])
-
-                        current_subtitle_index = self.getSelectedSubtitleIndex()
-
-                        # If our current subtitle is eligible for the condition, we will not change it
-                        if current_subtitle_index in to_chose_subtitle_indexes:
-                            log(LOG_INFO,
-                                'SubPrefs : already selected subtitle {0} matches preference {1} ({2})'.format(
-                                    (current_subtitle_index + 1), i, name))
-                            return current_subtitle_index
-
-                        if len(to_chose_subtitle_indexes) > 0:
-                            # if we have more than one subtitles, we will take the first one
-                            to_chose_subtitle_index = to_chose_subtitle_indexes[0]
-                            log(LOG_INFO, 'SubPrefs : Found {0} matching subtitles, using first at index {1}'.format(
-                                len(to_chose_subtitle_indexes), to_chose_subtitle_index))
-
-                            return to_chose_subtitle_index
-
-                        log(LOG_INFO, 'SubPrefs : preference {0} ({1}:{2}) not available'.format(i, name, code))
-                i += 1
-        return -2
-
-    def evalCondSubPrefs(self, condsub_prefs):
-        log(LOG_DEBUG, 'Evaluating conditional subtitle preferences')
-        log(LOG_DEBUG, 'Subtitle names containing the following keywords are blacklisted: {0}'.format(
-            ','.join(settings.subtitle_keyword_blacklist)))
-        # if the audio track has been changed wait some time
-        if (self.audio_changed and settings.delay > 0):
-            log(LOG_DEBUG, "Delaying preferences evaluation by {0} ms".format(4 * settings.delay))
-            xbmc.sleep(4 * settings.delay)
-        log(LOG_DEBUG, 'Getting video properties')
-        self.getDetails()
-        i = 0
-        for pref in condsub_prefs:
-            i += 1
-            g_t, preferences = pref
-            # genre or tags are given (g_t not empty) but none of them matches the video's tags/genres
-            if g_t and (not (self.genres_and_tags & g_t)):
-                continue
-
-            if g_t:
-                log(LOG_INFO, 'CondSubs : genre/tag preference {0} met with intersection {1}'.format(g_t, (
-                            self.genres_and_tags & g_t)))
-            for pref in preferences:
-                audio_name, audio_codes, sub_name, sub_codes, forced, ss_tag = pref
-                # manage multiple audio and/or subtitle 3-letters codes if present (ex. German = ger,deu)
-                audio_codes = audio_codes.split(r',')
-                sub_codes = sub_codes.split(r',')
-                nbr_sub_codes = len(sub_codes)
-
-                for audio_code in audio_codes:
-                    if audio_code is None:
-                        log(LOG_DEBUG, 'continue')
-                        continue
-
-                    if (self.selected_audio_stream and
-                            'language' in self.selected_audio_stream and
-                            (audio_code == self.selected_audio_stream['language'] or audio_name ==
-                             self.selected_audio_stream['language'] or audio_code == "any")):
-                        log(LOG_INFO,
-                            'CondSubs : Selected audio language matches conditional preference {0} ({1}:{2}), force tag is {3}'.format(
-                                i, audio_name, sub_name, forced))
-                        for sub_code in sub_codes:
-                            if sub_code == "non":
-                                if forced == 'true':
-                                    log(LOG_INFO,
-                                        'CondSubs : Subtitle condition is None but forced is true, searching a forced subtitle matching selected audio...')
-                                    for sub in self.subtitles:
-                                        log(LOG_DEBUG, 'Looping subtitles...')
-                                        # filter out subtitles to be ignored via Signs&Songs Toggle or matching Keywords Blacklist
-                                        if self.isInBlacklist(sub['name'], 'Subtitle'):
-                                            log(LOG_INFO,
-                                                'CondSubs : one subtitle track is found matching Keyword Blacklist : {0}. Skipping it.'.format(
-                                                    ','.join(settings.subtitle_keyword_blacklist)))
-                                            continue
-                                        if settings.ignore_signs_on and self.isSignsSub(sub['name']):
-                                            log(LOG_INFO,
-                                                'CondSubs : ignore_signs toggle is on and one such subtitle track is found. Skipping it.')
-                                            continue
-                                        if (audio_code == sub['language']) or (audio_name == sub['language']):
-                                            log(LOG_DEBUG, 'One potential match found...')
-                                            if self.testForcedFlag(forced, sub['name'], sub['isforced']):
-                                                log(LOG_DEBUG, 'One forced match found...')
-                                                log(LOG_INFO,
-                                                    'CondSubs : Language of subtitle {0} matches audio preference {1} ({2}:{3}) with forced overriding rule {4}'.format(
-                                                        (sub['index'] + 1), i, audio_name, sub_name, forced))
-                                                return sub['index']
-                                    log(LOG_INFO,
-                                        'CondSubs : no match found for preference {0} ({1}:{2}) with forced overriding rule {3}'.format(
-                                            i, audio_name, sub_name, forced))
-                                return -1
-                            else:
-                                to_chose_subtitle_indexes = []
-
-                                for sub in self.subtitles:
-                                    # Consider empty subtitle language code as und/Undefined so it can still be prioritized in rules, not just ignored
-                                    if sub['language'] == "":
-                                        sub['language'] = "und"
-                                    # take into account -ss tag to prioritize specific Signs&Songs subtitles track
-                                    if (sub_code == sub['language']) or (sub_name == sub['language']):
-                                        if ss_tag == 'true' and self.isSignsSub(sub['name']):
-                                            log(LOG_INFO,
-                                                'CondSubs : Language of subtitle {0} matches conditional preference {1} ({2}:{3}) SubTag {4}'.format(
-                                                    (sub['index'] + 1), i, audio_name, sub_name, ss_tag))
-                                            to_chose_subtitle_indexes.append(sub['index'])
-                                            # return sub['index']
-                                    # filter out subtitles to be ignored via Signs&Songs Toggle or matching Keywords Blacklist
-                                    if self.isInBlacklist(sub['name'], 'Subtitle'):
-                                        log(LOG_INFO,
-                                            'CondSubs : one subtitle track is found matching Keyword Blacklist : {0}. Skipping it.'.format(
-                                                ','.join(settings.subtitle_keyword_blacklist)))
-                                        continue
-                                    if settings.ignore_signs_on and self.isSignsSub(sub['name']):
-                                        log(LOG_INFO,
-                                            'CondSubs : ignore_signs toggle is on and one such subtitle track is found. Skipping it.')
-                                        continue
-                                    if (sub_code == sub['language']) or (sub_name == sub['language']):
-                                        if (ss_tag == 'false' and self.testForcedFlag(forced, sub['name'],
-                                                                                      sub['isforced'])):
-                                            log(LOG_INFO,
-                                                'CondSubs : Language of subtitle {0} matches conditional preference {1} ({2}:{3}) forced {4}'.format(
-                                                    (sub['index'] + 1), i, audio_name, sub_name, forced))
-                                            to_chose_subtitle_indexes.append(sub['index'])
-
-                                current_subtitle_index = self.getSelectedSubtitleIndex()
-
-                                # If our current subtitle is eligible for the condition, we will not change it
-                                if current_subtitle_index in to_chose_subtitle_indexes:
-                                    log(LOG_INFO,
-                                        'CondSubs : already selected subtitle matches preference {0} ({1}:{2}) with forced {3} & ss-tag {4}'.format(
-                                            i, audio_name, sub_name, forced, ss_tag))
-                                    return current_subtitle_index
-
-                                if len(to_chose_subtitle_indexes) > 0:
-                                    # if we have more than one subtitles, we will take the first one
-                                    to_chose_subtitle_index = to_chose_subtitle_indexes[0]
-                                    log(LOG_INFO,
-                                        'CondSubs : Found {0} matching subtitles, using first at index {1}'.format(
-                                        len(to_chose_subtitle_indexes), to_chose_subtitle_index))
-
-                                    return to_chose_subtitle_index
-
-                                nbr_sub_codes -= 1
-                                if nbr_sub_codes == 0:
-                                    log(LOG_INFO,
-                                        'CondSubs : no match found for preference {0} ({1}:{2}) with forced {3} & ss-tag {4}'.format(
-                                            i, audio_name, sub_name, forced, ss_tag))
-                i += 1
-        return -2
-
-    def get_original_audio_track_index(self):
-        """
-        Get the audio track index that matches the original_preferred_list. If no audio track matches, return None.
-        The audio track is searched by language, checking for the isoriginal tag. If multiple original found (weird...) the first one is returned.
-
-        :return: The first audio track index tagged as isoriginal and that matches the original_preferred_list.
-                -1 if the current selected audio track is already correct (to avoid unnecessary audio change)
-                 None if no original audio track found or no match.       
-        """
-
-        # Find all 'isoriginal' audio tracks (index, language) that match one language code in the original preferred list
-        found_original_audio_languages = [[stream['index'],stream['language']] for stream in self.audiostreams if
-                                          ('index' in stream and 'language' in stream and 'isoriginal' in stream
-                                            and stream['language'] in settings.audio_original_preflist
-								            and stream['isoriginal'])]
-
-        if found_original_audio_languages:
-            if found_original_audio_languages[0][0] != self.selected_audio_stream['index']:
-                log(LOG_INFO,
-                    "Audio: Found at least one preferred original audio track among " + ",".join(settings.audio_original_preflist) +
-                    " . Picking first: " + found_original_audio_languages[0][1])
-                return found_original_audio_languages[0][0]
-            else:
-                # Found audio track is already the selected one - No need to change
-                log(LOG_INFO,
-                    "Audio: Selected audio track matches preferred original list " + ",".join(settings.audio_original_preflist) +
-                    " . Keeping it   : " + found_original_audio_languages[0][1])
-                return -1
-        log(LOG_INFO,
-            "Audio: No preferred original audio track found among " + ",".join(settings.audio_original_preflist) +
-            " . Continue preferences evaluation...")
-        return None
-
-    def isInBlacklist(self, TrackName, TrackType):
-        found = False
-        test = TrackName.lower()
-        if (TrackType == 'Subtitle' and settings.subtitle_keyword_blacklist_enabled and any(
-                keyword in test for keyword in settings.subtitle_keyword_blacklist)):
-            found = True
-        elif (TrackType == 'Audio' and settings.audio_keyword_blacklist_enabled and any(
-                keyword in test for keyword in settings.audio_keyword_blacklist)):
-            found = True
-        return found
-
-    def isSignsSub(self, subName):
-        test = subName.lower()
-        matches = ['signs']
-        return any(x in test for x in matches)
-
-    def testForcedFlag(self, forced, subName, subForcedTag):
-        test = subName.lower()
-        matches = ['forced', 'forcés']
-        found = any(x in test for x in matches)
-        # Only when looking for forced subs :
-        #   in case the sub name is plain empty or not well documented, 
-        #   check also the sub isforced tag and consider it a match if set
-        if (forced and not found and subForcedTag):
-            found = True
-        return ((forced == 'false') and not found) or ((forced == 'true') and found)
-
     def isExternalSub(self, subName):
         test = subName.lower()
         matches = ['ext']
         return any(x in test for x in matches)
 
-    def getDetails(self):
-        activePlayers = '{"jsonrpc": "2.0", "method": "Player.GetActivePlayers", "id": 1}'
-        json_query = xbmc.executeJSONRPC(activePlayers)
-        # json_query = unicode(json_query, 'utf-8', errors='ignore')
-        json_response = simplejson.loads(json_query)
-        activePlayerID = json_response['result'][0]['playerid']
-        details_query_dict = {"jsonrpc": "2.0",
-                              "method": "Player.GetProperties",
-                              "params": {"properties":
-                                             ["currentaudiostream", "audiostreams", "subtitleenabled",
-                                              "currentsubtitle", "subtitles"],
-                                         "playerid": activePlayerID},
-                              "id": 1}
-        details_query_string = simplejson.dumps(details_query_dict)
-        json_query = xbmc.executeJSONRPC(details_query_string)
-        # json_query = unicode(json_query, 'utf-8', errors='ignore')
-        json_response = simplejson.loads(json_query)
+    def setSnapshot(self, snapshot):
+        self.snapshot = snapshot
+        self.selected_audio_stream = snapshot.selected_audio_stream
+        self.selected_sub = snapshot.selected_sub
+        self.selected_sub_enabled = snapshot.subtitle_enabled
+        self.audiostreams = snapshot.audiostreams
+        self.subtitles = snapshot.subtitles
+        self.genres_and_tags = snapshot.genres_and_tags
 
-        if 'result' in json_response and json_response['result'] != None:
-            self.selected_audio_stream = json_response['result']['currentaudiostream']
-            self.selected_sub = json_response['result']['currentsubtitle']
-            self.selected_sub_enabled = json_response['result']['subtitleenabled']
-            self.audiostreams = json_response['result']['audiostreams']
-            self.subtitles = json_response['result']['subtitles']
+    def getDetails(self, refresh=False):
+        """
+        Get the stream details of the playing item, queried at most once per generation of the playback session.
+        :param refresh: Query the stream details even if the cached ones are current
+        """
+        session = self.getPlaybackSession()
+        if not refresh:
+            snapshot = session.currentSnapshot()
+            if snapshot is not None:
+                log(LOG_DEBUG, 'Stream details unchanged since generation {0}'.format(session.generation))
+                self.setSnapshot(snapshot)
+                return
+        generation = session.generation
+
+        if session.genres_and_tags is None:
+            if not settings.custom_condsub_prefs_on and not settings.custom_audio_prefs_on and not settings.custom_sub_prefs_on:
+                log(LOG_DEBUG, 'No custom prefs used at all, skipping extra Video tags/genres JSON query.')
+                session.genres_and_tags = set()
+            else:
+                # Movies processed by the library precomputation already know their genres/tags,
+                # as well as prefetched playlist items
+                playing_file = self.getPlayingFile()
+                session.genres_and_tags = precomputed_decisions.genresAndTags(playing_file)
+                prefetched = self.getPrefetchedItem(playing_file)
+                if session.genres_and_tags is None and prefetched is not None:
+                    session.genres_and_tags = set(prefetched.genres_and_tags)
+                if session.genres_and_tags is not None:
+                    log(LOG_DEBUG, 'Video tags/genres (library): {0}'.format(session.genres_and_tags))
+        with_genres = session.genres_and_tags is None
+
+        responses = None
+        if session.player_id is None and self.rpc_batch_supported:
+            responses = self.queryDetailsBatch(with_genres)
+        if responses is None:
+            responses = self.queryDetails(with_genres, session.player_id)
+        activePlayerID, json_response, genres_response = responses
+
+        log(LOG_DEBUG, json_response)
+        if 'result' not in json_response or json_response['result'] == None:
+            return
+        properties = json_response['result']
+        session.player_id = activePlayerID
+        if with_genres:
+            session.genres_and_tags = self.genresAndTagsFrom(genres_response)
+
+        snapshot = StreamSnapshot(properties['audiostreams'], properties['subtitles'],
+                                  properties['currentaudiostream'], properties['currentsubtitle'],
+                                  properties['subtitleenabled'], session.genres_and_tags,
+                                  file_name=self.getPlayingFile() if settings.useFilename else '',
+                                  initial=not self.LPM_initial_run_done)
+        if not session.setSnapshot(snapshot, generation):
+            log(LOG_DEBUG, 'Streams changed while getting video properties, ignoring them')
+            return
+        self.setSnapshot(snapshot)
+
+    def getSelection(self, properties):
+        """
+        Get only some selection properties of the player and merge them into the known stream details.
+        The full details are queried instead if they are not known yet for this playback, or if the selected
+        tracks are not part of the known streams.
+        :param properties: SELECTION_PROPERTIES or SUBTITLE_SELECTION_PROPERTIES
+        """
+        session = self.getPlaybackSession()
+        if session.snapshot is None:
+            self.getDetails(refresh=True)
+            return
+        generation = session.generation
+
+        json_response = queryJSONRPC(propertiesQueryString(session.player_id, properties))
         log(LOG_DEBUG, json_response)
+        if 'result' not in json_response or json_response['result'] == None:
+            return
+        selection = json_response['result']
+        if not self.snapshot.hasSelection(selection):
+            log(LOG_DEBUG, 'Selected tracks are not among the known streams, getting all video properties')
+            self.getDetails(refresh=True)
+            return
 
-        if (
-                not settings.custom_condsub_prefs_on and not settings.custom_audio_prefs_on and not settings.custom_sub_prefs_on):
-            log(LOG_DEBUG, 'No custom prefs used at all, skipping extra Video tags/genres JSON query.')
-            self.genres_and_tags = set()
+        snapshot = self.snapshot.withProperties(selection, initial=not self.LPM_initial_run_done)
+        if not session.setSnapshot(snapshot, generation):
+            log(LOG_DEBUG, 'Streams changed while getting selected tracks, ignoring them')
             return
+        self.setSnapshot(snapshot)
 
-        genre_tags_query_dict = {"jsonrpc": "2.0",
-                                 "method": "Player.GetItem",
-                                 "params": {"properties":
-                                                ["genre", "tag"],
-                                            "playerid": activePlayerID},
-                                 "id": 1}
-        genre_tags_query_string = simplejson.dumps(genre_tags_query_dict)
-        json_query = xbmc.executeJSONRPC(genre_tags_query_string)
-        # json_query = unicode(json_query, 'utf-8', errors='ignore')
-        json_response = simplejson.loads(json_query)
+    def queryDetailsBatch(self, with_genres):
+        """
+        Query the active players, the stream details and optionally the genres/tags in a single JSON-RPC batch,
+        assuming the active player is the video player.
+        :return: The active player id, stream details and genres/tags responses, or None if the batch could not be used
+        """
+        try:
+            json_response = queryJSONRPC(DETAILS_GENRES_BATCH_QUERY if with_genres else DETAILS_BATCH_QUERY)
+            responses = dict((response['id'], response) for response in json_response)
+            active_players = responses[ACTIVE_PLAYERS_ID]['result']
+        except (ValueError, KeyError, TypeError) as e:
+            # Batches are not handled by this Kodi version, stay with single queries from now on
+            log(LOG_DEBUG, 'JSON-RPC batch failed, falling back to single queries: {0}'.format(e))
+            self.rpc_batch_supported = False
+            return None
+        if not active_players:
+            return None
+        activePlayerID = active_players[0]['playerid']
+        if activePlayerID != VIDEO_PLAYER_ID:
+            log(LOG_DEBUG, 'Active player {0} is not the video player, querying it separately'.format(activePlayerID))
+            return self.queryDetails(with_genres, activePlayerID)
+        return activePlayerID, responses.get(DETAILS_ID, {}), responses.get(GENRES_TAGS_ID, {})
+
+    def queryDetails(self, with_genres, activePlayerID=None):
+        """
+        Query the active players if not known yet, the stream details and optionally the genres/tags one after the other.
+        :return: The active player id, stream details and genres/tags responses
+        """
+        if activePlayerID is None:
+            json_response = queryJSONRPC(ACTIVE_PLAYERS_QUERY)
+            activePlayerID = json_response['result'][0]['playerid']
+        json_response = queryJSONRPC(propertiesQueryString(activePlayerID, STREAM_PROPERTIES))
+        genres_response = {}
+        if with_genres:
+            genres_response = queryJSONRPC(genresTagsQuery(activePlayerID))
+        return activePlayerID, json_response, genres_response
+
+    def genresAndTagsFrom(self, json_response):
+        genres_and_tags = set()
         if 'result' in json_response and json_response['result'] != None:
             gt = []
             if 'genre' in json_response['result']['item']:
                 gt = json_response['result']['item']['genre']
             if 'tag' in json_response['result']['item']:
                 gt.extend(json_response['result']['item']['tag'])
-            self.genres_and_tags = set(map(lambda x: x.lower(), gt))
-        log(LOG_DEBUG, 'Video tags/genres: {0}'.format(self.genres_and_tags))
+            genres_and_tags = set(map(lambda x: x.lower(), gt))
+        log(LOG_DEBUG, 'Video tags/genres: {0}'.format(genres_and_tags))
         log(LOG_DEBUG, json_response)
+        return genres_and_tags
 
     def __del__(self):
         """ Ensure that the watcher thread is properly stopped when the object is deleted """
         if hasattr(self, 'lang_pref_watcher'):
             self.lang_pref_watcher.stop()
+        if hasattr(self, 'library_precomputer'):
+            self.library_precomputer.stop()
+        if hasattr(self, 'evaluation_worker'):
+            self.evaluation_worker.stop()
+        if hasattr(self, 'prefetch_worker'):
+            self.prefetch_worker.stop()
+        useSocket(False)
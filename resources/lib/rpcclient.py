@@ -0,0 +1,309 @@
+"""
+Access to Kodi's JSON-RPC API. Queries go through xbmc.executeJSONRPC, or through Kodi's JSON-RPC TCP interface when
+enabled (it needs "Allow remote control from applications on this system" in Kodi's services settings): the queries
+of all threads are then pipelined on a single connection, run by an asyncio event loop in a background thread.
+"""
+import asyncio
+import codecs
+import concurrent.futures
+import functools
+import itertools
+import threading
+
+import xbmc
+
+import json as simplejson
+
+from logger import log, LOG_NONE, LOG_INFO, LOG_DEBUG, LOG_ERROR
+
+JSONRPC_HOST = '127.0.0.1'
+JSONRPC_PORT = 9090
+# Seconds to wait for the connection, and for the response to a request
+CONNECT_TIMEOUT = 2
+REQUEST_TIMEOUT = 10
+READ_SIZE = 65536
+
+
+class JsonRpcError(Exception):
+    """ Raised when the JSON-RPC TCP interface cannot be reached or does not answer """
+    pass
+
+
+class AsyncJsonRpcClient:
+    """
+    A JSON-RPC client over Kodi's TCP interface. Requests are sent as soon as they are made, under ids of the client,
+    and their responses are matched by id as they arrive, in any order. Messages without id are notifications,
+    passed on to the notification listeners.
+    """
+
+    def __init__(self, host=JSONRPC_HOST, port=JSONRPC_PORT, listeners=None):
+        """
+        :param listeners: The list of notification listeners to use, possibly shared with other clients
+        """
+        self.host = host
+        self.port = port
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._listeners = listeners if listeners is not None else []
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                            CONNECT_TIMEOUT)
+        self._read_task = asyncio.ensure_future(self._readMessages())
+
+    async def close(self):
+        self.closed = True
+        if self._read_task is not None:
+            self._read_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        self._failPending(JsonRpcError('Connection closed'))
+
+    def _failPending(self, error):
+        """ Requests waiting for a response get the error instead """
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def addNotificationListener(self, listener):
+        """
+        :param listener: Called with the method and params of each notification, on the event loop thread
+        """
+        self._listeners.append(listener)
+
+    async def request(self, payload):
+        """
+        Send a request, or a batch of requests, and wait for the response.
+        :param payload: The request as a dict, or a list of them
+        :return: The response as a dict, or a list of them, with the ids of the requests
+        """
+        if self.closed:
+            raise JsonRpcError('Connection closed')
+        requests = payload if isinstance(payload, list) else [payload]
+        loop = asyncio.get_running_loop()
+        sent = []
+        waiting = []
+        for request in requests:
+            if 'id' in request:
+                request_id = next(self._ids)
+                future = loop.create_future()
+                self._pending[request_id] = future
+                waiting.append((request['id'], request_id, future))
+                request = dict(request, id=request_id)
+            sent.append(request)
+        try:
+            self._writer.write(simplejson.dumps(sent if isinstance(payload, list) else sent[0]).encode('utf-8'))
+            await self._writer.drain()
+            responses = await asyncio.wait_for(asyncio.gather(*[future for _, _, future in waiting]), REQUEST_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise JsonRpcError('No response to {0}: {1}'.format(
+                ', '.join(request.get('method', '?') for request in requests), str(e) or 'timeout'))
+        finally:
+            for _, request_id, _ in waiting:
+                self._pending.pop(request_id, None)
+
+        for (original_id, _, _), response in zip(waiting, responses):
+            response['id'] = original_id
+        if isinstance(payload, list):
+            return responses
+        return responses[0] if responses else None
+
+    async def _readMessages(self):
+        """
+        Read the messages sent by Kodi. They are JSON values one after the other, without any separator.
+        """
+        utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        json_decoder = simplejson.JSONDecoder()
+        buffer = ''
+        try:
+            while True:
+                data = await self._reader.read(READ_SIZE)
+                if not data:
+                    raise JsonRpcError('Connection closed by Kodi')
+                buffer += utf8_decoder.decode(data)
+                # A message can only be complete once the buffer ends like one, this saves decoding large responses
+                # again with each part received
+                while buffer and buffer.rstrip()[-1:] in ('}', ']'):
+                    buffer = buffer.lstrip()
+                    try:
+                        message, end = json_decoder.raw_decode(buffer)
+                    except ValueError:
+                        break
+                    buffer = buffer[end:]
+                    self._dispatch(message)
+        except (OSError, JsonRpcError) as e:
+            log(LOG_ERROR, 'JSON-RPC TCP interface: ' + str(e))
+            self.closed = True
+            self._failPending(JsonRpcError(str(e)))
+
+    def _dispatch(self, message):
+        if isinstance(message, list):
+            for item in message:
+                self._dispatch(item)
+        elif not isinstance(message, dict):
+            log(LOG_DEBUG, 'JSON-RPC TCP interface: unexpected message {0}'.format(message))
+        elif message.get('id') is not None:
+            future = self._pending.get(message['id'])
+            if future is not None and not future.done():
+                future.set_result(message)
+        elif 'method' in message:
+            for listener in self._listeners:
+                try:
+                    listener(message['method'], message.get('params', {}))
+                except Exception as e:
+                    log(LOG_ERROR, 'JSON-RPC notification listener failed: ' + str(e))
+        else:
+            # Errors of requests that could not even be parsed have no id
+            log(LOG_ERROR, 'JSON-RPC TCP interface: {0}'.format(message.get('error')))
+
+
+class JsonRpcSocket:
+    """
+    An AsyncJsonRpcClient run by an event loop in a background thread, for the synchronous code of the service.
+    """
+
+    def __init__(self, host=JSONRPC_HOST, port=JSONRPC_PORT, listeners=None):
+        self.client = AsyncJsonRpcClient(host, port, listeners)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        # Ensures the thread exits when the program ends
+        self._thread.daemon = True
+
+    def _run(self, coroutine, timeout):
+        try:
+            future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        except RuntimeError as e:
+            # The socket was stopped meanwhile by another thread, its loop is closed
+            coroutine.close()
+            raise JsonRpcError(str(e))
+        try:
+            return future.result(timeout)
+        except (OSError, RuntimeError, asyncio.TimeoutError, asyncio.CancelledError,
+                concurrent.futures.TimeoutError, concurrent.futures.CancelledError) as e:
+            raise JsonRpcError(str(e) or 'timeout')
+
+    def start(self):
+        self._thread.start()
+        self._run(self.client.connect(), CONNECT_TIMEOUT + 1)
+
+    def execute(self, payload):
+        """
+        :param payload: The request as a dict, or a list of them
+        :return: The response as a dict, or a list of them
+        """
+        return self._run(self.client.request(payload), REQUEST_TIMEOUT + 1)
+
+    def stop(self):
+        if self._thread.is_alive():
+            try:
+                self._run(self.client.close(), CONNECT_TIMEOUT)
+            except JsonRpcError:
+                pass
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._loop.close()
+
+
+# The connection to the JSON-RPC TCP interface, None to use xbmc.executeJSONRPC. The lock is only held to read or
+# replace it, never while connecting or disconnecting: queries of other threads go on meanwhile.
+_socket = None
+_socket_lock = threading.Lock()
+# Incremented by each useSocket call, a connection made for an older call is not used
+_socket_request = 0
+# Listeners of the notifications pushed by Kodi on the JSON-RPC TCP interface, kept across connections
+_notification_listeners = []
+
+
+def addNotificationListener(listener):
+    """
+    :param listener: Called with the method and params of each notification Kodi pushes on the JSON-RPC TCP
+    interface, on the thread of its event loop
+    """
+    _notification_listeners.append(listener)
+
+
+def removeNotificationListener(listener):
+    if listener in _notification_listeners:
+        _notification_listeners.remove(listener)
+
+
+def useSocket(enabled, port=JSONRPC_PORT):
+    """
+    Send the queries through the JSON-RPC TCP interface if enabled and Kodi can be reached on it, otherwise through
+    xbmc.executeJSONRPC. Queries go through xbmc.executeJSONRPC while connecting.
+    """
+    global _socket, _socket_request
+    with _socket_lock:
+        _socket_request += 1
+        request = _socket_request
+        old_socket = _socket
+        if old_socket is not None and (not enabled or old_socket.client.port != port or old_socket.client.closed):
+            _socket = None
+        else:
+            old_socket = None
+        connect = enabled and _socket is None
+    if old_socket is not None:
+        old_socket.stop()
+    if not connect:
+        return
+
+    socket = JsonRpcSocket(JSONRPC_HOST, port, _notification_listeners)
+    try:
+        socket.start()
+    except JsonRpcError as e:
+        log(LOG_ERROR, 'JSON-RPC TCP interface not available on port {0}, using executeJSONRPC: {1}'.format(port, e))
+        socket.stop()
+        return
+    with _socket_lock:
+        if request == _socket_request and _socket is None:
+            _socket = socket
+            socket = None
+    if socket is not None:
+        # The settings changed again meanwhile, the newer call decides
+        socket.stop()
+        return
+    log(LOG_DEBUG, 'Using the JSON-RPC TCP interface on port {0}'.format(port))
+
+
+def dropSocket(socket):
+    """
+    Stop using a connection that was lost, unless it was already replaced.
+    """
+    global _socket
+    with _socket_lock:
+        if _socket is not socket:
+            return
+        _socket = None
+    socket.stop()
+
+
+@functools.lru_cache(maxsize=32)
+def decodeQuery(query):
+    """
+    :return: The request of a query string. Cached, as most queries are prebuilt strings sent again and again. The
+    request is shared and must not be modified.
+    """
+    return simplejson.loads(query)
+
+
+def queryJSONRPC(query):
+    """
+    Send a JSON-RPC query to Kodi, through the JSON-RPC TCP interface when in use, otherwise through
+    xbmc.executeJSONRPC.
+    :param query: The request as a JSON string, or as a dict or a list of dicts
+    :return: The decoded response
+    """
+    with _socket_lock:
+        socket = _socket
+    if socket is not None:
+        try:
+            return socket.execute(decodeQuery(query) if isinstance(query, str) else query)
+        except JsonRpcError as e:
+            log(LOG_ERROR, 'JSON-RPC TCP interface failed, using executeJSONRPC: ' + str(e))
+            if socket.client.closed:
+                dropSocket(socket)
+    return simplejson.loads(xbmc.executeJSONRPC(query if isinstance(query, str) else simplejson.dumps(query)))
@@ -0,0 +1,257 @@
+from logger import log, LOG_INFO, LOG_DEBUG, LOG_ERROR
+import os
+import sqlite3
+import threading
+
+from custom_media_preference import MediaPreferenceManager, CustomMediaPreference, MediaSelector, MediaIdentity, \
+    selector_key, __user_data_path__
+
+__database_file__ = __user_data_path__ + "customMediaPreferences.db"
+
+# Schema version, stored as the user_version of the database. 0 is a new database.
+SCHEMA_VERSION = 1
+
+CREATE_SCHEMA = (
+    # Rows are in insertion order by rowid: replacing a preference inserts it again, at the end
+    """CREATE TABLE IF NOT EXISTS preferences (
+           selector TEXT PRIMARY KEY,
+           selector_type TEXT NOT NULL,
+           tv_show_name TEXT NOT NULL,
+           file_name TEXT NOT NULL,
+           priority INTEGER NOT NULL,
+           audio_language TEXT NOT NULL,
+           audio_track_id INTEGER NOT NULL,
+           subtitle_language TEXT NOT NULL,
+           subtitle_track_id INTEGER NOT NULL,
+           enable_subtitles INTEGER NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS preferences_selector_type ON preferences (selector_type)",
+    "CREATE INDEX IF NOT EXISTS preferences_tv_show_name ON preferences (tv_show_name)",
+    "CREATE INDEX IF NOT EXISTS preferences_file_name ON preferences (file_name)",
+)
+
+# The statements are always given as the same strings, so that sqlite3 prepares each once and reuses it from its
+# statement cache
+PREFERENCE_COLUMNS = "selector, selector_type, tv_show_name, file_name, priority, audio_language, audio_track_id, " \
+                     "subtitle_language, subtitle_track_id, enable_subtitles"
+INSERT_PREFERENCE = "INSERT INTO preferences (" + PREFERENCE_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+DELETE_PREFERENCE = "DELETE FROM preferences WHERE selector = ?"
+SELECT_PREFERENCE = "SELECT " + PREFERENCE_COLUMNS + " FROM preferences WHERE selector = ?"
+# Candidates of an item, by the highest priority then insertion order
+SELECT_ITEM_PREFERENCES = "SELECT " + PREFERENCE_COLUMNS + " FROM preferences " \
+                          "WHERE (? AND tv_show_name = ? AND tv_show_name != '') OR (file_name = ? AND file_name != '') " \
+                          "ORDER BY priority DESC, rowid"
+SELECT_ALL_PREFERENCES = "SELECT " + PREFERENCE_COLUMNS + " FROM preferences ORDER BY rowid"
+
+
+class SqliteMediaPreferenceManager:
+    """
+    The custom media preferences, kept in an SQLite database instead of in memory, for very large numbers of
+    preferences. Same interface as MediaPreferenceManager. Changes are committed as they are made.
+    """
+
+    def __init__(self, file_name=__database_file__):
+        self.file_name = file_name
+        # Incremented on each change, to tell whether a preference looked up earlier is still the one that applies
+        self.version = 0
+        # The connection is shared by the player callbacks, the watcher and the evaluation worker
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    @staticmethod
+    def open(file_name=__database_file__):
+        """
+        Open the database, creating it on first use from the preferences of customMediaPreferences.json.
+        :return: The manager, None if the database cannot be opened
+        """
+        try:
+            manager = SqliteMediaPreferenceManager(file_name)
+            manager.create_schema()
+            return manager
+        except sqlite3.Error as e:
+            log(LOG_ERROR, "Failed to open custom media preferences database: " + str(e))
+            return None
+
+    @staticmethod
+    def export_to_file(file_name=__database_file__):
+        """
+        Write the preferences of the database to customMediaPreferences.json, which was not updated while the
+        database was in use, then delete the database: enabling the database again imports the file anew.
+        :return: True if there was a database and it was exported
+        """
+        if not os.path.exists(file_name):
+            return False
+
+        try:
+            manager = SqliteMediaPreferenceManager(file_name)
+            try:
+                if manager.connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                    # Never filled, customMediaPreferences.json is still the latest
+                    preferences = None
+                else:
+                    preferences = manager.to_json()
+            finally:
+                manager.connection.close()
+        except sqlite3.Error as e:
+            log(LOG_ERROR, "Failed to export custom media preferences database: " + str(e))
+            return False
+
+        if preferences is not None:
+            if not MediaPreferenceManager.from_json(preferences).write_preferences():
+                # Kept, to try again on the next start
+                log(LOG_ERROR, "Custom media preferences database not exported, keeping it")
+                return False
+            log(LOG_INFO, "Exported " + str(len(preferences)) +
+                " custom media preferences from the database back to customMediaPreferences.json")
+
+        try:
+            for database_file in (file_name, file_name + "-wal", file_name + "-shm"):
+                if os.path.exists(database_file):
+                    os.remove(database_file)
+        except OSError as e:
+            log(LOG_ERROR, "Failed to delete custom media preferences database: " + str(e))
+        return True
+
+    def create_schema(self):
+        with self.lock, self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return
+            for statement in CREATE_SCHEMA:
+                self.connection.execute(statement)
+            self.migrate(MediaPreferenceManager.from_file())
+            self.connection.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+
+    def migrate(self, manager):
+        """
+        Import the preferences of a MediaPreferenceManager, in their order.
+        """
+        preferences = manager.preferences
+        self.connection.executemany(INSERT_PREFERENCE, (preference_row(preference) for preference in preferences))
+        log(LOG_INFO, "Imported " + str(len(preferences)) + " custom media preferences into the database")
+
+    @property
+    def preferences(self):
+        with self.lock:
+            return [row_preference(row) for row in self.connection.execute(SELECT_ALL_PREFERENCES)]
+
+    def add_preference(self, custom_media_preference):
+        if not isinstance(custom_media_preference, CustomMediaPreference):
+            log(LOG_ERROR, "Cannot add non-custom media preference")
+            return
+
+        if not custom_media_preference:
+            log(LOG_ERROR, "Cannot add empty custom media preference")
+            return
+
+        # A preference for the same media replaces the previous one, and moves to the end
+        with self.lock, self.connection:
+            self.connection.execute(DELETE_PREFERENCE, (selector_key(custom_media_preference.selector),))
+            self.connection.execute(INSERT_PREFERENCE, preference_row(custom_media_preference))
+            self.version += 1
+
+    def remove_preference(self, custom_media_preference):
+        with self.lock, self.connection:
+            if self.connection.execute(DELETE_PREFERENCE,
+                                       (selector_key(custom_media_preference.selector),)).rowcount:
+                self.version += 1
+
+    def has_preference(self, custom_media_preference):
+        """
+        Check if the custom media preference is already in the list of preferences. That is, if the same media selector is already in the list.
+        :param custom_media_preference: The custom media preference to check
+        :return: True if the custom media preference is already in the list, False otherwise
+        """
+        return self.get_matching_preference(custom_media_preference) is not None
+
+    def get_matching_preference(self, custom_media_preference):
+        """
+        Get the custom media preference that matches the media selector of the given custom media preference. If no preference matches, return None.
+        :param custom_media_preference: The custom media preference to match
+        :return: The custom media preference that matches the media selector of the given custom media preference, or None if no preference matches
+        """
+        with self.lock:
+            row = self.connection.execute(SELECT_PREFERENCE,
+                                          (selector_key(custom_media_preference.selector),)).fetchone()
+        return row_preference(row) if row is not None else None
+
+    def get_preference(self, player):
+        """
+        Get the custom media preference that applies to the playing item with the highest priority. If no preference applies, return None.
+        :param player: The player to get the custom media preference for
+        :return:  The custom media preference that applies to the playing item with the highest priority, or None if no preference applies
+        """
+        identity = MediaIdentity.from_player(player)
+        if identity is None:
+            return None
+
+        return self.get_preference_for_item(identity.is_tv_show, identity.tv_show_title, identity.file_name)
+
+    def get_preference_for_item(self, is_tv_show, tv_show_title, file_name):
+        """
+        Get the custom media preference that applies to an item with the highest priority, without it being played.
+        :param is_tv_show: True if the item is an episode of a TV show
+        :param tv_show_title: The title of the TV show of the item
+        :param file_name: The file of the item
+        :return: The custom media preference that applies to the item with the highest priority, or None if no preference applies
+        """
+        with self.lock:
+            rows = self.connection.execute(SELECT_ITEM_PREFERENCES,
+                                           (bool(is_tv_show), tv_show_title or '', file_name or '')).fetchall()
+        for row in rows:
+            preference = row_preference(row)
+            if preference.selector.applies_to_item(is_tv_show, tv_show_title, file_name):
+                return preference
+        return None
+
+    def save_preferences(self):
+        """
+        Nothing to do, changes are committed as they are made.
+        """
+        pass
+
+    def start_writer(self):
+        pass
+
+    def stop_writer(self):
+        pass
+
+    def to_json(self):
+        return [preference.to_json() for preference in self.preferences]
+
+
+def preference_row(custom_media_preference):
+    """
+    :return: The values of the columns of a preference
+    """
+    selector = custom_media_preference.selector
+    return (selector_key(selector),
+            selector.get_type_name() if selector else "unknown",
+            selector.tv_show_name if selector else "",
+            selector.file_name if selector else "",
+            custom_media_preference.priority_index,
+            custom_media_preference.audio_language,
+            custom_media_preference.audio_track_id,
+            custom_media_preference.subtitle_language,
+            custom_media_preference.subtitle_track_id,
+            int(bool(custom_media_preference.enable_subtitles)))
+
+
+def row_preference(row):
+    """
+    :return: The preference of a row of the preferences table
+    """
+    selector_string, selector_type, tv_show_name, file_name, priority, audio_language, audio_track_id, \
+        subtitle_language, subtitle_track_id, enable_subtitles = row
+    custom_media_preference = CustomMediaPreference()
+    if selector_string:
+        custom_media_preference.selector = MediaSelector()
+        custom_media_preference.selector.tv_show_name = tv_show_name
+        custom_media_preference.selector.file_name = file_name
+    custom_media_preference.priority_index = priority
+    custom_media_preference.audio_language = audio_language
+    custom_media_preference.audio_track_id = audio_track_id
+    custom_media_preference.subtitle_language = subtitle_language
+    custom_media_preference.subtitle_track_id = subtitle_track_id
+    custom_media_preference.enable_subtitles = bool(enable_subtitles)
+    return custom_media_preference
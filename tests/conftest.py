@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules of the service import each other and Kodi's modules by name, as they do in Kodi
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [os.path.join(TESTS_DIR, 'stubs'), os.path.join(ROOT_DIR, 'resources', 'lib'), ROOT_DIR]
@@ -0,0 +1,49 @@
+"""
+Stand-in for Kodi's xbmc module, enough to import and run the modules of the service outside Kodi.
+"""
+import json
+import time
+
+LOGDEBUG, LOGINFO, LOGWARNING, LOGERROR = 0, 1, 2, 3
+
+# Messages logged, and queries sent to executeJSONRPC
+LOGS = []
+QUERIES = []
+
+
+def log(msg, level=LOGDEBUG):
+    LOGS.append(msg)
+
+
+def sleep(ms):
+    pass
+
+
+def answerJSONRPC(request):
+    """ Replaced by the tests to answer the requests of executeJSONRPC """
+    return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': -32601, 'message': 'Method not found.'}}
+
+
+def executeJSONRPC(query):
+    QUERIES.append(query)
+    request = json.loads(query)
+    if isinstance(request, list):
+        return json.dumps([answerJSONRPC(item) for item in request])
+    return json.dumps(answerJSONRPC(request))
+
+
+class Player:
+    def isPlaying(self):
+        return False
+
+    def isPlayingVideo(self):
+        return False
+
+
+class Monitor:
+    def abortRequested(self):
+        return False
+
+    def waitForAbort(self, timeout=None):
+        time.sleep(timeout or 0)
+        return False
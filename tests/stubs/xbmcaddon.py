@@ -0,0 +1,25 @@
+"""
+Stand-in for Kodi's xbmcaddon module.
+"""
+import tempfile
+
+# Settings of the addon, set by the tests
+SETTINGS = {'log_level': '0', 'delay': '0', 'FastSubsDisplay': '0'}
+PROFILE = tempfile.mkdtemp(prefix='langprefman-') + '/'
+
+
+class Addon:
+    def __init__(self, id=None):
+        pass
+
+    def getSetting(self, key):
+        return SETTINGS.get(key, '')
+
+    def getSettingBool(self, key):
+        return SETTINGS.get(key, '') == 'true'
+
+    def getAddonInfo(self, key):
+        return {'id': 'service.languagepreferencemanager', 'profile': PROFILE}.get(key, '')
+
+    def getLocalizedString(self, string_id):
+        return str(string_id)
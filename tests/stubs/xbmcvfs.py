@@ -0,0 +1,19 @@
+"""
+Stand-in for Kodi's xbmcvfs module.
+"""
+import os
+
+import xbmcaddon
+
+
+def translatePath(path):
+    return path.replace('special://profile/addon_data/service.languagepreferencemanager/', xbmcaddon.PROFILE)
+
+
+def exists(path):
+    return os.path.exists(path)
+
+
+def mkdirs(path):
+    os.makedirs(path, exist_ok=True)
+    return True
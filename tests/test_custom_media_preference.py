@@ -0,0 +1,103 @@
+"""
+Tests of the journal of the custom media preferences.
+"""
+import glob
+import os
+import unittest
+
+import custom_media_preference
+from custom_media_preference import MediaPreferenceManager, CustomMediaPreference
+
+
+def preferenceJson(number, audio_language='eng', priority=0):
+    return {'selector': ('tv_show:Show {0}' if number % 2 else 'file:/movies/{0}.mkv').format(number),
+            'priority': priority, 'audio_language': audio_language, 'audio_track_id': -1,
+            'subtitle_language': 'fre', 'subtitle_track_id': -1, 'enable_subtitles': True}
+
+
+def preference(number, audio_language='eng', priority=0):
+    return CustomMediaPreference.from_json(preferenceJson(number, audio_language, priority))
+
+
+def state(manager):
+    return [preference.to_json() for preference in manager.preferences]
+
+
+def journalChanges():
+    with open(custom_media_preference.__journal_file__) as file:
+        return file.readlines()[1:]
+
+
+class StandInWriter:
+    """ Lets the manager queue its changes, written when the test says so """
+
+    def schedule(self):
+        pass
+
+
+class TestPreferencesJournal(unittest.TestCase):
+
+    def setUp(self):
+        for file_name in glob.glob(custom_media_preference.__preferences_file__.replace('.json', '*')):
+            os.remove(file_name)
+        self.manager = MediaPreferenceManager()
+        self.manager.write_preferences()
+        self.manager.writer = StandInWriter()
+
+    def test_changes_replayed(self):
+        for number in range(5):
+            self.manager.add_preference(preference(number))
+        self.manager.remove_preference(preference(1))
+        self.manager.add_preference(preference(0, 'jpn'))
+        self.manager.write_changes()
+
+        self.assertEqual(len(journalChanges()), 7)
+        self.assertEqual(state(MediaPreferenceManager.from_file()), state(self.manager))
+
+    def test_change_during_compaction(self):
+        self.manager.add_preference(preference(1, priority=1))
+        self.manager.write_changes()
+        to_json = self.manager.to_json
+
+        def to_json_after_change():
+            # Another thread records a change while the writer thread takes the snapshot
+            self.manager.to_json = to_json
+            self.manager.add_preference(preference(2, priority=1))
+            return to_json()
+
+        self.manager.to_json = to_json_after_change
+        self.manager.add_preference(preference(3, priority=1))
+        self.manager.snapshot_hash = None
+        self.manager.write_changes()
+        # The change is in the snapshot, it is not written again to its journal
+        self.manager.write_changes()
+        self.assertEqual(journalChanges(), [])
+
+        self.manager.add_preference(preference(4, priority=1))
+        self.manager.write_changes()
+        self.assertEqual(len(journalChanges()), 1)
+        loaded = MediaPreferenceManager.from_file()
+        self.assertEqual(state(loaded), state(self.manager))
+        self.assertEqual(loaded.get_preference_for_item(False, '', '/movies/2.mkv').to_json(), preferenceJson(2, priority=1))
+
+    def test_incomplete_last_line(self):
+        self.manager.add_preference(preference(1))
+        self.manager.write_changes()
+        expected = state(self.manager)
+        with open(custom_media_preference.__journal_file__, 'a') as file:
+            file.write('{"add": {"sel')
+
+        self.assertEqual(state(MediaPreferenceManager.from_file()), expected)
+
+    def test_journal_of_another_snapshot(self):
+        self.manager.add_preference(preference(1))
+        self.manager.write_changes()
+        with open(custom_media_preference.__journal_file__) as file:
+            stale_journal = file.read()
+        # Crash between the new preferences file and the new journal
+        self.manager.add_preference(preference(2))
+        self.manager.write_preferences()
+        with open(custom_media_preference.__journal_file__, 'w') as file:
+            file.write(stale_journal)
+
+        self.assertEqual(state(MediaPreferenceManager.from_file()), state(self.manager))
@@ -0,0 +1,74 @@
+"""
+Tests of the library precomputation job, with canned library listings and a stand-in for the player.
+"""
+import threading
+import unittest
+
+import xbmc
+import precompute
+from precompute import LibraryPrecomputer, PrecomputationStopped, PrecomputedDecisions
+
+MOVIES = [{'movieid': movie_id, 'file': '/movies/{0}.mkv'.format(movie_id)} for movie_id in range(3)]
+
+
+def answerLibrary(request):
+    limits = request['params']['limits']
+    return {'jsonrpc': '2.0', 'id': request['id'],
+            'result': {'movies': MOVIES[limits['start']:limits['end']],
+                       'limits': {'start': limits['start'], 'end': limits['end'], 'total': len(MOVIES)}}}
+
+
+class StandInPlayer:
+    def __init__(self):
+        self.playing = False
+        self.checks_while_playing = 0
+
+    def isPlayingVideo(self):
+        if self.playing:
+            self.checks_while_playing += 1
+        return self.playing
+
+
+class TestLibraryPrecomputer(unittest.TestCase):
+
+    def setUp(self):
+        self.poll_interval = precompute.PLAYBACK_POLL_INTERVAL
+        precompute.PLAYBACK_POLL_INTERVAL = 1
+        xbmc.answerJSONRPC = answerLibrary
+        self.player = StandInPlayer()
+        self.precomputer = LibraryPrecomputer(self.player, None, PrecomputedDecisions(), None)
+
+    def tearDown(self):
+        precompute.PLAYBACK_POLL_INTERVAL = self.poll_interval
+
+    def test_yields_to_playback_within_a_page(self):
+        items = self.precomputer.libraryItems('VideoLibrary.GetMovies', 'movies', ['file'])
+        self.assertEqual(next(items), MOVIES[0])
+
+        self.player.playing = True
+        timer = threading.Timer(0.2, lambda: setattr(self.player, 'playing', False))
+        timer.start()
+        self.assertEqual(next(items), MOVIES[1])
+        timer.join()
+        self.assertGreater(self.player.checks_while_playing, 0)
+        self.assertEqual(list(items), MOVIES[2:])
+
+    def test_stopped_within_a_page(self):
+        items = self.precomputer.libraryItems('VideoLibrary.GetMovies', 'movies', ['file'])
+        next(items)
+        self.precomputer._stop_event.set()
+        with self.assertRaises(PrecomputationStopped):
+            next(items)
+
+
+class TestPrecomputedDecisions(unittest.TestCase):
+
+    def test_clear(self):
+        precomputed = PrecomputedDecisions()
+        precomputed.invalidate(1)
+        precomputed.putItem('/movies/0.mkv', 'layout', decisions={'fingerprint': 'decision'})
+        self.assertEqual(precomputed.get('fingerprint'), 'decision')
+
+        precomputed.clear()
+        self.assertIsNone(precomputed.get('fingerprint'))
+        self.assertEqual(len(precomputed), 0)
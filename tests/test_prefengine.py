@@ -0,0 +1,312 @@
+"""
+Differential tests of the preference engine against the evaluators it replaced.
+
+The reference evaluators below are the former evalAudioPrefs, evalSubPrefs and evalCondSubPrefs of
+LangPrefMan_Player, without logging, taking the player state as parameters. They compare the language of the tracks
+as strings with the code and the full name of each preference, where the engine compares canonical language IDs.
+The results are the same, except where canonical IDs were meant to change them:
+
+- Aliases: a preference for one code of a language (ex. German = ger) also matches tracks tagged with another code
+  of the same language (deu), and languages sharing a code (Farsi and Persian = per) match each other.
+- Alias ordering: as all the aliases of a preference are now one language, the first track of the language is picked
+  in tracks order, instead of the first track tagged with the first alias.
+- Empty subtitle languages count as "und" for every preference, instead of only once a previous preference normalised
+  them.
+
+The random cases only use languages with a single code, the divergences are tested on their own.
+"""
+import random
+import unittest
+
+from langcodes import LANGUAGES, languageTranslate
+from prefengine import KeywordMatcher, StreamSnapshot, evalAudio, evalSub, evalCondSub
+from prefparser import PrefParser
+
+SIGNS_KEYWORDS = ['signs']
+FORCED_KEYWORDS = ['forced', 'forcés']
+
+
+def isInBlacklist(name, keyword_blacklist):
+    test = name.lower()
+    return any(keyword in test for keyword in keyword_blacklist)
+
+
+def isSignsSub(name):
+    test = name.lower()
+    return any(x in test for x in SIGNS_KEYWORDS)
+
+
+def forcedFlagMatches(forced, name, forced_tag):
+    test = name.lower()
+    found = any(x in test for x in FORCED_KEYWORDS)
+    if forced and not found and forced_tag:
+        found = True
+    return ((forced == 'false') and not found) or ((forced == 'true') and found)
+
+
+def selectedIndex(stream):
+    if stream and 'index' in stream:
+        return stream['index']
+    return -1
+
+
+def referenceOriginalAudio(state, audio_original_preflist):
+    found = [stream['index'] for stream in state['audiostreams']
+             if stream['isoriginal'] and stream['language'] in audio_original_preflist]
+    if found:
+        return found[0] if found[0] != state['selected_audio_stream']['index'] else -1
+    return None
+
+
+def referenceAudio(state, audio_prefs, audio_keyword_blacklist, audio_original_preflist):
+    if audio_original_preflist:
+        index = referenceOriginalAudio(state, audio_original_preflist)
+        if index is not None:
+            return index
+    selected = state['selected_audio_stream']
+    for g_t, preferences in audio_prefs:
+        if g_t and not (state['genres_and_tags'] & g_t):
+            continue
+        for name, codes in preferences:
+            for code in codes.split(','):
+                if (selected and 'language' in selected and
+                        not isInBlacklist(selected['name'], audio_keyword_blacklist) and
+                        (code == selected['language'] or name == selected['language'])):
+                    return -1
+                for stream in state['audiostreams']:
+                    if isInBlacklist(stream['name'], audio_keyword_blacklist):
+                        continue
+                    if code == stream['language'] or name == stream['language']:
+                        return stream['index']
+    return -2
+
+
+def referenceSub(state, sub_prefs, subtitle_keyword_blacklist, ignore_signs):
+    selected = state['selected_sub']
+    for g_t, preferences in sub_prefs:
+        if g_t and not (state['genres_and_tags'] & g_t):
+            continue
+        for pref in preferences:
+            if len(pref) == 2:
+                name, codes = pref
+                forced = 'false'
+            else:
+                name, codes, forced = pref
+            for code in codes.split(','):
+                if (selected and 'language' in selected and
+                        not isInBlacklist(selected['name'], subtitle_keyword_blacklist) and
+                        not (ignore_signs and isSignsSub(selected['name'])) and
+                        (code == selected['language'] or name == selected['language']) and
+                        forcedFlagMatches(forced, selected['name'], selected['isforced'])):
+                    return -1
+                to_chose_subtitle_indexes = []
+                for sub in state['subtitles']:
+                    if isInBlacklist(sub['name'], subtitle_keyword_blacklist):
+                        continue
+                    if ignore_signs and isSignsSub(sub['name']):
+                        continue
+                    if ((code == sub['language'] or name == sub['language']) and
+                            forcedFlagMatches(forced, sub['name'], sub['isforced'])):
+                        to_chose_subtitle_indexes.append(sub['index'])
+                if selectedIndex(selected) in to_chose_subtitle_indexes:
+                    return selectedIndex(selected)
+                if to_chose_subtitle_indexes:
+                    return to_chose_subtitle_indexes[0]
+    return -2
+
+
+def referenceCondSub(state, condsub_prefs, subtitle_keyword_blacklist, ignore_signs):
+    selected = state['selected_audio_stream']
+    for g_t, preferences in condsub_prefs:
+        if g_t and not (state['genres_and_tags'] & g_t):
+            continue
+        for audio_name, audio_codes, sub_name, sub_codes, forced, ss_tag in preferences:
+            for audio_code in audio_codes.split(','):
+                if not (selected and 'language' in selected and
+                        (audio_code == selected['language'] or audio_name == selected['language'] or
+                         audio_code == 'any')):
+                    continue
+                for sub_code in sub_codes.split(','):
+                    if sub_code == 'non':
+                        if forced == 'true':
+                            for sub in state['subtitles']:
+                                if isInBlacklist(sub['name'], subtitle_keyword_blacklist):
+                                    continue
+                                if ignore_signs and isSignsSub(sub['name']):
+                                    continue
+                                if ((audio_code == sub['language'] or audio_name == sub['language']) and
+                                        forcedFlagMatches(forced, sub['name'], sub['isforced'])):
+                                    return sub['index']
+                        return -1
+                    to_chose_subtitle_indexes = []
+                    for sub in state['subtitles']:
+                        if sub_code == sub['language'] or sub_name == sub['language']:
+                            if ss_tag == 'true' and isSignsSub(sub['name']):
+                                to_chose_subtitle_indexes.append(sub['index'])
+                        if isInBlacklist(sub['name'], subtitle_keyword_blacklist):
+                            continue
+                        if ignore_signs and isSignsSub(sub['name']):
+                            continue
+                        if sub_code == sub['language'] or sub_name == sub['language']:
+                            if ss_tag == 'false' and forcedFlagMatches(forced, sub['name'], sub['isforced']):
+                                to_chose_subtitle_indexes.append(sub['index'])
+                    if selectedIndex(state['selected_sub']) in to_chose_subtitle_indexes:
+                        return selectedIndex(state['selected_sub'])
+                    if to_chose_subtitle_indexes:
+                        return to_chose_subtitle_indexes[0]
+    return -2
+
+
+# Languages with a single code, not shared with another language
+SINGLE_CODES = [row[3] for row in LANGUAGES
+                if ',' not in row[3] and row[3] not in ('non', 'any', 'und', 'per')][:12]
+TRACK_NAMES = ['', 'Forced', 'Signs & Songs', 'Commentary', 'SDH', 'forcés', 'Signs forced', 'Director']
+KEYWORDS = ['commentary', 'sdh', 'director']
+GENRES = ['anime', 'drama', 'kids']
+
+
+def randomLanguage(r):
+    choice = r.random()
+    if choice < 0.1:
+        return r.choice(['', 'und', 'xxx'])
+    code = r.choice(SINGLE_CODES[:6])
+    return languageTranslate(code, 3, 0) if choice < 0.2 else code
+
+
+def randomTrack(r, index, is_subtitle):
+    track = {'index': index, 'language': randomLanguage(r), 'name': r.choice(TRACK_NAMES)}
+    if is_subtitle:
+        track['isforced'] = r.random() < 0.2
+    else:
+        track['isoriginal'] = r.random() < 0.2
+    return track
+
+
+def randomState(r):
+    audiostreams = [randomTrack(r, index, False) for index in range(r.randint(1, 4))]
+    subtitles = [randomTrack(r, index, True) for index in range(r.randint(0, 6))]
+    selected_sub = dict(r.choice(subtitles)) if subtitles and r.random() < 0.7 else {}
+    return {'audiostreams': audiostreams,
+            'subtitles': subtitles,
+            'selected_audio_stream': dict(r.choice(audiostreams)),
+            'selected_sub': selected_sub,
+            'genres_and_tags': set(r.sample(GENRES, r.randint(0, 2)))}
+
+
+def randomPrefs(r, make_pref):
+    return [(set(r.sample(GENRES, r.randint(0, 1))) if position else set(),
+             [make_pref(r) for _ in range(r.randint(1, 3))])
+            for position in range(r.randint(1, 3))]
+
+
+def randomCode(r):
+    return r.choice(SINGLE_CODES[:8])
+
+
+def randomAudioPref(r):
+    code = randomCode(r)
+    return languageTranslate(code, 3, 0), code
+
+
+def randomSubPref(r):
+    code = randomCode(r)
+    return languageTranslate(code, 3, 0), code, r.choice(['true', 'false'])
+
+
+def randomCondSubPref(r):
+    audio_code = 'any' if r.random() < 0.15 else randomCode(r)
+    sub_code = 'non' if r.random() < 0.2 else randomCode(r)
+    forced = 'true' if sub_code == 'non' or r.random() < 0.3 else 'false'
+    ss_tag = 'true' if r.random() < 0.2 else 'false'
+    return (languageTranslate(audio_code, 3, 0), audio_code, languageTranslate(sub_code, 3, 0), sub_code,
+            forced, ss_tag)
+
+
+def snapshotFeatures(state, audio_keyword_blacklist, subtitle_keyword_blacklist):
+    snapshot = StreamSnapshot(state['audiostreams'], state['subtitles'], state['selected_audio_stream'],
+                              state['selected_sub'], bool(state['selected_sub']), state['genres_and_tags'])
+    return snapshot.features(KeywordMatcher(audio_keyword_blacklist, subtitle_keyword_blacklist))
+
+
+def normalised(state):
+    """ The state as the reference evaluators see it once empty subtitle languages count as "und" """
+    state = dict(state, subtitles=[dict(sub) for sub in state['subtitles']])
+    for sub in state['subtitles']:
+        if sub['language'] == '':
+            sub['language'] = 'und'
+    return state
+
+
+class TestPrefEngineDifferential(unittest.TestCase):
+    CASES = 3000
+
+    def setUp(self):
+        self.parser = PrefParser()
+
+    def test_same_indices(self):
+        r = random.Random(5)
+        for case in range(self.CASES):
+            state = randomState(r)
+            audio_keyword_blacklist = r.sample(KEYWORDS, r.randint(0, 2))
+            subtitle_keyword_blacklist = r.sample(KEYWORDS, r.randint(0, 2))
+            audio_original_preflist = r.sample(SINGLE_CODES[:6], r.randint(0, 2))
+            ignore_signs = r.random() < 0.5
+            audio_prefs = randomPrefs(r, randomAudioPref)
+            sub_prefs = randomPrefs(r, randomSubPref)
+            condsub_prefs = randomPrefs(r, randomCondSubPref)
+
+            features = snapshotFeatures(state, audio_keyword_blacklist, subtitle_keyword_blacklist)
+            reference_state = normalised(state)
+            genres_and_tags = frozenset(state['genres_and_tags'])
+            with self.subTest(case=case):
+                self.assertEqual(
+                    evalAudio(features, self.parser.compilePrefs(audio_prefs), genres_and_tags,
+                              audio_original_preflist),
+                    referenceAudio(reference_state, audio_prefs, audio_keyword_blacklist, audio_original_preflist))
+                self.assertEqual(
+                    evalSub(features, self.parser.compilePrefs(sub_prefs), genres_and_tags, ignore_signs),
+                    referenceSub(reference_state, sub_prefs, subtitle_keyword_blacklist, ignore_signs))
+                self.assertEqual(
+                    evalCondSub(features, self.parser.compilePrefs(condsub_prefs), genres_and_tags, ignore_signs),
+                    referenceCondSub(reference_state, condsub_prefs, subtitle_keyword_blacklist, ignore_signs))
+
+
+class TestPrefEngineDivergences(unittest.TestCase):
+    """ The intended differences with the reference evaluators, from matching canonical language IDs """
+
+    def setUp(self):
+        self.parser = PrefParser()
+
+    def evaluate(self, audio_languages, audio_prefs):
+        state = {'audiostreams': [{'index': index, 'language': language, 'name': '', 'isoriginal': False}
+                                  for index, language in enumerate(audio_languages)],
+                 'subtitles': [],
+                 'selected_audio_stream': {'index': 0, 'language': 'eng', 'name': '', 'isoriginal': False},
+                 'selected_sub': {},
+                 'genres_and_tags': set()}
+        features = snapshotFeatures(state, [], [])
+        return (evalAudio(features, self.parser.compilePrefs(audio_prefs), frozenset()),
+                referenceAudio(state, audio_prefs, [], []))
+
+    def test_alias(self):
+        # The track is tagged deu, the preference is for ger
+        self.assertEqual(self.evaluate(['eng', 'deu'], [(set(), [('German', 'ger')])]), (1, -2))
+
+    def test_shared_code(self):
+        # Farsi and Persian are both per
+        self.assertEqual(self.evaluate(['eng', 'Persian'], [(set(), [('Farsi', 'per')])]), (1, -2))
+
+    def test_alias_ordering(self):
+        # Both aliases in one preference: the first German track, not the first track tagged ger
+        self.assertEqual(self.evaluate(['eng', 'deu', 'ger'], [(set(), [('German', 'ger,deu')])]), (1, 2))
+
+    def test_empty_subtitle_language(self):
+        state = {'audiostreams': [{'index': 0, 'language': 'und', 'name': '', 'isoriginal': False}],
+                 'subtitles': [{'index': 0, 'language': '', 'name': 'Forced', 'isforced': True}],
+                 'selected_audio_stream': {'index': 0, 'language': 'und', 'name': '', 'isoriginal': False},
+                 'selected_sub': {},
+                 'genres_and_tags': set()}
+        condsub_prefs = [(set(), [('Undefined', 'und', 'None', 'non', 'true', 'false')])]
+        features = snapshotFeatures(state, [], [])
+        self.assertEqual(evalCondSub(features, self.parser.compilePrefs(condsub_prefs), frozenset(), False), 0)
+        self.assertEqual(referenceCondSub(state, condsub_prefs, [], False), -1)
@@ -0,0 +1,72 @@
+"""
+Differential tests of the NumPy kernel against the pure Python kernel: decideMany() must give the same decisions and
+traces with both, on random items and rules.
+"""
+import random
+import unittest
+from unittest import mock
+
+import prefkernel
+from prefengine import KeywordMatcher, StreamSnapshot, CompiledRules, PYTHON_KERNEL, decideMany
+from prefparser import PrefParser
+from test_prefengine import SINGLE_CODES, KEYWORDS, randomState, randomPrefs, randomAudioPref, randomSubPref, \
+    randomCondSubPref
+
+# Tracks of a language with several codes, or sharing its code with another language
+ALIASED_LANGUAGES = ['ger', 'deu', 'German', 'per', 'Persian']
+
+
+def randomSnapshot(r):
+    state = randomState(r)
+    for track in state['audiostreams'] + state['subtitles']:
+        if r.random() < 0.1:
+            track['language'] = r.choice(ALIASED_LANGUAGES)
+    if r.random() < 0.1:
+        # The selected subtitle is not among the tracks
+        state['selected_sub'] = {'index': 9, 'language': 'eng', 'name': ''}
+    return StreamSnapshot(state['audiostreams'], state['subtitles'], state['selected_audio_stream'],
+                          state['selected_sub'], r.random() < 0.5, frozenset(state['genres_and_tags']),
+                          initial=r.random() < 0.8)
+
+
+def randomRules(r, parser):
+    return CompiledRules(parser.compilePrefs(randomPrefs(r, randomAudioPref)),
+                         parser.compilePrefs(randomPrefs(r, randomSubPref)),
+                         parser.compilePrefs(randomPrefs(r, randomCondSubPref)),
+                         KeywordMatcher(r.sample(KEYWORDS, r.randint(0, 2)), r.sample(KEYWORDS, r.randint(0, 2))),
+                         audio_prefs_on=r.random() < 0.8, sub_prefs_on=r.random() < 0.8,
+                         condsub_prefs_on=r.random() < 0.8, turn_subs_on=r.random() < 0.5,
+                         turn_subs_off=r.random() < 0.5, ignore_signs=r.random() < 0.5,
+                         audio_original_preflist=r.sample(SINGLE_CODES[:6], r.randint(0, 2)))
+
+
+@unittest.skipIf(prefkernel.numpy is None, 'numpy is not installed')
+class TestNumpyKernelDifferential(unittest.TestCase):
+    RULE_SETS = 200
+    ITEMS = 40
+
+    def setUp(self):
+        self.parser = PrefParser()
+
+    def assertSameDecisions(self, seed):
+        r = random.Random(seed)
+        for case in range(self.RULE_SETS):
+            rules = randomRules(r, self.parser)
+            snapshots = [randomSnapshot(r) for _ in range(self.ITEMS)]
+            python_traces = [[] for _ in snapshots]
+            numpy_traces = [[] for _ in snapshots]
+            with self.subTest(case=case):
+                self.assertEqual(decideMany(snapshots, rules, numpy_traces, prefkernel.NUMPY_KERNEL),
+                                 decideMany(snapshots, rules, python_traces, PYTHON_KERNEL))
+                self.assertEqual(numpy_traces, python_traces)
+
+    def test_same_decisions(self):
+        self.assertSameDecisions(11)
+
+    def test_same_decisions_in_batches(self):
+        # Items split across several kernel batches, the last one partial
+        with mock.patch.object(prefkernel, 'KERNEL_BATCH_SIZE', 7):
+            self.assertSameDecisions(12)
+
+    def test_bulk_kernel(self):
+        self.assertIs(prefkernel.bulkKernel(), prefkernel.NUMPY_KERNEL)
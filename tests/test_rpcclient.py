@@ -0,0 +1,237 @@
+"""
+Tests of the JSON-RPC TCP client against a stand-in for Kodi's TCP interface, replaying canned responses.
+"""
+import asyncio
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+import xbmc
+import rpcclient
+
+PORT = 19190
+UNUSED_PORT = 19191
+
+PROPERTIES_REQUEST = {'jsonrpc': '2.0', 'method': 'Player.GetProperties',
+                      'params': {'playerid': 1, 'properties': ['currentaudiostream']}, 'id': 2}
+ITEM_REQUEST = {'jsonrpc': '2.0', 'method': 'Player.GetItem', 'params': {'playerid': 1}, 'id': 3}
+RESPONSES = {
+    'Player.GetProperties': {'currentaudiostream': {'index': 1, 'language': 'fre', 'name': 'Français'}},
+    'Player.GetItem': {'item': {'type': 'episode', 'file': '/tv/Série/S01E01.mkv'}},
+}
+NOTIFICATION = {'jsonrpc': '2.0', 'method': 'Player.OnAVChange',
+                'params': {'sender': 'xbmc', 'data': {'player': {'playerid': 1}}}}
+
+
+class StandInServer:
+    """
+    Answers requests like Kodi does: JSON values one after the other without separator, written in small parts
+    (splitting multi-byte characters), the response to a batch only once all of it is done. A request for
+    Player.GetItem is preceded by a notification.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.writers = []
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def dropConnections(self):
+        """ Close the connections from the server side, like Kodi exiting """
+        for writer in self.writers:
+            self._loop.call_soon_threadsafe(writer.transport.abort)
+
+    def _run(self):
+        async def serve():
+            self._server = await asyncio.start_server(self._handle, rpcclient.JSONRPC_HOST, self.port)
+            self._ready.set()
+
+        self._loop.run_until_complete(serve())
+        self._loop.run_forever()
+        self._server.close()
+        self._loop.close()
+
+    async def _handle(self, reader, writer):
+        self.writers.append(writer)
+        decoder = json.JSONDecoder()
+        buffer = ''
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            buffer += data.decode('utf-8')
+            while buffer.strip():
+                try:
+                    message, end = decoder.raw_decode(buffer.lstrip())
+                except ValueError:
+                    break
+                buffer = buffer.lstrip()[end:]
+                await self._answer(writer, message)
+
+    async def _answer(self, writer, message):
+        requests = message if isinstance(message, list) else [message]
+        if any(request['method'] == 'Player.GetItem' for request in requests):
+            await self._send(writer, NOTIFICATION)
+        responses = [{'jsonrpc': '2.0', 'id': request['id'], 'result': RESPONSES[request['method']]}
+                     for request in requests if 'id' in request]
+        await self._send(writer, responses if isinstance(message, list) else responses[0])
+
+    @staticmethod
+    async def _send(writer, message):
+        data = json.dumps(message, ensure_ascii=False).encode('utf-8')
+        for start in range(0, len(data), 7):
+            writer.write(data[start:start + 7])
+            await writer.drain()
+
+
+def answerFromKodi(request):
+    return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': 'executeJSONRPC'}
+
+
+class SlowConnection:
+    """ Holds JsonRpcSocket.start back until released, as a connection that takes its time """
+
+    def __init__(self):
+        self.connecting = threading.Event()
+        self.released = threading.Event()
+        self._start = rpcclient.JsonRpcSocket.start
+        self._thread = None
+
+    def __enter__(self):
+        def start(socket):
+            self.connecting.set()
+            self.released.wait(5)
+            self._start(socket)
+
+        self._patcher = mock.patch.object(rpcclient.JsonRpcSocket, 'start', start)
+        self._patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.released.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._patcher.stop()
+
+    def useSocket(self, port):
+        """ Call useSocket on another thread, and wait until it is connecting """
+        self._thread = threading.Thread(target=rpcclient.useSocket, args=(True, port))
+        self._thread.start()
+        self.connecting.wait(5)
+
+    def release(self):
+        self.released.set()
+        self._thread.join()
+
+
+class TestJsonRpcSocket(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInServer(PORT)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.notifications = []
+        rpcclient.addNotificationListener(self.onNotification)
+        xbmc.answerJSONRPC = answerFromKodi
+        del xbmc.QUERIES[:]
+
+    def tearDown(self):
+        rpcclient.removeNotificationListener(self.onNotification)
+        rpcclient.useSocket(False)
+
+    def onNotification(self, method, data):
+        self.notifications.append((method, data))
+
+    def test_requests(self):
+        rpcclient.useSocket(True, PORT)
+        self.assertIsNotNone(rpcclient._socket)
+
+        response = rpcclient.queryJSONRPC(json.dumps(PROPERTIES_REQUEST))
+        self.assertEqual(response, {'jsonrpc': '2.0', 'id': 2, 'result': RESPONSES['Player.GetProperties']})
+        responses = rpcclient.queryJSONRPC([PROPERTIES_REQUEST, ITEM_REQUEST])
+        self.assertEqual([response['id'] for response in responses], [2, 3])
+        self.assertEqual(responses[1]['result'], RESPONSES['Player.GetItem'])
+        self.assertEqual(xbmc.QUERIES, [])
+
+    def test_concurrent_requests(self):
+        rpcclient.useSocket(True, PORT)
+        results = []
+
+        def query():
+            for _ in range(20):
+                results.append(rpcclient.queryJSONRPC(PROPERTIES_REQUEST)['result'])
+
+        threads = [threading.Thread(target=query) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [RESPONSES['Player.GetProperties']] * 80)
+
+    def test_notification(self):
+        rpcclient.useSocket(True, PORT)
+        rpcclient.queryJSONRPC(ITEM_REQUEST)
+        self.assertEqual(self.notifications, [(NOTIFICATION['method'], NOTIFICATION['params'])])
+
+    def test_unreachable(self):
+        rpcclient.useSocket(True, UNUSED_PORT)
+        self.assertIsNone(rpcclient._socket)
+        self.assertEqual(rpcclient.queryJSONRPC(PROPERTIES_REQUEST)['result'], 'executeJSONRPC')
+
+    def test_connection_dropped(self):
+        rpcclient.useSocket(True, PORT)
+        rpcclient.queryJSONRPC(PROPERTIES_REQUEST)
+        self.server.dropConnections()
+        time.sleep(0.2)
+
+        self.assertEqual(rpcclient.queryJSONRPC(PROPERTIES_REQUEST)['result'], 'executeJSONRPC')
+        self.assertIsNone(rpcclient._socket)
+        self.assertEqual(len(xbmc.QUERIES), 1)
+
+    def test_socket_stopped_while_in_use(self):
+        rpcclient.useSocket(True, PORT)
+        socket = rpcclient._socket
+        socket.stop()
+
+        with self.assertRaises(rpcclient.JsonRpcError):
+            socket.execute(PROPERTIES_REQUEST)
+        self.assertEqual(rpcclient.queryJSONRPC(PROPERTIES_REQUEST)['result'], 'executeJSONRPC')
+
+    def test_socket_disabled(self):
+        self.assertEqual(rpcclient.queryJSONRPC(json.dumps(PROPERTIES_REQUEST))['result'], 'executeJSONRPC')
+        self.assertEqual(xbmc.QUERIES, [json.dumps(PROPERTIES_REQUEST)])
+
+
+    def test_queries_while_connecting(self):
+        with SlowConnection() as connection:
+            connection.useSocket(PORT)
+            started = time.monotonic()
+            self.assertEqual(rpcclient.queryJSONRPC(PROPERTIES_REQUEST)['result'], 'executeJSONRPC')
+            self.assertLess(time.monotonic() - started, 1)
+
+            connection.release()
+        self.assertEqual(rpcclient.queryJSONRPC(PROPERTIES_REQUEST)['result'], RESPONSES['Player.GetProperties'])
+
+    def test_disabled_while_connecting(self):
+        with SlowConnection() as connection:
+            connection.useSocket(PORT)
+            rpcclient.useSocket(False)
+            connection.release()
+        self.assertIsNone(rpcclient._socket)
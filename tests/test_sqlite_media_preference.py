@@ -0,0 +1,59 @@
+"""
+Tests of the custom media preferences database, and of its export back to customMediaPreferences.json.
+"""
+import glob
+import os
+import unittest
+
+import custom_media_preference
+import sqlite_media_preference
+from custom_media_preference import MediaPreferenceManager
+from sqlite_media_preference import SqliteMediaPreferenceManager
+from test_custom_media_preference import preference, state
+
+
+class TestDatabaseExport(unittest.TestCase):
+
+    def setUp(self):
+        for file_name in glob.glob(custom_media_preference.__preferences_file__.replace('.json', '*')):
+            os.remove(file_name)
+        self.file_manager = MediaPreferenceManager()
+        for number in range(4):
+            self.file_manager.add_preference(preference(number))
+        self.file_manager.write_preferences()
+
+    def openDatabase(self):
+        manager = SqliteMediaPreferenceManager.open()
+        self.addCleanup(manager.connection.close)
+        return manager
+
+    def test_changes_exported(self):
+        database = self.openDatabase()
+        self.assertEqual(state(database), state(self.file_manager))
+        database.add_preference(preference(1, 'jpn'))
+        database.remove_preference(preference(2))
+        database.add_preference(preference(7, priority=2))
+        expected = state(database)
+        database.connection.close()
+
+        self.assertTrue(SqliteMediaPreferenceManager.export_to_file())
+        self.assertEqual(state(MediaPreferenceManager.from_file()), expected)
+        self.assertFalse(os.path.exists(sqlite_media_preference.__database_file__))
+
+    def test_file_imported_again(self):
+        self.openDatabase().connection.close()
+        SqliteMediaPreferenceManager.export_to_file()
+
+        # Changes made while the database is disabled are in the database once enabled again
+        self.file_manager = MediaPreferenceManager.from_file()
+        self.file_manager.add_preference(preference(5, 'ger'))
+        self.file_manager.write_preferences()
+        self.assertEqual(state(self.openDatabase()), state(self.file_manager))
+
+    def test_nothing_to_export(self):
+        self.assertFalse(SqliteMediaPreferenceManager.export_to_file())
+        self.assertEqual(state(MediaPreferenceManager.from_file()), state(self.file_manager))
+
+
+if __name__ == '__main__':
+    unittest.main()
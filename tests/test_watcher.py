@@ -0,0 +1,189 @@
+"""
+Tests of the subtitle change watcher, with a stand-in for the player, and with the player and its evaluation worker.
+"""
+import threading
+import time
+import unittest
+from unittest import mock
+
+import rpcclient
+import prefutils
+import xbmc
+from prefengine import Decision, StreamSnapshot, ACTION_SUBTITLE
+from prefutils import LangPrefWatcher, LangPrefMan_Player, EvaluationWorker, PlaybackSession, EVENT_AV_CHANGE, \
+    EVENT_SUBTITLE_CHECK
+
+# Seconds, short enough that polling never gets in the way of the tests
+MIN_INTERVAL = 60
+MAX_INTERVAL = 120
+
+
+class StandInPlayer:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.checked = threading.Event()
+        self.checks = 0
+
+    def isPlayingVideo(self):
+        return True
+
+    def requestSubtitleCheck(self):
+        self.checks += 1
+        self.checked.set()
+        if self.fail:
+            raise RuntimeError('player went away')
+
+
+class TestLangPrefWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.player = StandInPlayer()
+        self.watcher = LangPrefWatcher(self.player, MIN_INTERVAL, MAX_INTERVAL)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+
+    def assertChecked(self):
+        self.assertTrue(self.player.checked.wait(5))
+        self.player.checked.clear()
+
+    def test_stream_change_notification(self):
+        self.watcher.monitor.onNotification('xbmc', 'Player.OnAVChange', '{}')
+        self.assertChecked()
+
+    def test_other_notification(self):
+        self.watcher.monitor.onNotification('xbmc', 'Player.OnPropertyChanged', '{}')
+        self.assertFalse(self.player.checked.wait(0.2))
+
+    def test_pushed_notification(self):
+        # As dispatched by the JSON-RPC TCP client
+        for listener in rpcclient._notification_listeners:
+            listener('Player.OnAVChange', {'sender': 'xbmc', 'data': {}})
+        self.assertChecked()
+
+    def test_failed_check(self):
+        self.player.fail = True
+        self.watcher.requestCheck()
+        self.assertChecked()
+        self.assertTrue(self.watcher.is_alive())
+
+        self.player.fail = False
+        self.watcher.requestCheck()
+        self.assertChecked()
+
+    def test_stop(self):
+        self.watcher.stop()
+        self.assertNotIn(self.watcher.onNotification, rpcclient._notification_listeners)
+
+
+AUDIO_STREAMS = [{'index': 0, 'language': 'jpn', 'name': ''}]
+SUBTITLES = [{'index': 0, 'language': 'eng', 'name': 'Signs'}, {'index': 1, 'language': 'eng', 'name': 'Full'}]
+
+
+class TestSubtitleCheckOrdering(unittest.TestCase):
+    """ Subtitle checks run on the evaluation worker, never in the middle of our own track changes """
+
+    def setUp(self):
+        # What Kodi reports as selected
+        self.kodi = {'currentaudiostream': AUDIO_STREAMS[0], 'currentsubtitle': SUBTITLES[0],
+                     'subtitleenabled': False}
+        self.checked = threading.Event()
+        self.checks = 0
+
+        player = LangPrefMan_Player.__new__(LangPrefMan_Player)
+        player.LPM_initial_run_done = True
+        player.playback_session = PlaybackSession()
+        player.isPlayingVideo = lambda: True
+        player.getTime = lambda: 100.0
+        player.setSubtitleStream = self.setSubtitleStream
+        detect_subtitle_change = player.detect_subtitle_change
+
+        def checkSubtitles():
+            changed = detect_subtitle_change()
+            self.checks += 1
+            self.checked.set()
+            return changed
+        player.detect_subtitle_change = checkSubtitles
+
+        snapshot = StreamSnapshot(AUDIO_STREAMS, SUBTITLES, self.kodi['currentaudiostream'],
+                                  self.kodi['currentsubtitle'], self.kodi['subtitleenabled'], initial=False)
+        player.playback_session.setSnapshot(snapshot, 0)
+        player.setSnapshot(snapshot)
+        self.player = player
+
+        self.startPatch(mock.patch.object(xbmc, 'answerJSONRPC', self.answerJSONRPC))
+        self.startPatch(mock.patch.multiple(prefutils.settings, create=True, service_enabled=True,
+                                            at_least_one_pref_on=True, condsub_prefs_on=False, fast_subs_display=0,
+                                            is_store_user_preference_for_player=lambda player: True))
+        self.startPatch(mock.patch.object(prefutils.CustomMediaPreference, 'from_player'))
+        self.startPatch(mock.patch.object(prefutils.media_preference_manager, 'save_preferences'))
+        self.add_preference = self.startPatch(mock.patch.object(prefutils.media_preference_manager, 'add_preference'))
+
+        player.evaluation_worker = EvaluationWorker(player)
+        player.evaluation_worker.start()
+        self.addCleanup(player.evaluation_worker.stop)
+        player.lang_pref_watcher = LangPrefWatcher(player, MIN_INTERVAL, MAX_INTERVAL)
+        player.lang_pref_watcher.start()
+        self.addCleanup(player.lang_pref_watcher.stop)
+
+    def startPatch(self, patcher):
+        patched = patcher.start()
+        self.addCleanup(patcher.stop)
+        return patched
+
+    def answerJSONRPC(self, request):
+        properties = request['params']['properties']
+        return {'jsonrpc': '2.0', 'id': request.get('id'),
+                'result': dict((name, self.kodi[name]) for name in properties if name in self.kodi)}
+
+    def setSubtitleStream(self, index):
+        self.kodi['currentsubtitle'] = SUBTITLES[index]
+        self.kodi['subtitleenabled'] = True
+        # Kodi announces the stream change while the evaluation is still going on
+        self.player.lang_pref_watcher.monitor.onNotification('xbmc', 'Player.OnAVChange', '{}')
+        time.sleep(0.2)
+
+    def test_own_change_not_stored(self):
+        self.player.evaluateAVChange = lambda job: self.player.applyDecision(Decision([(ACTION_SUBTITLE, 1)]))
+        self.player.evaluation_worker.submit(self.player.playback_session, EVENT_AV_CHANGE)
+
+        self.assertTrue(self.checked.wait(5))
+        self.assertEqual(self.player.getSelectedSubtitleIndex(), 1)
+        self.add_preference.assert_not_called()
+
+    def test_user_change_stored(self):
+        self.kodi['currentsubtitle'] = SUBTITLES[1]
+        self.kodi['subtitleenabled'] = True
+        self.player.lang_pref_watcher.monitor.onNotification('xbmc', 'Player.OnAVChange', '{}')
+
+        self.assertTrue(self.checked.wait(5))
+        self.add_preference.assert_called_once()
+
+
+    def test_checks_coalesced(self):
+        evaluating = threading.Event()
+        release = threading.Event()
+
+        def evaluateAVChange(job):
+            evaluating.set()
+            release.wait(5)
+        self.player.evaluateAVChange = evaluateAVChange
+        self.player.evaluation_worker.submit(self.player.playback_session, EVENT_AV_CHANGE)
+        self.assertTrue(evaluating.wait(5))
+
+        # Checks requested by notifications, by polling and by pause/resume, during the evaluation
+        self.player.lang_pref_watcher.monitor.onNotification('xbmc', 'Player.OnAVChange', '{}')
+        self.player.lang_pref_watcher.requestCheck()
+        self.player.onPlayBackPaused()
+        self.player.onPlayBackResumed()
+        time.sleep(0.2)
+        self.assertEqual(self.checks, 0)
+
+        release.set()
+        self.assertTrue(self.checked.wait(5))
+        # Jobs run in order, all the checks requested before this one are done once it is
+        self.checked.clear()
+        self.player.evaluation_worker.submit(self.player.playback_session, EVENT_SUBTITLE_CHECK)
+        self.assertTrue(self.checked.wait(5))
+        self.assertEqual(self.checks, 2)
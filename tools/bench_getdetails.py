@@ -0,0 +1,89 @@
+"""
+Microbenchmark of LangPrefMan_Player.getDetails at the start of a playback: the active player, stream details and
+genres/tags queries sent as one JSON-RPC batch, or one after the other. Runs outside Kodi, against the stub xbmc
+module of the tests, answering with canned responses after a simulated latency.
+
+    python tools/bench_getdetails.py [latency in ms] [iterations]
+"""
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT_DIR, 'tests', 'stubs'), os.path.join(ROOT_DIR, 'resources', 'lib'), ROOT_DIR]
+
+import xbmc
+import prefutils
+
+LATENCY = float(sys.argv[1]) / 1000.0 if len(sys.argv) > 1 else 0.0
+ITERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else (300 if LATENCY else 3000)
+
+AUDIO = [{'index': index, 'language': language, 'name': name, 'codec': 'ac3', 'channels': 6,
+          'isdefault': index == 0, 'isoriginal': index == 0, 'isimpaired': False, 'bitrate': 640000}
+         for index, (language, name) in enumerate([('jpn', 'Japanese'), ('eng', 'English'), ('eng', 'Commentary')])]
+SUBTITLES = [{'index': index, 'language': language, 'name': name, 'isdefault': False, 'isforced': 'forced' in name,
+              'isimpaired': False}
+             for index, (language, name) in enumerate([('eng', 'Full'), ('eng', 'Signs & Songs'), ('eng', 'forced'),
+                                                       ('fre', 'Complets'), ('ger', 'Vollständig')])]
+RESULTS = {
+    'Player.GetActivePlayers': [{'playerid': 1, 'playertype': 'internal', 'type': 'video'}],
+    'Player.GetProperties': {'audiostreams': AUDIO, 'subtitles': SUBTITLES, 'currentaudiostream': AUDIO[0],
+                             'currentsubtitle': SUBTITLES[0], 'subtitleenabled': True},
+    'Player.GetItem': {'item': {'id': 1, 'type': 'episode', 'label': 'Episode', 'genre': ['Animation', 'Anime'],
+                                'tag': ['Subbed']}},
+}
+
+calls = 0
+
+
+def answerJSONRPC(request):
+    return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': RESULTS[request['method']]}
+
+
+def executeJSONRPC(query):
+    """ One round trip per call, whatever the number of requests in it """
+    global calls
+    calls += 1
+    if LATENCY:
+        time.sleep(LATENCY)
+    return stub_executeJSONRPC(query)
+
+
+stub_executeJSONRPC = xbmc.executeJSONRPC
+xbmc.answerJSONRPC = answerJSONRPC
+xbmc.executeJSONRPC = executeJSONRPC
+
+
+def newPlayer(batch):
+    Player = prefutils.LangPrefMan_Player
+    # Only what getDetails needs, without the threads of the service
+    player = Player.__new__(Player)
+    player.LPM_initial_run_done = False
+    player.rpc_batch_supported = batch
+    player.prefetched_item = None
+    player.playback_session = None
+    player.getPlayingFile = lambda: '/tv/Show/S01E01.mkv'
+    return player
+
+
+def bench(batch):
+    global calls
+    player = newPlayer(batch)
+    player.getDetails()
+    calls = 0
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        # Each playback starts with nothing known about the playing item
+        player.playback_session = prefutils.PlaybackSession()
+        player.getDetails()
+    elapsed = (time.perf_counter() - start) / ITERATIONS
+    print('{0:<10} latency {1:4.1f} ms  {2:8.1f} us/getDetails  {3:.1f} round trips'.format(
+        'batch' if batch else 'sequential', LATENCY * 1000, elapsed * 1e6, calls / float(ITERATIONS)))
+
+
+if __name__ == '__main__':
+    prefutils.settings.readSettings()
+    # The genres/tags are only queried when custom preferences are in use
+    prefutils.settings.custom_audio_prefs_on = True
+    bench(batch=False)
+    bench(batch=True)
@@ -0,0 +1,72 @@
+"""
+Benchmark of saving the custom media preferences: the cost of saving one change by appending it to the journal,
+against writing the whole preferences file, and the cost of loading the preferences file plus its journal.
+Runs outside Kodi, against the stub Kodi modules of the tests, in a temporary profile directory.
+
+    python tools/bench_preferences_journal.py [number of preferences...]
+"""
+import glob
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT_DIR, 'tests', 'stubs'), os.path.join(ROOT_DIR, 'resources', 'lib'), ROOT_DIR]
+
+import custom_media_preference
+from custom_media_preference import MediaPreferenceManager, CustomMediaPreference
+
+SIZES = [int(size) for size in sys.argv[1:]] or [5000, 20000, 50000]
+CHANGES = 50
+
+
+def preferenceJson(number, audio_language='eng'):
+    return {'selector': ('tv_show:Show {0}' if number % 2 else 'file:/movies/{0}.mkv').format(number),
+            'priority': number % 3, 'audio_language': audio_language, 'audio_track_id': 1,
+            'subtitle_language': 'fre', 'subtitle_track_id': 2, 'enable_subtitles': True}
+
+
+def removeFiles():
+    for file_name in glob.glob(custom_media_preference.__preferences_file__.replace('.json', '*')):
+        os.remove(file_name)
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def bench(size, journal):
+    removeFiles()
+    manager = MediaPreferenceManager.from_json([preferenceJson(number) for number in range(size)])
+    manager.write_preferences()
+    if journal:
+        manager.start_writer()
+        # Changes are only written when flushed below
+        manager.writer.delay = 3600
+    costs = []
+    for change in range(CHANGES):
+        manager.add_preference(CustomMediaPreference.from_json(preferenceJson(change * 7, 'l{0}'.format(change))))
+        if journal:
+            manager.save_preferences()
+            start = time.perf_counter()
+            manager.writer.flush()
+        else:
+            start = time.perf_counter()
+            manager.write_preferences()
+        costs.append(time.perf_counter() - start)
+    if journal:
+        manager.stop_writer()
+
+    start = time.perf_counter()
+    loaded = MediaPreferenceManager.from_file()
+    load = time.perf_counter() - start
+    assert len(loaded.preferences) == size
+    print('{0:6d} {1:<10} save per change {2:7.2f} ms  load after {3} changes {4:7.1f} ms'.format(
+        size, 'journal' if journal else 'full file', median(costs) * 1000, CHANGES, load * 1000))
+
+
+if __name__ == '__main__':
+    for size in SIZES:
+        bench(size, journal=False)
+        bench(size, journal=True)
+    removeFiles()